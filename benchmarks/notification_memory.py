@@ -0,0 +1,120 @@
+"""Compare memory held by the notifications of a batch of claimed outbox events, queued per event and per change
+
+    python -m benchmarks.notification_memory --notifications 100000 --subscribers 10
+"""
+import logging
+import tracemalloc
+
+from bson import BSON, ObjectId
+from datetime import datetime
+
+from vss.backend import build_variant_doc, slim_variant_doc
+from vss.constants import DEFAULT_GENOME_BUILD, DEFAULT_NOTIFICATION_PREFERENCES
+from vss.outbox import get_event_key, OUTBOX_CLAIMED
+from vss.scripts.dispatch import group_events
+from vss.services.notifier import UpdateNotifier
+
+NUM_USERS = 5000
+RUN_ID = ObjectId()
+
+
+def make_docs(i):
+    pos = str(1000000 + i)
+    old_doc = build_variant_doc(DEFAULT_GENOME_BUILD, '1', pos, 'G', 'A',
+                                variation_id=str(i), clinical_significance='Benign', gold_stars='1',
+                                review_status='criteria provided, single submitter', last_evaluated='2017-01-01')
+    new_doc = build_variant_doc(DEFAULT_GENOME_BUILD, '1', pos, 'G', 'A',
+                                variation_id=str(i), clinical_significance='Pathogenic', gold_stars='2',
+                                review_status='criteria provided, multiple submitters', last_evaluated='2018-01-01')
+    # As queued by the importer
+    return slim_variant_doc(old_doc), slim_variant_doc(new_doc)
+
+
+def make_events(user_ids, notifications, subscribers):
+    """Return outbox events as claimed by the dispatch worker: each decoded separately, with its own docs"""
+    events = []
+    created_at = datetime.utcnow()
+    for i in range(notifications // subscribers):
+        old_doc, new_doc = make_docs(i)
+        for j in range(subscribers):
+            user_id = user_ids[(i * subscribers + j) % len(user_ids)]
+            event = {
+                '_id': get_event_key(RUN_ID, new_doc['_id'], user_id),
+                'run_id': RUN_ID,
+                'variant_id': new_doc['_id'],
+                'user_id': user_id,
+                'tag': 'patient panel {}'.format(j),
+                'old': old_doc,
+                'new': new_doc,
+                'created_at': created_at,
+                'status': OUTBOX_CLAIMED,
+                'attempts': 1,
+            }
+            events.append(BSON.encode(event).decode())
+    return events
+
+
+def make_notifier(user_ids):
+    notifier = UpdateNotifier(None, {})
+    for user_id in user_ids:
+        notifier._cache_user(user_id, {
+            '_id': user_id,
+            'email': '{}@example.com'.format(user_id),
+            'notification_preferences': dict(DEFAULT_NOTIFICATION_PREFERENCES),
+        })
+    return notifier
+
+
+def per_event(events):
+    # A change per event, as the dispatch worker used to queue them
+    return [(event['old'], event['new'], [event]) for event in events]
+
+
+def measure(get_changes, user_ids, events):
+    notifier = make_notifier(user_ids)
+    tracemalloc.start()
+    notifier.notify_of_changes(get_changes(events))
+    # Rendered as when sending, so rendered text counts too
+    for user_notifications in notifier.notifications.values():
+        for notification in user_notifications:
+            notification.change.render()
+
+    # Memory held by the queued notifications, on top of the claimed events
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = sum(len(user_notifications) for user_notifications in notifier.notifications.values())
+    return count, current, peak
+
+
+def main(notifications, subscribers):
+    logging.getLogger('vss.services.notifier').setLevel(logging.WARNING)
+    user_ids = [ObjectId() for i in range(NUM_USERS)]
+    print('{:,} notifications of changes to variants with {} subscribers each'.format(notifications, subscribers))
+
+    tracemalloc.start()
+    events = make_events(user_ids, notifications, subscribers)
+    events_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('Claimed outbox events: {:.1f} MiB'.format(events_memory / 2 ** 20))
+
+    print('{:<16} {:>14} {:>14} {:>14}'.format('', 'notifications', 'held MiB', 'peak MiB'))
+    for name, get_changes in [('per event', per_event), ('per change', group_events)]:
+        count, current, peak = measure(get_changes, user_ids, events)
+        print('{:<16} {:>14,} {:>14.1f} {:>14.1f}'.format(name, count, current / 2 ** 20, peak / 2 ** 20))
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark memory held by queued update notifications')
+    parser.add_argument('--notifications', type=int, default=100000,
+                        help='Number of notifications to queue (default: %(default)s)')
+    parser.add_argument('--subscribers', type=int, default=10,
+                        help='Number of subscribers of each changed variant (default: %(default)s)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.notifications, args.subscribers)
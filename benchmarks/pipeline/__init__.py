@@ -0,0 +1 @@
+"""End-to-end benchmark of the ClinVar import and notification pipeline (see __main__)"""
@@ -0,0 +1,201 @@
+"""Benchmark the import and notification pipeline end to end against a local mongod
+
+    python -m benchmarks.pipeline --variants 100000 --reclassification-rate 0.02 --users 1000 --workers 4
+
+Generates two synthetic ClinVar releases, imports the first, subscribes generated users to
+its variants, then measures importing the second (vss.scripts.import) and sending the queued
+notifications (vss.scripts.dispatch) to local stand-ins for SendGrid and Slack. Each phase
+runs as its own process, as in production, with the config pointed at the stand-ins and a
+scratch database, which is dropped first.
+
+Reports rows/sec, notifications/sec, peak RSS and Mongo operation counts (from the server's
+opcounters, so those of import worker processes count too), and saves them as JSON, so runs
+can be compared across commits.
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+from pymongo import MongoClient
+
+from vss.outbox import OUTBOX_CLAIMED, OUTBOX_PENDING
+
+from ..results import save_results
+from .generate import generate_releases, seed_subscriptions, UNIFORM, ZIPF
+from .servers import StandInServer
+
+DEFAULT_DBNAME = 'vss_benchmark'
+
+CONFIG_TEMPLATE = """
+MONGO_DBNAME = {dbname!r}
+MONGO_PORT = {port!r}
+MONGO_ENSURE_INDEXES = True
+SENDGRID_API_URL = {sendgrid_url!r}
+SENDGRID_API_KEY = 'benchmark'
+BASE_URL = 'http://127.0.0.1:5000'
+NOTIFICATION_WORKERS = {notification_workers!r}
+EMAIL_RATE_LIMIT = {rate_limit!r}
+SLACK_RATE_LIMIT = {rate_limit!r}
+NOTIFICATION_RETRY_BACKOFF = 0.1
+"""
+
+
+def get_opcounters(db):
+    return db.client.admin.command('serverStatus')['opcounters']
+
+
+def run_phase(name, module_args, env, db, workdir):
+    """Run python -m module_args in a new process, returning its elapsed time, peak RSS and Mongo operations"""
+    ops_before = get_opcounters(db)
+    started = time.perf_counter()
+    with open(os.path.join(workdir, '{}.log'.format(name)), 'w') as log:
+        process = subprocess.Popen([sys.executable, '-m'] + module_args, env=env, stdout=log, stderr=log)
+        # The rusage of the process, including the worker processes it waited for
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    seconds = time.perf_counter() - started
+    ops_after = get_opcounters(db)
+
+    if process.returncode != 0:
+        raise RuntimeError('{} failed ({}): see {}'.format(name, process.returncode, log.name))
+
+    return {
+        'seconds': round(seconds, 3),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': round(rusage.ru_maxrss / 1024, 1),
+        'mongo_ops': dict((op, ops_after[op] - ops_before[op]) for op in ops_after),
+    }
+
+
+def count_outbox_statuses(db):
+    return dict((status['_id'], status['count']) for status in db.outbox.aggregate([
+        { '$group': { '_id': '$status', 'count': { '$sum': 1 } } },
+    ]))
+
+
+def main(args):
+    if 'benchmark' not in args.db:
+        raise ValueError('Refusing to drop database {!r}: its name must contain "benchmark"'.format(args.db))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='vss-benchmark-')
+    db = MongoClient('mongodb://localhost:{}'.format(args.port))[args.db]
+    db.client.drop_database(args.db)
+
+    stand_in = StandInServer(latency=args.latency, rate_limited_fraction=args.rate_limited_fraction).start()
+    config_filename = os.path.join(workdir, 'benchmark.cfg')
+    with open(config_filename, 'w') as ofp:
+        ofp.write(CONFIG_TEMPLATE.format(dbname=args.db, port=str(args.port), sendgrid_url=stand_in.url,
+                                         notification_workers=args.notification_workers, rate_limit=args.rate_limit))
+    env = dict(os.environ, VSS_SETTINGS=config_filename)
+
+    base_filename = os.path.join(workdir, 'clinvar_alleles.base.tsv.gz')
+    next_filename = os.path.join(workdir, 'clinvar_alleles.next.tsv.gz')
+    variant_ids = generate_releases(base_filename, next_filename, args.variants, args.reclassification_rate,
+                                    args.new_variant_rate, args.seed)
+    next_rows = args.variants + int(args.variants * args.new_variant_rate)
+
+    import_args = ['--workers', str(args.workers), '--batch-size', str(args.batch_size)]
+    if args.fast_path:
+        import_args.append('--fast-path')
+
+    phases = {}
+    phases['initial_import'] = run_phase('initial_import', ['vss.scripts.import', base_filename] + import_args, env, db, workdir)
+    phases['initial_import']['rows'] = args.variants
+
+    num_users, num_subscriptions = seed_subscriptions(db, variant_ids, args.users, args.subscribed_fraction,
+                                                      args.subscriptions_per_user, args.distribution,
+                                                      args.slack_fraction, stand_in.slack_url, args.seed)
+
+    phases['import'] = run_phase('import', ['vss.scripts.import', next_filename] + import_args, env, db, workdir)
+    phases['import']['rows'] = next_rows
+    phases['import']['outbox_events'] = db.outbox.count()
+
+    stand_in.reset()
+    phases['dispatch'] = run_phase('dispatch', ['vss.scripts.dispatch'], env, db, workdir)
+    phases['dispatch']['stand_in'] = dict(stand_in.counts)
+    phases['dispatch']['notifications'] = stand_in.counts['email_recipients'] + stand_in.counts['slack_posts']
+    stand_in.stop()
+
+    # A run that left events behind (e.g. failing on some) didn't measure the whole outbox
+    phases['dispatch']['outbox'] = count_outbox_statuses(db)
+    undispatched = sum(phases['dispatch']['outbox'].get(status, 0) for status in [OUTBOX_PENDING, OUTBOX_CLAIMED])
+    if undispatched:
+        raise RuntimeError('dispatch left {} outbox events undispatched: see {}'.format(
+            undispatched, os.path.join(workdir, 'dispatch.log')))
+
+    for phase in phases.values():
+        if 'rows' in phase:
+            phase['rows_per_second'] = round(phase['rows'] / phase['seconds'], 1)
+    phases['dispatch']['notifications_per_second'] = round(phases['dispatch']['notifications'] / phases['dispatch']['seconds'], 1)
+
+    output = save_results('pipeline', vars(args), {
+        'dataset': {
+            'variants': args.variants,
+            'users': num_users,
+            'subscriptions': num_subscriptions,
+        },
+        'phases': phases,
+    }, args.output)
+
+    print('{:<16} {:>10} {:>12} {:>14} {:>10} {:>10} {:>10}'.format(
+        '', 'seconds', 'rows/sec', 'notifs/sec', 'RSS MiB', 'queries', 'updates'))
+    for name, phase in phases.items():
+        print('{:<16} {:>10.1f} {:>12} {:>14} {:>10.1f} {:>10,} {:>10,}'.format(
+            name, phase['seconds'], phase.get('rows_per_second', ''), phase.get('notifications_per_second', ''),
+            phase['peak_rss_mib'], phase['mongo_ops']['query'], phase['mongo_ops']['update']))
+    print('Saved results to {} (logs in {})'.format(output, workdir))
+    return phases
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the ClinVar import and notification pipeline')
+    parser.add_argument('--variants', type=int, default=100000,
+                        help='Number of variants in the base release (default: %(default)s)')
+    parser.add_argument('--reclassification-rate', type=float, default=0.02,
+                        help='Fraction of variants whose category changes in the next release (default: %(default)s)')
+    parser.add_argument('--new-variant-rate', type=float, default=0.01,
+                        help='Variants added by the next release, as a fraction of --variants (default: %(default)s)')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='Number of users (default: %(default)s)')
+    parser.add_argument('--subscriptions-per-user', type=int, default=50,
+                        help='Average number of subscriptions of each user (default: %(default)s)')
+    parser.add_argument('--subscribed-fraction', type=float, default=0.05,
+                        help='Fraction of variants with any subscriber (default: %(default)s)')
+    parser.add_argument('--distribution', choices=[UNIFORM, ZIPF], default=ZIPF,
+                        help='Distribution of subscribers over the subscribed variants (default: %(default)s)')
+    parser.add_argument('--slack-fraction', type=float, default=0.2,
+                        help='Fraction of users with Slack connected (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of import worker processes (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Number of rows the import looks up at once (default: %(default)s)')
+    parser.add_argument('--fast-path', action='store_true',
+                        help='Import with the subscribed-variants fast path')
+    parser.add_argument('--notification-workers', type=int, default=8,
+                        help='Number of notification sender threads (default: %(default)s)')
+    parser.add_argument('--rate-limit', type=float, default=1000,
+                        help='Notifications per second per channel (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds the stand-in servers take to answer (default: %(default)s)')
+    parser.add_argument('--rate-limited-fraction', type=float, default=0.0,
+                        help='Fraction of stand-in requests answered with 429 (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=27017,
+                        help='Port of the local mongod (default: %(default)s)')
+    parser.add_argument('--db', type=str, default=DEFAULT_DBNAME,
+                        help='Scratch database, dropped before the run (default: %(default)s)')
+    parser.add_argument('--workdir', type=str,
+                        help='Directory for the releases, config and logs (default: a new temporary directory)')
+    parser.add_argument('--output', type=str,
+                        help='JSON file to save the results to (default: pipeline-COMMIT.json)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
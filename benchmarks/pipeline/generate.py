@@ -0,0 +1,178 @@
+"""Generate synthetic clinvar_alleles TSV.gz releases, and users subscribed to their variants
+
+    python -m benchmarks.pipeline.generate --variants 100000 --reclassification-rate 0.02 --output-dir /tmp/releases
+"""
+import gzip
+import random
+
+from bson import ObjectId
+from datetime import datetime
+
+from vss.backend import make_subscription, make_variant_key
+from vss.clinvar import CLINVAR_ALLELE_COLUMNS
+from vss.constants import DEFAULT_GENOME_BUILD, DEFAULT_NOTIFICATION_PREFERENCES
+
+CHROMOSOMES = [str(x) for x in range(1, 23)] + ['X', 'Y', 'MT']
+BASES = 'ACGT'
+
+# Clinical significance strings of each category, as written by the ClinVar pipeline
+SIGNIFICANCES = [
+    ['Pathogenic', 'Likely pathogenic', 'Pathogenic/Likely pathogenic'],
+    ['Uncertain significance', 'Conflicting interpretations of pathogenicity'],
+    ['Benign', 'Likely benign', 'Benign/Likely benign'],
+    ['not provided'],
+]
+REVIEW_STATUSES = [
+    ('0', 'no assertion criteria provided'),
+    ('1', 'criteria provided, single submitter'),
+    ('2', 'criteria provided, multiple submitters, no conflicts'),
+    ('3', 'reviewed by expert panel'),
+    ('4', 'practice guideline'),
+]
+
+# How subscriptions are spread over the subscribed variants
+UNIFORM = 'uniform'
+ZIPF = 'zipf'
+DEFAULT_ZIPF_EXPONENT = 1.0
+
+
+def make_allele(rng, i):
+    """Return the columns of the i-th variant of a release, as a dict"""
+    ref = rng.choice(BASES)
+    gold_stars, review_status = rng.choice(REVIEW_STATUSES)
+    return {
+        'chrom': CHROMOSOMES[i % len(CHROMOSOMES)],
+        # Unique per variant, so the key is too
+        'pos': str(10000 + i),
+        'ref': ref,
+        'alt': rng.choice([base for base in BASES if base != ref]),
+        'variation_id': str(100000 + i),
+        'clinical_significance': rng.choice(rng.choice(SIGNIFICANCES)),
+        'gold_stars': gold_stars,
+        'review_status': review_status,
+        'last_evaluated': '2017-{:02d}-{:02d}'.format(rng.randint(1, 12), rng.randint(1, 28)),
+    }
+
+
+def reclassify(rng, allele):
+    """Return a copy of the allele, with a clinical significance of a different category"""
+    categories = [significances for significances in SIGNIFICANCES if allele['clinical_significance'] not in significances]
+    allele = dict(allele)
+    allele['clinical_significance'] = rng.choice(rng.choice(categories))
+    allele['last_evaluated'] = '2018-{:02d}-{:02d}'.format(rng.randint(1, 12), rng.randint(1, 28))
+    return allele
+
+
+def iter_releases(num_variants, reclassification_rate, new_variant_rate=0.0, seed=0):
+    """Yield (base allele, next allele) for each variant of two consecutive releases
+
+    reclassification_rate of the variants change category in the next release. The next
+    release also has num_variants * new_variant_rate variants not in the base release,
+    yielded with a base allele of None.
+    """
+    rng = random.Random(seed)
+    for i in range(num_variants):
+        allele = make_allele(rng, i)
+        next_allele = reclassify(rng, allele) if rng.random() < reclassification_rate else allele
+        yield allele, next_allele
+
+    for i in range(num_variants, num_variants + int(num_variants * new_variant_rate)):
+        yield None, make_allele(rng, i)
+
+
+def write_release(filename, alleles):
+    with gzip.open(filename, 'wt', compresslevel=1) as ofp:
+        ofp.write('\t'.join(CLINVAR_ALLELE_COLUMNS) + '\n')
+        for allele in alleles:
+            ofp.write('\t'.join(allele[column] for column in CLINVAR_ALLELE_COLUMNS) + '\n')
+
+
+def generate_releases(base_filename, next_filename, num_variants, reclassification_rate, new_variant_rate=0.0, seed=0):
+    """Write the two releases, returning the keys of the variants in the base release"""
+    pairs = list(iter_releases(num_variants, reclassification_rate, new_variant_rate, seed))
+    write_release(base_filename, (allele for allele, next_allele in pairs if allele))
+    write_release(next_filename, (next_allele for allele, next_allele in pairs))
+    return [make_variant_key(DEFAULT_GENOME_BUILD, allele['chrom'], allele['pos'], allele['ref'], allele['alt'])
+            for allele, next_allele in pairs if allele]
+
+
+def make_user(i, slack_url=None):
+    return {
+        '_id': ObjectId(),
+        'email': 'user{}@example.com'.format(i),
+        'token': 'benchmark-token-{}'.format(i),
+        'joined_at': datetime.utcnow(),
+        'last_emailed': None,
+        'is_active': True,
+        'slack': { 'ok': True, 'incoming_webhook': { 'url': slack_url } } if slack_url else None,
+        'notification_preferences': dict(DEFAULT_NOTIFICATION_PREFERENCES),
+    }
+
+
+def get_subscriber_counts(num_subscribed, subscriptions, distribution=UNIFORM, exponent=DEFAULT_ZIPF_EXPONENT):
+    """Return the number of subscribers of each of num_subscribed variants, adding up to about subscriptions
+
+    With the zipf distribution, the variant of rank k has subscribers in proportion to 1 / k ** exponent,
+    like a few well-known variants on many panels and a long tail on one or two.
+    """
+    if distribution == ZIPF:
+        weights = [1 / (rank ** exponent) for rank in range(1, num_subscribed + 1)]
+    else:
+        weights = [1] * num_subscribed
+    scale = subscriptions / sum(weights)
+    return [max(1, int(round(weight * scale))) for weight in weights]
+
+
+def seed_subscriptions(db, variant_ids, num_users, subscribed_fraction, subscriptions_per_user,
+                       distribution=UNIFORM, slack_fraction=0.0, slack_url=None, seed=0):
+    """Insert users and their subscriptions to a random subset of variant_ids, returning the numbers of each"""
+    rng = random.Random(seed)
+    users = [make_user(i, slack_url if rng.random() < slack_fraction else None) for i in range(num_users)]
+    db.users.insert_many(users)
+    user_ids = [user['_id'] for user in users]
+
+    subscribed = rng.sample(variant_ids, int(len(variant_ids) * subscribed_fraction))
+    counts = get_subscriber_counts(len(subscribed), num_users * subscriptions_per_user, distribution)
+    subscriptions = []
+    for variant_id, count in zip(subscribed, counts):
+        for user_id in rng.sample(user_ids, min(count, num_users)):
+            subscriptions.append(make_subscription(user_id, variant_id, tag='panel {}'.format(rng.randint(1, 5))))
+            if len(subscriptions) >= 10000:
+                db.subscriptions.bulk_write(subscriptions, ordered=False)
+                subscriptions = []
+    if subscriptions:
+        db.subscriptions.bulk_write(subscriptions, ordered=False)
+
+    return len(users), db.subscriptions.count()
+
+
+def main(num_variants, reclassification_rate, new_variant_rate, seed, output_dir):
+    import os
+
+    base_filename = os.path.join(output_dir, 'clinvar_alleles.base.tsv.gz')
+    next_filename = os.path.join(output_dir, 'clinvar_alleles.next.tsv.gz')
+    generate_releases(base_filename, next_filename, num_variants, reclassification_rate, new_variant_rate, seed)
+    print('Wrote {} and {}'.format(base_filename, next_filename))
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate two consecutive synthetic clinvar_alleles releases')
+    parser.add_argument('--variants', type=int, default=100000,
+                        help='Number of variants in the base release (default: %(default)s)')
+    parser.add_argument('--reclassification-rate', type=float, default=0.02,
+                        help='Fraction of variants whose category changes in the next release (default: %(default)s)')
+    parser.add_argument('--new-variant-rate', type=float, default=0.01,
+                        help='Variants added by the next release, as a fraction of --variants (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator, for reproducible releases (default: %(default)s)')
+    parser.add_argument('--output-dir', type=str, default='.',
+                        help='Directory to write the releases to (default: %(default)s)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.variants, args.reclassification_rate, args.new_variant_rate, args.seed, args.output_dir)
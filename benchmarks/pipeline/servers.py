@@ -0,0 +1,97 @@
+"""Local stand-ins for the SendGrid and Slack APIs, counting the notifications they receive"""
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer:
+    """Accepts SendGrid mail sends (POST /v3/mail/send) and Slack webhook posts (POST /slack/...)
+
+    Each request takes latency seconds to answer, and rate_limited_fraction of them are
+    answered with 429 and a Retry-After, to exercise the dispatcher's retries.
+    """
+    def __init__(self, latency=0.0, rate_limited_fraction=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.rate_limited_fraction = rate_limited_fraction
+        self.lock = threading.Lock()
+        self.counts = {
+            'email_requests': 0,
+            'email_recipients': 0,
+            'slack_posts': 0,
+            'rate_limited': 0,
+        }
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def slack_url(self):
+        return '{}/slack/webhook'.format(self.url)
+
+    def _count(self, **counts):
+        with self.lock:
+            for key, count in counts.items():
+                self.counts[key] += count
+
+    def _should_rate_limit(self):
+        if not self.rate_limited_fraction:
+            return False
+        with self.lock:
+            # Every 1/fraction-th request, so runs are reproducible
+            requests = self.counts['email_requests'] + self.counts['slack_posts'] + self.counts['rate_limited']
+            return int((requests + 1) * self.rate_limited_fraction) > int(requests * self.rate_limited_fraction)
+
+    def _make_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if stand_in.latency:
+                    threading.Event().wait(stand_in.latency)
+
+                if stand_in._should_rate_limit():
+                    stand_in._count(rate_limited=1)
+                    self.send_response(429)
+                    self.send_header('Retry-After', '0.1')
+                    self.end_headers()
+                    return
+
+                if self.path == '/v3/mail/send':
+                    mail = json.loads(body.decode('utf-8'))
+                    stand_in._count(email_requests=1, email_recipients=len(mail.get('personalizations', [])))
+                    self.send_response(202)
+                elif self.path.startswith('/slack/'):
+                    stand_in._count(slack_posts=1)
+                    self.send_response(200)
+                else:
+                    self.send_response(404)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            for key in self.counts:
+                self.counts[key] = 0
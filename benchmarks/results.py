@@ -0,0 +1,26 @@
+"""Saving benchmark results as JSON, tagged with the commit they were measured at"""
+import json
+import subprocess
+
+from datetime import datetime
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(benchmark, params, results, output=None):
+    """Save results to output (default: BENCHMARK-COMMIT.json), returning the filename"""
+    commit = get_commit()
+    output = output or '{}-{}.json'.format(benchmark, commit or 'results')
+    with open(output, 'w') as ofp:
+        json.dump(dict({
+            'benchmark': benchmark,
+            'commit': commit,
+            'finished_at': datetime.utcnow().isoformat(),
+            'params': params,
+        }, **results), ofp, indent=2)
+    return output
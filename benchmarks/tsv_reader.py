@@ -0,0 +1,87 @@
+"""Compare rows/sec of the DictReader and column-projected clinvar_alleles readers
+
+    python -m benchmarks.tsv_reader /path/to/clinvar_alleles.single.b37.tsv.gz
+"""
+import gzip
+import time
+
+from csv import DictReader
+
+from vss.backend import build_variant_doc
+from vss.clinvar import iter_clinvar_alleles, parse_clinvar_category
+from vss.constants import DEFAULT_GENOME_BUILD
+
+
+def dict_reader_rows(filename):
+    # The importer's original reader
+    with gzip.open(filename, 'rt') as ifp:
+        for row in DictReader(ifp, dialect='excel-tab'):
+            yield row
+
+
+def read_dict_reader(filename):
+    count = 0
+    for row in dict_reader_rows(filename):
+        count += 1
+    return count
+
+
+def read_projected(filename):
+    count = 0
+    for row in iter_clinvar_alleles(filename):
+        count += 1
+    return count
+
+
+def build_dict_reader(filename):
+    count = 0
+    for row in dict_reader_rows(filename):
+        build_variant_doc(DEFAULT_GENOME_BUILD, **row)
+        count += 1
+    return count
+
+
+def build_projected(filename):
+    count = 0
+    for row in iter_clinvar_alleles(filename):
+        build_variant_doc(DEFAULT_GENOME_BUILD, *row)
+        count += 1
+    return count
+
+
+BENCHMARKS = [
+    ('read: DictReader', read_dict_reader),
+    ('read: projected', read_projected),
+    ('read + build_variant_doc: DictReader', build_dict_reader),
+    ('read + build_variant_doc: projected', build_projected),
+]
+
+
+def main(filename, repeat=3):
+    for name, func in BENCHMARKS:
+        best = None
+        for i in range(repeat):
+            parse_clinvar_category.cache_clear()
+            start = time.perf_counter()
+            rows = func(filename)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print('{:<40} {:>10} rows {:>8.2f}s {:>12,.0f} rows/sec'.format(name, rows, best, rows / best))
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark clinvar_alleles TSV readers')
+    parser.add_argument('clinvar_filename', metavar='CLINVAR_ALLELES_TSV_GZ', type=str,
+                        help='clinvar_alleles.single.b*.tsv.gz from github.com/macarthur-lab/clinvar pipeline')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times to run each benchmark, keeping the best (default: %(default)s)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.clinvar_filename, repeat=args.repeat)
@@ -0,0 +1,266 @@
+"""Measure latency and Mongo commands of the web endpoints under concurrent load
+
+    python -m benchmarks.web --variants 100000 --users 1000 --subscriptions-per-user 500 --clients 8
+
+Seeds a scratch database on a local mongod (dropped first) with variants, users and their
+subscriptions, then drives the app through its WSGI interface from concurrent clients (the
+Flask test client, so no HTTP server is involved). Jobs are only queued, and mail goes to
+a local stand-in for SendGrid, so third-party calls don't count towards the latency.
+
+The app reads its config when vss is first imported, so vss (and modules importing it)
+are only imported once the config is written.
+
+Reports p50/p95/p99 latency and the Mongo commands of each request (counted with a pymongo
+command listener) per endpoint, and saves them as JSON, so runs can be compared across commits.
+"""
+import os
+import math
+import time
+import queue
+import random
+import tempfile
+import threading
+
+from datetime import datetime
+from pymongo import MongoClient, monitoring
+
+from .pipeline.servers import StandInServer
+from .results import save_results
+
+DEFAULT_DBNAME = 'vss_benchmark'
+ENDPOINTS = ['index', 'account', 'subscribe', 'login']
+
+CONFIG_TEMPLATE = """
+MONGO_DBNAME = {dbname!r}
+MONGO_PORT = {port!r}
+MONGO_ENSURE_INDEXES = True
+SENDGRID_API_URL = {sendgrid_url!r}
+SENDGRID_API_KEY = 'benchmark'
+BASE_URL = 'http://127.0.0.1:5000'
+JOB_QUEUE = 'mongo'
+# Clients post forms without fetching them first
+WTF_CSRF_ENABLED = False
+"""
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts the Mongo commands started by the current thread between start() and stop()"""
+    def __init__(self):
+        self.local = threading.local()
+
+    def start(self):
+        self.local.counts = {}
+
+    def stop(self):
+        counts, self.local.counts = self.local.counts, None
+        return counts
+
+    def started(self, event):
+        counts = getattr(self.local, 'counts', None)
+        if counts is not None:
+            counts[event.command_name] = counts.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def seed(db, num_variants, num_users, subscriptions_per_user, rng):
+    """Insert variants, and users with subscriptions_per_user subscriptions each, returning the users"""
+    from vss.backend import build_variant_doc, make_subscription, refresh_stats
+    from vss.clinvar import CLINVAR_ALLELE_COLUMNS
+    from vss.constants import DEFAULT_GENOME_BUILD
+    from vss.utils import iter_chunks
+    from .pipeline.generate import make_allele, make_user
+
+    alleles = (make_allele(rng, i) for i in range(num_variants))
+    docs = (build_variant_doc(DEFAULT_GENOME_BUILD, *[allele[column] for column in CLINVAR_ALLELE_COLUMNS]) for allele in alleles)
+    variant_ids = []
+    for chunk in iter_chunks(docs, 10000):
+        db.variants.insert_many(chunk)
+        variant_ids.extend(doc['_id'] for doc in chunk)
+
+    users = [make_user(i) for i in range(num_users)]
+    db.users.insert_many(users)
+    subscriptions = (make_subscription(user['_id'], variant_id, tag='panel {}'.format(rng.randint(1, 5)))
+                     for user in users for variant_id in rng.sample(variant_ids, min(subscriptions_per_user, num_variants)))
+    for chunk in iter_chunks(subscriptions, 10000):
+        db.subscriptions.bulk_write(chunk, ordered=False)
+
+    # As after an import, which the home page shows
+    db.updates.insert_one({ 'started_at': datetime.utcnow(), 'finished_at': datetime.utcnow() })
+    refresh_stats(db)
+    return users
+
+
+def get_subscribable_variants(num_variants, rng):
+    from .pipeline.generate import make_allele
+
+    # Variant strings the subscribe form accepts (which excludes MT)
+    alleles = (make_allele(rng, i) for i in range(num_variants))
+    return ['-'.join([allele['chrom'], allele['pos'], allele['ref'], allele['alt']])
+            for allele in alleles if allele['chrom'] != 'MT']
+
+
+def make_request(endpoint, client, users, variant_strings, rng):
+    user = rng.choice(users)
+    if endpoint == 'index':
+        return client.get('/')
+    elif endpoint == 'account':
+        return client.get('/account/?t={}'.format(user['token']))
+    elif endpoint == 'subscribe':
+        return client.post('/subscribe/', data={ 'email': user['email'], 'variant': rng.choice(variant_strings), 'tag': 'load test' })
+    elif endpoint == 'login':
+        return client.post('/login', data={ 'email': user['email'] })
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    return sorted_values[max(0, min(len(sorted_values) - 1, int(math.ceil(p / 100 * len(sorted_values))) - 1))]
+
+
+def run_clients(app, counter, work, num_clients, users, variant_strings, seed_value):
+    """Run the requests of the work queue from num_clients threads, returning the samples of each endpoint"""
+    samples = dict((endpoint, []) for endpoint in ENDPOINTS)
+    lock = threading.Lock()
+
+    def client_loop(i):
+        rng = random.Random(seed_value + i)
+        # No cookies, so each request authenticates (or not) on its own
+        client = app.test_client(use_cookies=False)
+        while True:
+            try:
+                endpoint = work.get_nowait()
+            except queue.Empty:
+                return
+
+            counter.start()
+            started = time.perf_counter()
+            response = make_request(endpoint, client, users, variant_strings, rng)
+            seconds = time.perf_counter() - started
+            commands = counter.stop()
+            with lock:
+                samples[endpoint].append((seconds, response.status_code, commands))
+
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(num_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def summarize(endpoint_samples):
+    latencies = sorted(seconds * 1000 for seconds, status, commands in endpoint_samples)
+    commands = {}
+    for seconds, status, request_commands in endpoint_samples:
+        for name, count in request_commands.items():
+            commands[name] = commands.get(name, 0) + count
+    n = len(endpoint_samples)
+    return {
+        'requests': n,
+        'errors': sum(1 for seconds, status, request_commands in endpoint_samples if status >= 400),
+        'mean_ms': round(sum(latencies) / n, 2),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'mongo_commands_per_request': round(sum(commands.values()) / n, 2),
+        'mongo_commands': dict((name, round(count / n, 2)) for name, count in sorted(commands.items())),
+    }
+
+
+def main(args):
+    if 'benchmark' not in args.db:
+        raise ValueError('Refusing to drop database {!r}: its name must contain "benchmark"'.format(args.db))
+
+    MongoClient('mongodb://localhost:{}'.format(args.port)).drop_database(args.db)
+    stand_in = StandInServer().start()
+    workdir = tempfile.mkdtemp(prefix='vss-benchmark-')
+    config_filename = os.path.join(workdir, 'benchmark.cfg')
+    with open(config_filename, 'w') as ofp:
+        ofp.write(CONFIG_TEMPLATE.format(dbname=args.db, port=str(args.port), sendgrid_url=stand_in.url))
+    os.environ['VSS_SETTINGS'] = config_filename
+
+    # Registered before the app creates its client, so it sees all of the app's commands
+    counter = CommandCounter()
+    monitoring.register(counter)
+    from vss import app, prepare_database
+    from vss.extensions import mongo
+    # As the web app does on start
+    prepare_database(app)
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db = mongo.db
+        users = seed(db, args.variants, args.users, args.subscriptions_per_user, rng)
+    variant_strings = get_subscribable_variants(args.variants, random.Random(args.seed))
+    print('Seeded {:,} variants and {:,} users with {:,} subscriptions each'.format(
+        args.variants, args.users, args.subscriptions_per_user))
+
+    endpoints = args.endpoints or ENDPOINTS
+    # Fill caches and connection pools before measuring
+    warmup = queue.Queue()
+    for endpoint in endpoints * args.warmup:
+        warmup.put(endpoint)
+    run_clients(app, counter, warmup, 1, users, variant_strings, args.seed)
+
+    work_items = endpoints * args.requests
+    rng.shuffle(work_items)
+    work = queue.Queue()
+    for endpoint in work_items:
+        work.put(endpoint)
+    started = time.perf_counter()
+    samples = run_clients(app, counter, work, args.clients, users, variant_strings, args.seed)
+    seconds = time.perf_counter() - started
+    stand_in.stop()
+
+    summaries = dict((endpoint, summarize(samples[endpoint])) for endpoint in endpoints)
+    output = save_results('web', vars(args), {
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(work_items) / seconds, 1),
+        'endpoints': summaries,
+    }, args.output)
+
+    print('{:<12} {:>9} {:>7} {:>9} {:>9} {:>9} {:>14}'.format('', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'mongo/request'))
+    for endpoint, summary in summaries.items():
+        print('{:<12} {:>9,} {:>7,} {:>9.1f} {:>9.1f} {:>9.1f} {:>14.1f}'.format(
+            endpoint, summary['requests'], summary['errors'], summary['p50_ms'], summary['p95_ms'], summary['p99_ms'],
+            summary['mongo_commands_per_request']))
+    print('{:.1f} requests/sec. Saved results to {}'.format(len(work_items) / seconds, output))
+    return summaries
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the latency of the web endpoints under concurrent load')
+    parser.add_argument('--variants', type=int, default=100000,
+                        help='Number of variants in the database (default: %(default)s)')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='Number of users (default: %(default)s)')
+    parser.add_argument('--subscriptions-per-user', type=int, default=100,
+                        help='Number of subscriptions of each user (default: %(default)s)')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='Number of concurrent clients (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Number of measured requests per endpoint (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='Number of unmeasured requests per endpoint first (default: %(default)s)')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS,
+                        help='Endpoints to request (default: all)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=27017,
+                        help='Port of the local mongod (default: %(default)s)')
+    parser.add_argument('--db', type=str, default=DEFAULT_DBNAME,
+                        help='Scratch database, dropped before the run (default: %(default)s)')
+    parser.add_argument('--output', type=str,
+                        help='JSON file to save the results to (default: web-COMMIT.json)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
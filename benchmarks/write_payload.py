@@ -0,0 +1,82 @@
+"""Compare write payload size and task throughput of full-document and field-level variant updates
+
+    python -m benchmarks.write_payload --history 20 --subscribers 500
+"""
+import time
+
+from copy import deepcopy
+
+from bson import BSON
+from pymongo import ReplaceOne
+
+from vss.backend import build_variant_doc, make_variant_update, update_variant_task
+from vss.constants import DEFAULT_GENOME_BUILD
+
+
+def make_docs(history, subscribers):
+    old_doc = build_variant_doc(DEFAULT_GENOME_BUILD, '1', '55518071', 'G', 'A',
+                                variation_id='230224', clinical_significance='Benign', gold_stars='1',
+                                review_status='criteria provided, single submitter', last_evaluated='2017-01-01')
+    old_doc['clinvar']['history'] = [dict(old_doc['clinvar']['current']) for i in range(history)]
+    old_doc['subscribers'] = ['{:024x}'.format(i) for i in range(subscribers)]
+    old_doc['tags'] = dict((user_id, 'patient panel {}'.format(i)) for i, user_id in enumerate(old_doc['subscribers']))
+
+    new_doc = build_variant_doc(DEFAULT_GENOME_BUILD, '1', '55518071', 'G', 'A',
+                                variation_id='230224', clinical_significance='Pathogenic', gold_stars='2',
+                                review_status='criteria provided, multiple submitters', last_evaluated='2018-01-01')
+    return old_doc, new_doc
+
+
+def replace_task(existing_doc, updated_doc):
+    # The importer's original full-document update
+    merged_doc = deepcopy(existing_doc)
+    merged_doc['clinvar']['history'].append(existing_doc['clinvar']['current'])
+    merged_doc['clinvar']['current'] = updated_doc['clinvar']['current']
+    merged_doc['clinvar']['variation_id'] = updated_doc['clinvar']['variation_id']
+    merged_doc['variant'] = updated_doc['variant']
+    return ReplaceOne({ '_id': existing_doc['_id'] }, merged_doc), merged_doc
+
+
+def replace_payload(old_doc, new_doc):
+    task, merged_doc = replace_task(old_doc, new_doc)
+    return len(BSON.encode(merged_doc))
+
+
+def update_payload(old_doc, new_doc):
+    return len(BSON.encode(make_variant_update(old_doc, new_doc)))
+
+
+def time_tasks(func, old_doc, new_doc, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func(old_doc, new_doc)
+    return count / (time.perf_counter() - start)
+
+
+def main(history, subscribers, count):
+    old_doc, new_doc = make_docs(history, subscribers)
+    print('Variant with {} history entries and {} subscribers'.format(history, subscribers))
+    print('{:<12} {:>14} {:>14}'.format('', 'payload bytes', 'tasks/sec'))
+    print('{:<12} {:>14,} {:>14,.0f}'.format('ReplaceOne', replace_payload(old_doc, new_doc),
+                                              time_tasks(replace_task, old_doc, new_doc, count)))
+    print('{:<12} {:>14,} {:>14,.0f}'.format('UpdateOne', update_payload(old_doc, new_doc),
+                                              time_tasks(lambda old, new: update_variant_task(None, old, new), old_doc, new_doc, count)))
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark variant update payloads')
+    parser.add_argument('--history', type=int, default=10,
+                        help='Number of entries in the variant\'s ClinVar history (default: %(default)s)')
+    parser.add_argument('--subscribers', type=int, default=100,
+                        help='Number of subscribers (each with a tag) of the variant (default: %(default)s)')
+    parser.add_argument('--count', type=int, default=10000,
+                        help='Number of tasks to build when measuring throughput (default: %(default)s)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.history, args.subscribers, args.count)
@@ -3,10 +3,27 @@ APP_NAME_SHORT = 'VF'
 
 MONGO_DBNAME = 'vss'
 MONGO_PORT = '27017'
+# Create any missing database indexes when the app starts
+MONGO_ENSURE_INDEXES = True
+# Load an in-memory index of ClinVar Variation ids to variants when the app starts, reloaded
+# after each import, so subscribing by ClinVar id doesn't query the database
+CLINVAR_ID_INDEX = False
 
 MAILER_FROM_EMAIL = 'support@variantfacts.com'
 MAILER_FROM_NAME = 'Variant Facts'
 
+# Where emails and Slack calls of web requests are run: 'inline' (in a thread of the web
+# process, for development) or 'mongo' (by the vss.scripts.worker process)
+JOB_QUEUE = 'inline'
+
+# Update notifications are sent concurrently, rate limited per channel (messages per second).
+# Limits are per dispatch worker process.
+NOTIFICATION_WORKERS = 8
+EMAIL_RATE_LIMIT = 10
+SLACK_RATE_LIMIT = 10
+NOTIFICATION_MAX_RETRIES = 3
+NOTIFICATION_RETRY_BACKOFF = 1.0
+
 # Override in production
 SECRET_KEY = 'verysecret'
 SLACK_CLIENT_ID = 'placeholder'
@@ -0,0 +1,10 @@
+from vss import app
+from vss.api import NDJSON_MIMETYPE, iter_request_records
+
+
+def test_records_with_a_non_string_tag_are_errors():
+    body = '{"variant": "1-55518071-G-A", "tag": ["x"]}\n{"variant": "230224"}\n{"variant": "230224", "tag": "panel"}\n'
+    with app.test_request_context(data=body, content_type=NDJSON_MIMETYPE):
+        records = list(iter_request_records('variant', optional_fields=('tag',)))
+
+    assert [(n, error) for n, record, error in records] == [(1, "Expected a string for 'tag'"), (2, None), (3, None)]
@@ -0,0 +1,52 @@
+from importlib import import_module
+from types import SimpleNamespace
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from vss.backend import USER_CACHE_TTL, authenticate, create_user, find_or_create_variants, user_cache
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = mongomock.MongoClient().db
+    # vss.backend is shadowed by its blueprint as an attribute of vss
+    monkeypatch.setattr(import_module('vss.backend'), 'mongo', SimpleNamespace(db=db))
+    user_cache.clear()
+    yield db
+    user_cache.clear()
+
+
+def test_authenticate_sees_changes_made_by_other_processes_once_cached_users_expire(db, monkeypatch):
+    now = [0]
+    monkeypatch.setattr(user_cache, 'timer', lambda: now[0])
+    user_id, token = create_user(db, 'user@example.com')
+    assert authenticate(token)['slack'] is None
+
+    # As written by another process, without invalidating this process's cache
+    db.users.update_one({ '_id': user_id }, { '$set': { 'slack': { 'ok': True } } })
+    assert authenticate(token)['slack'] is None
+    now[0] += USER_CACHE_TTL + 1
+    assert authenticate(token)['slack'] == { 'ok': True }
+
+    db.users.delete_one({ '_id': user_id })
+    now[0] += USER_CACHE_TTL + 1
+    assert authenticate(token) is None
+
+
+def test_variant_strings_are_normalized(db):
+    variant_ids, unresolved = find_or_create_variants(db, 'b37', ['chr1-55518071-g-a', '1-55518071-G-A'])
+    assert (variant_ids, unresolved) == (['b37-1-55518071-G-A'], [])
+    assert db.variants.count_documents({}) == 1
+
+
+def test_mitochondrial_variants_are_named_as_in_clinvar(db):
+    variant_ids, unresolved = find_or_create_variants(db, 'b37', ['chrM-100-A-G', 'M-100-A-G', 'MT-100-A-G'])
+    assert (variant_ids, unresolved) == (['b37-MT-100-A-G'], [])
+
+
+def test_variants_of_unknown_chromosomes_are_unresolved(db):
+    variant_ids, unresolved = find_or_create_variants(db, 'b37', ['banana-1-A-C', 'chr23-1-A-C', 'x-1-a-c'])
+    assert (variant_ids, unresolved) == (['b37-X-1-A-C'], ['banana-1-A-C', 'chr23-1-A-C'])
+    assert db.variants.count_documents({}) == 1
@@ -0,0 +1,160 @@
+from importlib import import_module
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from benchmarks.pipeline.generate import generate_releases, seed_subscriptions
+from vss.constants import RUN_ABANDONED, RUN_FINISHED, RUN_RUNNING
+from vss.outbox import claim_events, get_unfinished_run_ids
+from vss.utils import deep_get
+
+importer = import_module('vss.scripts.import')
+
+NUM_VARIANTS = 60
+BATCH_SIZE = 10
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().db
+
+
+@pytest.fixture
+def release(tmpdir):
+    filename = tmpdir.join('clinvar_alleles.tsv.gz')
+    filename.write_binary(b'release')
+    return str(filename)
+
+
+@pytest.fixture
+def releases(tmpdir):
+    base_filename = str(tmpdir.join('clinvar_alleles.base.tsv.gz'))
+    next_filename = str(tmpdir.join('clinvar_alleles.next.tsv.gz'))
+    variant_ids = generate_releases(base_filename, next_filename, NUM_VARIANTS, 0.5, 0.1, seed=1)
+    return base_filename, next_filename, variant_ids
+
+
+def import_release(monkeypatch, db, filename, **kwargs):
+    monkeypatch.setattr(importer, 'connect_db', lambda: db)
+    importer.main(filename, batch_size=BATCH_SIZE, **kwargs)
+
+
+def import_base_release(monkeypatch, releases):
+    """Return a database with the base release imported, and users subscribed to half its variants"""
+    base_filename, next_filename, variant_ids = releases
+    db = mongomock.MongoClient().db
+    import_release(monkeypatch, db, base_filename)
+    seed_subscriptions(db, variant_ids, 5, 0.5, 10, seed=1)
+    return db
+
+
+def get_import_state(db, filename):
+    """Return what the import of a release left in the database, independent of ids made at random"""
+    run = db.updates.find_one({ 'filename': filename })
+    emails = dict((user['_id'], user['email']) for user in db.users.find())
+    return {
+        'run': dict((key, run.get(key)) for key in ['status', 'committed_batches', 'inserted_count', 'modified_count', 'notified_count']),
+        'variants': sorted((doc['_id'], deep_get(doc, 'clinvar.current.clinical_significance')) for doc in db.variants.find()),
+        'history': sorted((entry['variant_id'], entry['clinvar']['clinical_significance']) for entry in db.clinvar_history.find()),
+        'outbox': sorted((event['variant_id'], emails[event['user_id']], event['tag'],
+                          event['old']['clinvar']['current']['clinical_significance'],
+                          event['new']['clinvar']['current']['clinical_significance']) for event in db.outbox.find()),
+    }
+
+
+def interrupt_after_second_checkpoint(monkeypatch, db):
+    checkpoint_partition = importer.checkpoint_partition
+    checkpoints = []
+
+    def interrupt(*args, **kwargs):
+        checkpoint_partition(*args, **kwargs)
+        checkpoints.append(args)
+        if len(checkpoints) == 2:
+            raise Interrupted()
+
+    monkeypatch.setattr(importer, 'checkpoint_partition', interrupt)
+
+
+def interrupt_first_variant_write_with_notifications(monkeypatch, db):
+    bulk_write = db.variants.bulk_write
+
+    def interrupt(*args, **kwargs):
+        if db.outbox.count_documents({}):
+            raise Interrupted()
+        return bulk_write(*args, **kwargs)
+
+    monkeypatch.setattr(db.variants, 'bulk_write', interrupt)
+
+
+@pytest.mark.parametrize('interrupt', [interrupt_after_second_checkpoint, interrupt_first_variant_write_with_notifications])
+def test_resumed_imports_leave_the_same_variants_history_and_notifications(monkeypatch, releases, interrupt):
+    base_filename, next_filename, variant_ids = releases
+    reference_db = import_base_release(monkeypatch, releases)
+    import_release(monkeypatch, reference_db, next_filename)
+    reference = get_import_state(reference_db, next_filename)
+    assert reference['history'] and reference['outbox']
+    assert reference['run']['committed_batches'] == len(range(0, NUM_VARIANTS + NUM_VARIANTS // 10, BATCH_SIZE))
+
+    db = import_base_release(monkeypatch, releases)
+    with monkeypatch.context() as interrupted:
+        interrupt(interrupted, db)
+        with pytest.raises(Interrupted):
+            import_release(interrupted, db, next_filename)
+
+    run = db.updates.find_one({ 'filename': next_filename })
+    assert run['status'] == RUN_RUNNING
+    # Notifications of an interrupted import are held back
+    assert db.outbox.count_documents({}) and claim_events(db, 'worker') == (None, [])
+    if interrupt is interrupt_first_variant_write_with_notifications:
+        # Events are queued before the variant write, so changes not yet written are already queued
+        for event in db.outbox.find():
+            variant = db.variants.find_one({ '_id': event['variant_id'] })
+            assert variant['clinvar']['current'] == event['old']['clinvar']['current']
+
+    import_release(monkeypatch, db, next_filename, resume=True)
+    state = get_import_state(db, next_filename)
+    assert state == reference
+    assert state['run']['status'] == RUN_FINISHED
+
+
+def test_partition_chunks_skip_the_rows_committed_by_each_partition(releases):
+    base_filename, next_filename, variant_ids = releases
+
+    def get_partition_rows(chunks):
+        rows = [[] for partition in range(3)]
+        for partition, chunk in chunks:
+            assert 0 < len(chunk) <= 4
+            rows[partition].extend(chunk)
+        return rows
+
+    rows = get_partition_rows(importer.iter_partition_chunks(next_filename, [0, 0, 0], 4))
+    assert sum(len(partition_rows) for partition_rows in rows) == NUM_VARIANTS + NUM_VARIANTS // 10
+    offsets = [5, 0, 9]
+    resumed_rows = get_partition_rows(importer.iter_partition_chunks(next_filename, offsets, 4))
+    assert resumed_rows == [partition_rows[offset:] for partition_rows, offset in zip(rows, offsets)]
+
+
+def test_imports_are_refused_while_one_is_unfinished(db, release):
+    run = importer.start_run(db, release)
+    with pytest.raises(RuntimeError):
+        importer.start_run(db, release)
+    with pytest.raises(RuntimeError):
+        # Not resumable with a different number of workers
+        importer.start_run(db, release, num_partitions=2, resume=True)
+
+    assert importer.start_run(db, release, resume=True)['_id'] == run['_id']
+    assert get_unfinished_run_ids(db) == [run['_id']]
+
+
+def test_restart_abandons_unfinished_imports_releasing_their_notifications(db, release):
+    run = importer.start_run(db, release)
+    new_run = importer.start_run(db, release, restart=True)
+
+    assert db.updates.find_one({ '_id': run['_id'] })['status'] == RUN_ABANDONED
+    assert new_run['status'] == RUN_RUNNING
+    assert get_unfinished_run_ids(db) == [new_run['_id']]
@@ -0,0 +1,222 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+mongomock = pytest.importorskip('mongomock')
+
+from benchmarks.pipeline.servers import StandInServer
+from vss.backend import build_variant_doc
+from vss.constants import DEFAULT_GENOME_BUILD, DEFAULT_NOTIFICATION_PREFERENCES, RUN_FINISHED, RUN_RUNNING
+from vss.outbox import claim_events, complete_events, make_outbox_event, \
+    OUTBOX_CLAIMED, OUTBOX_FAILED, OUTBOX_SENT, OUTBOX_SKIPPED
+from vss.scripts.dispatch import dispatch_events
+from vss.services import notifier
+from vss.services.dispatcher import NotificationDispatcher
+from vss.services.notifier import RenderedChange, VariantChange
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().db
+    db.updates.insert_one({ '_id': 'run', 'status': RUN_FINISHED })
+    return db
+
+
+@pytest.fixture
+def stand_in():
+    # Local stand-in for SendGrid and Slack
+    stand_in = StandInServer().start()
+    yield stand_in
+    stand_in.stop()
+
+
+@pytest.fixture
+def config(stand_in):
+    return {
+        'SENDGRID_API_URL': stand_in.url,
+        'SENDGRID_API_KEY': 'test',
+        'MAILER_FROM_EMAIL': 'support@example.com',
+        'MAILER_FROM_NAME': 'Test',
+        'NOTIFICATION_RETRY_BACKOFF': 0,
+    }
+
+
+def make_doc(pos, clinical_significance):
+    return build_variant_doc(DEFAULT_GENOME_BUILD, '1', str(pos), 'G', 'A', variation_id=str(pos),
+                             clinical_significance=clinical_significance, gold_stars='1')
+
+
+def queue_event(db, user_id, pos, old_significance='Benign', new_significance='Pathogenic', run_id='run'):
+    old_doc = make_doc(pos, old_significance)
+    new_doc = make_doc(pos, new_significance)
+    db.outbox.bulk_write([make_outbox_event(run_id, old_doc, new_doc, { 'user_id': user_id }, datetime.utcnow())])
+    return db.outbox.find_one({ 'variant_id': new_doc['_id'], 'user_id': user_id })
+
+
+def create_user(db, slack_url=None):
+    user_id = ObjectId()
+    user = {
+        '_id': user_id,
+        'email': '{}@example.com'.format(user_id),
+        'token': str(user_id),
+        'notification_preferences': dict(DEFAULT_NOTIFICATION_PREFERENCES, notify_slack=True),
+    }
+    if slack_url:
+        user['slack'] = { 'incoming_webhook': { 'url': slack_url } }
+    db.users.insert_one(user)
+    return user_id
+
+
+def expire_lease(db, event):
+    db.outbox.update_one({ '_id': event['_id'] }, { '$set': { 'lease_expires_at': datetime.utcnow() - timedelta(seconds=1) } })
+
+
+def test_claim_leases_all_of_a_users_events_to_one_worker(db):
+    user_id = ObjectId()
+    queue_event(db, user_id, 1)
+    queue_event(db, user_id, 2)
+
+    claim_id, events = claim_events(db, 'worker-1')
+    assert len(events) == 2
+    assert all(event['status'] == OUTBOX_CLAIMED and event['attempts'] == 1 for event in events)
+    assert claim_events(db, 'worker-2') == (None, [])
+
+
+def test_events_of_an_unfinished_import_are_not_claimed(db):
+    db.updates.insert_one({ '_id': 'running', 'status': RUN_RUNNING })
+    event = queue_event(db, ObjectId(), 1, run_id='running')
+    assert claim_events(db, 'worker') == (None, [])
+
+    db.updates.update_one({ '_id': 'running' }, { '$set': { 'status': RUN_FINISHED } })
+    claim_id, events = claim_events(db, 'worker')
+    assert [event['_id'] for event in events] == [event['_id']]
+
+
+def test_events_of_a_dead_worker_are_claimed_again_once_the_lease_expires(db):
+    event = queue_event(db, ObjectId(), 1)
+    claim_events(db, 'worker-1')
+    expire_lease(db, event)
+
+    claim_id, events = claim_events(db, 'worker-2')
+    assert [(event['worker_id'], event['attempts']) for event in events] == [('worker-2', 2)]
+
+
+def test_failed_events_are_retried_until_max_attempts(db):
+    event = queue_event(db, ObjectId(), 1)
+    for attempt in range(1, 3):
+        claim_id, events = claim_events(db, 'worker', max_attempts=2)
+        assert len(events) == 1
+        complete_events(db, claim_id, events, { event['_id']: OUTBOX_FAILED }, max_attempts=2, retry_seconds=0)
+        expire_lease(db, event)
+
+    assert db.outbox.find_one()['status'] == OUTBOX_FAILED
+    assert claim_events(db, 'worker', max_attempts=2) == (None, [])
+
+
+def test_events_of_workers_that_died_max_attempts_times_are_failed_at_claim(db):
+    event = queue_event(db, ObjectId(), 1)
+    for attempt in range(2):
+        claim_events(db, 'worker', max_attempts=2)
+        expire_lease(db, event)
+
+    assert claim_events(db, 'worker', max_attempts=2) == (None, [])
+    assert db.outbox.find_one()['status'] == OUTBOX_FAILED
+
+
+def test_dispatch_marks_events_that_cant_be_built_failed_and_sends_the_rest(db, config):
+    user_id = create_user(db)
+    ok = queue_event(db, user_id, 1)
+    # Malformed variant doc
+    poison = queue_event(db, user_id, 2)
+    db.outbox.update_one({ '_id': poison['_id'] }, { '$unset': { 'new.variant': '' } })
+    # No user preference covers changes to an unknown classification
+    unknown = queue_event(db, create_user(db), 3, old_significance='Pathogenic', new_significance='not provided')
+    missing_user = queue_event(db, ObjectId(), 4)
+
+    claim_id, events = claim_events(db, 'worker')
+    dispatcher = NotificationDispatcher(config)
+    try:
+        report, statuses, delivered = dispatch_events(db, config, events, dispatcher=dispatcher)
+    finally:
+        dispatcher.close()
+
+    assert statuses == {
+        ok['_id']: OUTBOX_SENT,
+        poison['_id']: OUTBOX_FAILED,
+        unknown['_id']: OUTBOX_SKIPPED,
+        missing_user['_id']: OUTBOX_SKIPPED,
+    }
+    assert report['email']['sent'] == 1
+
+
+def dispatch(db, config, max_attempts=5):
+    claim_id, events = claim_events(db, 'worker', max_attempts=max_attempts)
+    report, statuses, delivered = dispatch_events(db, config, events)
+    complete_events(db, claim_id, events, statuses, delivered=delivered, max_attempts=max_attempts, retry_seconds=0)
+    for event in events:
+        expire_lease(db, event)
+    return statuses
+
+
+def test_events_sent_by_email_but_refused_by_a_removed_slack_webhook_are_not_sent_again(db, config, stand_in):
+    event = queue_event(db, create_user(db, slack_url='{}/removed'.format(stand_in.url)), 1)
+
+    assert dispatch(db, config) == { event['_id']: OUTBOX_SENT }
+    assert claim_events(db, 'worker') == (None, [])
+    assert db.outbox.find_one()['delivered'] == ['email']
+    assert stand_in.counts['email_requests'] == 1
+
+
+def test_events_are_only_sent_again_on_the_channels_that_failed(db, config, stand_in):
+    # Nothing listens on port 9 (discard), so posts to Slack fail to connect
+    user_id = create_user(db, slack_url='http://127.0.0.1:9/slack/webhook')
+    event = queue_event(db, user_id, 1)
+
+    assert dispatch(db, config) == { event['_id']: OUTBOX_FAILED }
+    assert db.outbox.find_one()['delivered'] == ['email']
+
+    db.users.update_one({ '_id': user_id }, { '$set': { 'slack.incoming_webhook.url': stand_in.slack_url } })
+    assert dispatch(db, config) == { event['_id']: OUTBOX_SENT }
+    assert sorted(db.outbox.find_one()['delivered']) == ['email', 'slack']
+    assert (stand_in.counts['email_requests'], stand_in.counts['slack_posts']) == (1, 1)
+
+
+def test_dispatch_shares_a_record_of_each_change_between_its_subscribers(db, config, monkeypatch):
+    changed_variant_ids = []
+
+    def make_change(old_doc, new_doc):
+        changed_variant_ids.append(new_doc['_id'])
+        return VariantChange(old_doc, new_doc)
+
+    monkeypatch.setattr(notifier, 'VariantChange', make_change)
+    for i in range(3):
+        queue_event(db, create_user(db), 1)
+    queue_event(db, create_user(db), 2)
+
+    claim_id, events = claim_events(db, 'worker')
+    report, statuses, delivered = dispatch_events(db, config, events)
+
+    assert sorted(changed_variant_ids) == ['b37-1-1-G-A', 'b37-1-2-G-A']
+    assert report['email']['sent'] == 4
+
+
+def test_dispatch_renders_each_change_once_across_batches(db, config, monkeypatch):
+    rendered_variant_ids = []
+
+    def render_change(change):
+        rendered_variant_ids.append(change.variant_id)
+        return RenderedChange(change)
+
+    monkeypatch.setattr(notifier, 'RenderedChange', render_change)
+    for i in range(3):
+        queue_event(db, create_user(db), 1)
+
+    changes = OrderedDict()
+    for batch in range(3):
+        claim_id, events = claim_events(db, 'worker', max_users=1)
+        report, statuses, delivered = dispatch_events(db, config, events, changes=changes)
+        assert report['email']['sent'] == 1
+
+    assert rendered_variant_ids == ['b37-1-1-G-A']
@@ -0,0 +1,23 @@
+import pytest
+
+from vss.variant_lists import iter_variant_strings
+
+
+@pytest.mark.parametrize('line, variant_strings', [
+    ('1 55518071 G A', ['1-55518071-G-A']),
+    ('chr1\t55518071\tg\ta', ['1-55518071-G-A']),
+    ('1:55518071:G:A 2_123_C_T', ['1-55518071-G-A', '2-123-C-T']),
+    ('230224', ['230224']),
+    ('230224, X 100 A C', ['230224', 'X-100-A-C']),
+    ('chrM 100 A G', ['MT-100-A-G']),
+    # Integers among other fields aren't ClinVar ids, so the entry is left unresolved
+    ('1 55518071 G', ['1 55518071 G']),
+    ('230224 12345', ['230224 12345']),
+])
+def test_list_entries(line, variant_strings):
+    assert list(iter_variant_strings([line])) == variant_strings
+
+
+def test_vcf_yields_each_alt():
+    assert list(iter_variant_strings(['##fileformat=VCFv4.2', 'chr1\t55518071\trs1\tG\tA,T\t.\t.\t.'])) == \
+        ['1-55518071-G-A', '1-55518071-G-T']
@@ -4,10 +4,14 @@ import logging
 from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_wtf.csrf import CSRFProtect
+from pymongo.errors import PyMongoError
 
+from .api import api
 from .backend import backend
 from .frontend import frontend
 from .extensions import mongo, nav
+from .indexes import ensure_indexes
+from .resolver import warm_clinvar_id_index
 
 logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
 logger = logging.getLogger(__name__)
@@ -37,13 +41,49 @@ def create_app():
 def register_blueprints(app):
     app.register_blueprint(frontend)
     app.register_blueprint(backend)
+    app.register_blueprint(api)
 
 
 def register_extensions(app):
     Bootstrap(app)
-    CSRFProtect(app)
+    csrf = CSRFProtect(app)
+    # The API is authenticated by token rather than session cookie, so isn't open to CSRF
+    csrf.exempt(api)
     mongo.init_app(app)
     nav.init_app(app)
 
 
+def prepare_database(app):
+    """Create missing indexes and load the ClinVar id index, as configured, for the web app
+
+    Not done by create_app, so scripts and tests importing vss don't wait on the database.
+    """
+    create_indexes(app)
+    warm_resolver(app)
+
+
+def create_indexes(app):
+    if not app.config.get('MONGO_ENSURE_INDEXES'):
+        return
+
+    with app.app_context():
+        try:
+            ensure_indexes(mongo.db)
+        except PyMongoError:
+            # Queries still work without indexes, just slower
+            logger.exception('Error creating database indexes')
+
+
+def warm_resolver(app):
+    if not app.config.get('CLINVAR_ID_INDEX'):
+        return
+
+    with app.app_context():
+        try:
+            warm_clinvar_id_index(mongo.db)
+        except PyMongoError:
+            # ClinVar ids are still resolved by querying the database
+            logger.exception('Error loading ClinVar id index')
+
+
 app = create_app()
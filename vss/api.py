@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# JSON API for managing subscriptions programmatically. Requests are authenticated by
+# the user's login token (Authorization: Bearer TOKEN) rather than the session cookie.
+#
+# Request bodies are NDJSON (one JSON object per line), read as a stream, or a JSON array
+# of the same objects. Responses are streamed as NDJSON, so large panels are handled in
+# constant memory.
+
+import json
+import logging
+
+from collections import OrderedDict
+from functools import wraps
+from flask import Blueprint, Response, current_app, g, jsonify, request, stream_with_context
+
+from .backend import VARIANT_BATCH_SIZE, authenticate, find_or_create_variants, get_user_subscribed_variants, \
+    subscribe_to_variants, tag_variants, unsubscribe_from_variants
+from .constants import DEFAULT_GENOME_BUILD
+from .extensions import mongo
+from .jobs import JobQueue, QueuedSubscriptionNotifier
+from .utils import deep_get, iter_chunks
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def token_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user = authenticate(token) if scheme.lower() == 'bearer' and token else None
+        if not user:
+            return jsonify({ 'error': 'Missing or invalid token' }), 401
+
+        g.user = user
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def iter_request_records(*fields, optional_fields=()):
+    """Yield (line number, record, error) for each record of the request body
+
+    Records must be objects with a string for each of fields, and a string or null (if given)
+    for each of optional_fields. Invalid records are yielded with the error instead, so they
+    can be reported without failing the rest of the request.
+    """
+    if request.mimetype == 'application/json':
+        records = request.get_json(silent=True)
+        if not isinstance(records, list):
+            yield 1, None, 'Expected a JSON array of objects'
+            return
+    else:
+        records = request.stream
+
+    for n, record in enumerate(records, 1):
+        if isinstance(record, bytes):
+            line = record.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield n, None, 'Invalid JSON'
+                continue
+
+        if not isinstance(record, dict) or not all(isinstance(record.get(field), str) for field in fields):
+            yield n, None, 'Expected an object with {}'.format(', '.join(repr(field) for field in fields))
+        elif not all(isinstance(record.get(field), (str, type(None))) for field in optional_fields):
+            yield n, None, 'Expected a string for {}'.format(', '.join(repr(field) for field in optional_fields))
+        else:
+            yield n, record, None
+
+
+def ndjson_response(results):
+    lines = (json.dumps(result) + '\n' for result in results)
+    return Response(stream_with_context(lines), mimetype=NDJSON_MIMETYPE)
+
+
+def group_batch(batch, key_field, value_field):
+    """Return (dict: record[key_field] -> list of record[value_field], errors) for a batch of request records"""
+    groups = OrderedDict()
+    errors = []
+    for n, record, error in batch:
+        if error:
+            errors.append({ 'line': n, 'error': error })
+        else:
+            groups.setdefault(record.get(key_field), []).append(record[value_field])
+    return groups, errors
+
+
+def iter_subscribe_results(db, user_id, records, genome_build, notifier):
+    num_subscribed = 0
+    for batch in iter_chunks(records, VARIANT_BATCH_SIZE):
+        variants_by_tag, errors = group_batch(batch, 'tag', 'variant')
+        result = { 'subscribed': 0, 'unresolved': [], 'errors': errors }
+        for tag, variant_strings in variants_by_tag.items():
+            variant_ids, unresolved = find_or_create_variants(db, genome_build, variant_strings)
+            result['subscribed'] += subscribe_to_variants(db, user_id, variant_ids)
+            result['unresolved'].extend(unresolved)
+            if tag and variant_ids:
+                tag_variants(db, user_id, tag, variant_ids)
+
+        num_subscribed += result['subscribed']
+        yield result
+
+    # A single email for the whole request
+    if num_subscribed > 0:
+        notifier.notify_of_subscription(user_id, num_subscribed)
+
+
+def iter_unsubscribe_results(db, user_id, records):
+    for batch in iter_chunks(records, VARIANT_BATCH_SIZE):
+        groups, errors = group_batch(batch, None, 'variant_id')
+        variant_ids = groups.get(None, [])
+        yield {
+            'unsubscribed': unsubscribe_from_variants(db, user_id, variant_ids) if variant_ids else 0,
+            'errors': errors,
+        }
+
+
+def iter_tag_results(db, user_id, records):
+    for batch in iter_chunks(records, VARIANT_BATCH_SIZE):
+        variants_by_tag, errors = group_batch(batch, 'tag', 'variant_id')
+        yield {
+            'tagged': sum(tag_variants(db, user_id, tag, variant_ids) for tag, variant_ids in variants_by_tag.items()),
+            'errors': errors,
+        }
+
+
+def iter_subscribed_variants(user, tag=None, category=None):
+    after = None
+    while True:
+        page = get_user_subscribed_variants(user, after=after, tag=tag, category=category, page_size=VARIANT_BATCH_SIZE)
+        for variant in page['data']:
+            yield {
+                'variant_id': variant['_id'],
+                'variant': variant['variant'],
+                'tag': variant['tag'],
+                'category': deep_get(variant, 'clinvar.current.category'),
+                'gold_stars': deep_get(variant, 'clinvar.current.gold_stars'),
+            }
+
+        after = page['next']
+        if not after:
+            break
+
+
+@api.route('/subscriptions', methods=('GET',))
+@token_required
+def list_subscriptions():
+    """Stream the user's subscribed variants, optionally filtered by tag and category"""
+    return ndjson_response(iter_subscribed_variants(g.user, tag=request.args.get('tag'),
+                                                    category=request.args.get('category')))
+
+
+@api.route('/subscriptions', methods=('POST',))
+@token_required
+def subscribe():
+    """Subscribe to records of { "variant": chrom-pos-ref-alt or ClinVar Variation id, "tag": optional }"""
+    genome_build = request.args.get('build', DEFAULT_GENOME_BUILD)
+    notifier = QueuedSubscriptionNotifier(JobQueue(mongo.db, current_app._get_current_object()))
+    records = iter_request_records('variant', optional_fields=('tag',))
+    return ndjson_response(iter_subscribe_results(mongo.db, g.user['_id'], records, genome_build, notifier))
+
+
+@api.route('/subscriptions/remove', methods=('POST',))
+@token_required
+def unsubscribe():
+    """Unsubscribe from records of { "variant_id": variant id, as listed }"""
+    records = iter_request_records('variant_id')
+    return ndjson_response(iter_unsubscribe_results(mongo.db, g.user['_id'], records))
+
+
+@api.route('/subscriptions/tag', methods=('POST',))
+@token_required
+def tag():
+    """Tag subscriptions from records of { "variant_id": variant id, as listed, "tag": tag }"""
+    records = iter_request_records('variant_id', 'tag')
+    return ndjson_response(iter_tag_results(mongo.db, g.user['_id'], records))
@@ -1,18 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import re
 import logging
 
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import datetime
 from flask import Blueprint, g
 from base64 import urlsafe_b64encode
-from pymongo import ASCENDING, DESCENDING, InsertOne, ReplaceOne
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
 
-from .constants import DEFAULT_GENOME_BUILD, DEFAULT_NOTIFICATION_PREFERENCES, UNKNOWN
+from .constants import CHROMOSOMES, DEFAULT_GENOME_BUILD, DEFAULT_NOTIFICATION_PREFERENCES, UNKNOWN
 from .extensions import mongo
 from .clinvar import parse_clinvar_category
-from .utils import deep_get
+from .outbox import make_outbox_event
+from .resolver import resolve_clinvar_ids
+from .utils import deep_get, iter_chunks, HashedIdSet, TTLCache
 
 logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
 logger = logging.getLogger(__name__)
@@ -26,6 +30,55 @@ assert DEFAULT_RANDOM_BYTES % 3 == 0
 
 # DEFAULT_BCRYPT_ROUNDS = 12
 VARIANT_PART_DELIMITER = '-'
+# chrom-pos-ref-alt variant strings
+VARIANT_STRING_PATTERN = re.compile(r'^[0-9A-Za-z]+-\d+-[ACGTacgt]+-[ACGTacgt]+$')
+# Number of variant strings resolved and subscribed to at once
+VARIANT_BATCH_SIZE = 1000
+# Entries of the append-only clinvar_history collection, in archive order for each variant
+CLINVAR_HISTORY_INDEX = [('variant_id', ASCENDING), ('_id', ASCENDING)]
+
+# Users by login token, so the requests of a page view don't each query the database. Each
+# process has its own cache, and invalidate_user only clears the one of the process making
+# the change: changes made by another process (e.g. a job worker, or another uWSGI process)
+# show up once the entry expires, so entries are kept only briefly.
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 5
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# _id of the document in the stats collection shown on the home page
+STATS_ID = 'global'
+
+
+def invalidate_user(user):
+    """Drop the user from the authentication cache, after changing them"""
+    token = deep_get(user, 'token')
+    if token:
+        user_cache.pop(token)
+    else:
+        user_id = deep_get(user, '_id')
+        user_cache.pop_matching(lambda cached_user: cached_user['_id'] == user_id)
+
+
+def get_user_cache_stats():
+    return {
+        'hits': user_cache.hits,
+        'misses': user_cache.misses,
+        'size': len(user_cache),
+    }
+
+
+def normalize_variant(chrom, pos, ref, alt):
+    """Return the parts of a variant as in ClinVar: without a chr prefix, uppercase, and with MT for chrM"""
+    chrom = chrom.upper()
+    if chrom.startswith('CHR'):
+        chrom = chrom[3:]
+    if chrom == 'M':
+        chrom = 'MT'
+    return chrom, pos, ref.upper(), alt.upper()
+
+
+def format_variant_string(chrom, pos, ref, alt):
+    return VARIANT_PART_DELIMITER.join(normalize_variant(chrom, pos, ref, alt))
 
 
 def make_variant_key(build, chrom, pos, ref, alt):
@@ -64,14 +117,11 @@ def build_variant_doc(build, chrom, pos, ref, alt,
             'review_status': review_status,
             'last_evaluated': last_evaluated,
         }
-        clinvar['history'] = []
 
     return {
         '_id': key,
         'variant': variant,
         'clinvar': clinvar,
-        'subscribers': [],  # list of user_ids
-        'tags': {},  # user_id -> tag
     }
 
 
@@ -86,6 +136,7 @@ def reset_user_token(db, user):
     new_token = create_token()
     logging.info('Reset token for user: {}'.format(user['email']))
     db.users.update_one({ '_id': user['_id'] }, { '$set': { 'token': new_token } })
+    invalidate_user(user)
     return new_token
 
 
@@ -104,73 +155,152 @@ def create_user(db, email):
     return user_id, token
 
 
+def make_subscription(user_id, variant_id, tag=None, created_at=None):
+    """Return an upsert of a subscription, which leaves an existing subscription unchanged"""
+    return UpdateOne({ 'user_id': user_id, 'variant_id': variant_id }, {
+        '$setOnInsert': {
+            'user_id': user_id,
+            'variant_id': variant_id,
+            'tag': tag,
+            'created_at': created_at or datetime.utcnow(),
+        }
+    }, upsert=True)
+
+
 def subscribe_to_variants(db, user_id, variant_ids):
     logger.debug('Subscribing to {} variants'.format(len(variant_ids)))
-    result = db.variants.update_many({ '_id': { '$in': variant_ids } }, { '$addToSet': { 'subscribers': user_id } })
-    num_subscribed = result.modified_count
+    if not variant_ids:
+        return 0
+
+    created_at = datetime.utcnow()
+    upserts = [make_subscription(user_id, variant_id, created_at=created_at) for variant_id in variant_ids]
+    result = db.subscriptions.bulk_write(upserts, ordered=False)
+    num_subscribed = result.upserted_count
     logger.info('Subscribed to {} new variants'.format(num_subscribed))
+
+    if num_subscribed:
+        # Variants whose only subscription is the new one just became subscribed
+        new_variant_ids = [variant_ids[i] for i in result.upserted_ids]
+        counts = db.subscriptions.aggregate([
+            { '$match': { 'variant_id': { '$in': new_variant_ids } } },
+            { '$group': { '_id': '$variant_id', 'count': { '$sum': 1 } } },
+        ])
+        adjust_stats(db, subscribed_variants=sum(1 for count in counts if count['count'] == 1))
+
     return num_subscribed
 
 
+def count_unsubscribed_variants(db, variant_ids):
+    """Return how many of variant_ids no longer have any subscription"""
+    if not variant_ids:
+        return 0
+    return len(variant_ids) - len(db.subscriptions.distinct('variant_id', { 'variant_id': { '$in': variant_ids } }))
+
+
 def unsubscribe_from_variants(db, user_id, variant_ids):
     logger.debug('Unsubscribing from {} variants'.format(len(variant_ids)))
-    # Unsubscribe
-    result = db.variants.update_many({ '_id': { '$in': variant_ids } }, { '$pull': { 'subscribers': user_id } })
-    num_unsubscribed = result.modified_count
-    # Remove tags
-    result = db.variants.update_many({ '_id': { '$in': variant_ids } }, { '$unset': { 'tags.{}'.format(user_id): '' } })
+    query = { 'user_id': user_id, 'variant_id': { '$in': variant_ids } }
+    subscribed_variant_ids = [subscription['variant_id'] for subscription in db.subscriptions.find(query, { '_id': 0, 'variant_id': 1 })]
+    # Removing the subscription removes its tag too
+    result = db.subscriptions.delete_many(query)
+    num_unsubscribed = result.deleted_count
     logger.info('Unsubscribed from {} new variants'.format(num_unsubscribed))
+    adjust_stats(db, subscribed_variants=-count_unsubscribed_variants(db, subscribed_variant_ids))
     return num_unsubscribed
 
 
 def tag_variants(db, user_id, tag, variant_ids):
     logger.debug('Tagging {} variants'.format(len(variant_ids)))
-    result = db.variants.update_many({ '_id': { '$in': variant_ids } }, { '$set': { 'tags.{}'.format(user_id): tag } })
+    result = db.subscriptions.update_many({ 'user_id': user_id, 'variant_id': { '$in': variant_ids } }, { '$set': { 'tag': tag } })
     num_tagged = result.modified_count
     logger.info('Tagged {} variants'.format(num_tagged))
     return num_tagged
 
 
-def get_variant_by_clinvar_id(db, clinvar_id):
-    logger.error('Finding variant by clinvar id: {!r}'.format(clinvar_id))
-    result = db.variants.find_one({ 'clinvar.variation_id': clinvar_id })
-    logger.error('Result: {!r}'.format(result))
-    return result
+def get_variant_subscriptions(db, variant_ids):
+    """Return dict: variant_id -> list of subscriptions (user_id and tag) to it, for variants with any"""
+    subscriptions = {}
+    for subscription in db.subscriptions.find({ 'variant_id': { '$in': variant_ids } }, ['variant_id', 'user_id', 'tag']):
+        subscriptions.setdefault(subscription['variant_id'], []).append(subscription)
+    return subscriptions
 
 
-def find_or_create_variants(db, genome_build, variant_strings):
-    variant_docs = []
-    for variant_string in variant_strings:
-        if variant_string.count(VARIANT_PART_DELIMITER) == 3:
-            chrom, pos, ref, alt = variant_string.split(VARIANT_PART_DELIMITER)
-            key = make_variant_key(genome_build, chrom, pos, ref, alt)
-            # TODO: normalize this here or in form validation
-            variant = db.variants.find_one({ '_id': key })
-        else:
-            clinvar_id = variant_string
-            variant = get_variant_by_clinvar_id(db, clinvar_id)
-            # Cannot subscribe to variant by clinvar id if it isn't in clinvar
-            # Should have been validated upstream
-            assert variant
-
-        if variant:
-            logger.debug('Found variant: {}'.format(variant['_id']))
-        else:
-            logger.debug('Could not find variant: {}'.format(variant_string))
-            # Create variant
-            variant = build_variant_doc(genome_build, chrom, pos, ref, alt)
-            result = db.variants.insert_one(variant)
-            if result.inserted_id != variant['_id']:
-                logger.error('Error creating variant: {}'.format(variant))
-            logger.debug('Created new variant doc: {}'.format(variant))
+def load_subscribed_variant_ids(db):
+    """Return a compact set of the ids of all variants with subscribers"""
+    # Covered by the variant_user index, so only the index is read
+    subscriptions = db.subscriptions.find({}, { 'variant_id': True, '_id': False }, sort=[('variant_id', ASCENDING)])
+    return HashedIdSet(subscription['variant_id'] for subscription in subscriptions)
+
 
-        variant_docs.append(variant)
+def get_variant_history(db, variant_id):
+    """Return the previous ClinVar annotations of a variant, oldest first"""
+    entries = db.clinvar_history.find({ 'variant_id': variant_id }, sort=CLINVAR_HISTORY_INDEX)
+    return [entry['clinvar'] for entry in entries]
 
-    return variant_docs
 
+def find_or_create_variants(db, genome_build, variant_strings):
+    """Resolve a batch of variant strings to variant ids, returning (variant ids, unresolved strings)
+
+    chrom-pos-ref-alt strings are resolved to their keys, with stub docs created for new variants
+    by a single unordered bulk upsert. ClinVar Variation ids are resolved together by the resolver
+    (so ids already looked up by the request, e.g. by form validation, aren't queried again), and
+    can only be subscribed to if they are in ClinVar.
+    """
+    # dicts, to drop duplicates while keeping the order
+    keys = OrderedDict()
+    clinvar_ids = OrderedDict()
+    unresolved = []
+    for variant_string in variant_strings:
+        if VARIANT_STRING_PATTERN.match(variant_string):
+            # Normalized, so e.g. chr1-55518071-g-a is the same variant as in ClinVar
+            chrom, pos, ref, alt = normalize_variant(*variant_string.split(VARIANT_PART_DELIMITER))
+            if chrom in CHROMOSOMES:
+                keys[make_variant_key(genome_build, chrom, pos, ref, alt)] = (chrom, pos, ref, alt)
+            else:
+                unresolved.append(variant_string)
+        elif variant_string.isdigit():
+            # Keep as string to match what's in db
+            clinvar_ids[variant_string] = None
+        else:
+            unresolved.append(variant_string)
 
-def subscribe(db, email, variant_strings, tag=None, genome_build=DEFAULT_GENOME_BUILD, notifier=None):
-    user = db.users.find_one({ 'email': email })
+    if keys:
+        upserts = []
+        for key, (chrom, pos, ref, alt) in keys.items():
+            variant = build_variant_doc(genome_build, chrom, pos, ref, alt)
+            del variant['_id']
+            # Existing variants are left unchanged
+            upserts.append(UpdateOne({ '_id': key }, { '$setOnInsert': variant }, upsert=True))
+        result = db.variants.bulk_write(upserts, ordered=False)
+        logger.debug('Created {} new variant docs'.format(result.upserted_count))
+
+    variant_ids = list(keys)
+    if clinvar_ids:
+        clinvar_ids.update(resolve_clinvar_ids(db, list(clinvar_ids)))
+        seen = set(variant_ids)
+        for clinvar_id, variant_id in clinvar_ids.items():
+            if variant_id is None:
+                logger.debug('Could not find variant: {}'.format(clinvar_id))
+                unresolved.append(clinvar_id)
+            elif variant_id not in seen:
+                seen.add(variant_id)
+                variant_ids.append(variant_id)
+
+    return variant_ids, unresolved
+
+
+def get_user_by_email(db, email):
+    return db.users.find_one({ 'email': email })
+
+
+def subscribe(db, email, variant_strings, tag=None, genome_build=DEFAULT_GENOME_BUILD, notifier=None, unresolved=None):
+    """Subscribe the user with the email (created if new) to the variants, returning the number of new subscriptions
+
+    variant_strings may be any iterable, such as a stream of an uploaded list, and is subscribed
+    to in batches of VARIANT_BATCH_SIZE. The user gets a single notification of all their new
+    subscriptions. Variant strings that could not be resolved are appended to unresolved, if given.
+    """
+    user = get_user_by_email(db, email)
     # Create user if they don't exist
     if user is None:
         logger.debug('User not found: {}'.format(email))
@@ -185,11 +315,17 @@ def subscribe(db, email, variant_strings, tag=None, genome_build=DEFAULT_GENOME_
             token = reset_user_token(db, user)
 
     # Subscribe to variants
-    variant_docs = find_or_create_variants(db, genome_build, variant_strings)
-    variant_ids = [variant['_id'] for variant in variant_docs]
-    num_subscribed = subscribe_to_variants(db, user_id, variant_ids)
-    if tag:
-        num_tagged = tag_variants(db, user_id, tag, variant_ids)
+    num_subscribed = 0
+    for batch in iter_chunks(variant_strings, VARIANT_BATCH_SIZE):
+        variant_ids, batch_unresolved = find_or_create_variants(db, genome_build, batch)
+        if batch_unresolved:
+            logger.info('Could not resolve {} variants'.format(len(batch_unresolved)))
+            if unresolved is not None:
+                unresolved.extend(batch_unresolved)
+
+        num_subscribed += subscribe_to_variants(db, user_id, variant_ids)
+        if tag and variant_ids:
+            num_tagged = tag_variants(db, user_id, tag, variant_ids)
 
     # Send update email
     if num_subscribed > 0 and notifier:
@@ -198,38 +334,64 @@ def subscribe(db, email, variant_strings, tag=None, genome_build=DEFAULT_GENOME_
     return num_subscribed
 
 
-def unsubscribe(user, form):
+def unsubscribe(user, variant_ids):
     db = mongo.db
     user_id = user.get('_id')
     assert user_id
 
-    ignored_fields = ['csrf_token', 'remove']
-    variant_ids = []
-    for variant_id, should_unsubscribe in form.data.items():
-        if variant_id in ignored_fields or not should_unsubscribe:
-            continue
-        variant_ids.append(variant_id)
-
-    num_unsubscribed = unsubscribe_from_variants(db, user_id, variant_ids)
+    num_unsubscribed = unsubscribe_from_variants(db, user_id, list(variant_ids))
     return num_unsubscribed
 
 
 def authenticate(token):
     """Given a token, return user data or None if not valid"""
-    db = mongo.db
-    user = db.users.find_one({ 'token': token })
-    return user
+    user = user_cache.get(token)
+    if user is None:
+        db = mongo.db
+        user = db.users.find_one({ 'token': token })
+        if user:
+            user_cache.set(token, user)
 
+    # Callers may change their copy
+    return deepcopy(user)
 
-def get_stats():
-    db = mongo.db
+
+def adjust_stats(db, subscribed_variants=0):
+    """Apply a change to the stats document (if there is none yet, it is computed when first read)"""
+    if subscribed_variants:
+        db.stats.update_one({ '_id': STATS_ID }, { '$inc': { 'subscribed_variants': subscribed_variants } })
+
+
+def refresh_stats(db):
+    """Recompute the stats document from scratch, correcting any drift, and return it"""
     # Get number of variants with subscribers
-    subscribed_variants = db.variants.count({ 'subscribers': { '$exists': True, '$ne': [] } })
-    last_updated_doc = db.updates.find_one({}, sort=[('finished_at', DESCENDING)])
+    counts = list(db.subscriptions.aggregate([
+        { '$group': { '_id': '$variant_id' } },
+        { '$count': 'count' },
+    ]))
+    subscribed_variants = counts[0]['count'] if counts else 0
+    # Ignore imports that are still running (or were interrupted)
+    last_updated_doc = db.updates.find_one({ 'finished_at': { '$ne': None } }, sort=[('finished_at', DESCENDING)])
     last_updated = last_updated_doc.get('finished_at') if last_updated_doc else None
-    return {
+
+    stats = {
+        '_id': STATS_ID,
         'subscribed_variants': subscribed_variants,
         'last_updated': last_updated,
+        'refreshed_at': datetime.utcnow(),
+    }
+    db.stats.replace_one({ '_id': STATS_ID }, stats, upsert=True)
+    return stats
+
+
+def get_stats():
+    db = mongo.db
+    stats = db.stats.find_one({ '_id': STATS_ID })
+    if not stats:
+        stats = refresh_stats(db)
+    return {
+        'subscribed_variants': stats['subscribed_variants'],
+        'last_updated': stats['last_updated'],
     }
 
 
@@ -239,7 +401,9 @@ def set_user_slack_data(user, slack_data):
     user_id = deep_get(user, '_id')
     ok = deep_get(slack_data, 'ok')
     if user_id and ok:
-        return db.users.update_one({ '_id': user['_id'] }, { '$set': { 'slack': slack_data } })
+        result = db.users.update_one({ '_id': user['_id'] }, { '$set': { 'slack': slack_data } })
+        invalidate_user(user)
+        return result
 
 
 def remove_user_slack_data(user):
@@ -247,7 +411,9 @@ def remove_user_slack_data(user):
     user_id = deep_get(user, '_id')
     logger.debug('Removing user slack data: {}'.format(user_id))
     if user_id:
-        return db.users.update_one({ '_id': user['_id'] }, { '$set': { 'slack': None } })
+        result = db.users.update_one({ '_id': user['_id'] }, { '$set': { 'slack': None } })
+        invalidate_user(user)
+        return result
 
 
 def suspend_notifications(user):
@@ -255,7 +421,9 @@ def suspend_notifications(user):
     user_id = deep_get(user, '_id')
     logger.debug('Suspending user notifications: {}'.format(user_id))
     if user_id:
-        return db.users.update_one({ '_id': user['_id'] }, { '$set': { 'notification_preferences.notify_emails': False, 'notification_preferences.notify_slack': False } })
+        result = db.users.update_one({ '_id': user['_id'] }, { '$set': { 'notification_preferences.notify_emails': False, 'notification_preferences.notify_slack': False } })
+        invalidate_user(user)
+        return result
 
 
 def delete_user(user):
@@ -263,15 +431,15 @@ def delete_user(user):
     user_id = deep_get(user, '_id')
     logger.debug('Deleting user: {}'.format(user_id))
     if user_id:
-        # Remove variant subscriptions
-        result = db.variants.update_many({ 'subscribers': user_id }, { '$pull': { 'subscribers': user_id } })
-        logger.debug('Unsubscribed from {} variants'.format(result.modified_count))
-        # Remove variant tags
-        tag_field = 'tags.{}'.format(user_id)
-        result = db.variants.update_many({ tag_field: { '$exists': True } }, { '$unset': { tag_field: '' } })
-        logger.debug('Removed tags from {} variants'.format(result.modified_count))
+        # Remove variant subscriptions, along with their tags
+        variant_ids = db.subscriptions.distinct('variant_id', { 'user_id': user_id })
+        result = db.subscriptions.delete_many({ 'user_id': user_id })
+        logger.debug('Unsubscribed from {} variants'.format(result.deleted_count))
+        adjust_stats(db, subscribed_variants=-count_unsubscribed_variants(db, variant_ids))
         # Remove account last
-        return db.users.delete_one({ '_id': user['_id'] })
+        result = db.users.delete_one({ '_id': user['_id'] })
+        invalidate_user(user)
+        return result
 
 
 def set_preferences(user, form):
@@ -295,47 +463,120 @@ def set_preferences(user, form):
     ]
     notification_preferences = dict([(field, form[field].data) for field in form_fields])
     logger.debug('Setting notification preferences: {}'.format(notification_preferences))
-    return db.users.update_one({ '_id': user['_id'] }, { '$set': { 'notification_preferences': notification_preferences } })
+    result = db.users.update_one({ '_id': user['_id'] }, { '$set': { 'notification_preferences': notification_preferences } })
+    invalidate_user(user)
+    return result
 
 
-def get_user_subscribed_variants(user):
+# Number of subscribed variants shown per page of the account page
+SUBSCRIBED_VARIANTS_PAGE_SIZE = 50
+# Fields of a subscribed variant shown on the account page
+SUBSCRIBED_VARIANT_PROJECTION = ['variant', 'clinvar.current.category', 'clinvar.current.gold_stars']
+
+
+def get_user_subscribed_variants(user, after=None, tag=None, category=None, page_size=SUBSCRIBED_VARIANTS_PAGE_SIZE):
+    """Return a page of the user's subscribed variants with the given tag and category, in variant id order
+
+    Pages are keyed on the last variant id of the previous page (after), so each page is
+    a range scan of the user's subscriptions however far in it is. Returns the variants (each
+    with the user's tag) as data, and the variant id to pass as after for the next page, if any.
+    """
     db = mongo.db
     user_id = deep_get(user, '_id')
     logger.debug('Getting variants for user: {}'.format(user_id))
-    if user_id:
-        limit = 100
-        results = db.variants.find({ 'subscribers': user_id }, limit=limit, sort=[('_id', ASCENDING)])
-        return {
-            'count': results.count(True),
-            'total': results.count(False),
-            'data': list(results),
-        }
+    if not user_id:
+        return None
 
+    query = { 'user_id': user_id }
+    if tag:
+        query['tag'] = tag
+
+    variant_query = {}
+    if category == UNKNOWN:
+        # Variants not in ClinVar have no category
+        variant_query['clinvar.current.category'] = { '$in': [None, UNKNOWN] }
+    elif category:
+        variant_query['clinvar.current.category'] = category
+
+    # One more than a page, to tell whether there is a next page
+    variants = []
+    while len(variants) <= page_size:
+        if after:
+            query['variant_id'] = { '$gt': after }
+        subscriptions = list(db.subscriptions.find(query, { '_id': 0, 'variant_id': 1, 'tag': 1 },
+                                                   limit=page_size + 1, sort=[('variant_id', ASCENDING)]))
+        if not subscriptions:
+            break
+
+        tags = dict((subscription['variant_id'], subscription.get('tag')) for subscription in subscriptions)
+        variant_query['_id'] = { '$in': list(tags) }
+        for variant in db.variants.find(variant_query, SUBSCRIBED_VARIANT_PROJECTION, sort=[('_id', ASCENDING)]):
+            # The user's tag for the variant
+            variant['tag'] = tags[variant['_id']]
+            variants.append(variant)
+
+        if not variant_query.get('clinvar.current.category') or len(subscriptions) <= page_size:
+            # Without a category filter, every subscription has its variant
+            break
+        # Otherwise keep scanning until the page is filled
+        after = subscriptions[-1]['variant_id']
+
+    page = variants[:page_size]
+    return {
+        'data': page,
+        'next': page[-1]['_id'] if len(variants) > page_size else None,
+    }
+
+
+# Fields of an existing variant doc needed to update it with new annotations
+VARIANT_UPDATE_PROJECTION = ['clinvar.current', 'clinvar.variation_id']
 
-def merge_docs(old_doc, new_doc):
-    merged_clinvar = {}
-    had_clinvar_data = bool(old_doc['clinvar'])
-    if had_clinvar_data:
+
+def make_variant_update(old_doc, new_doc):
+    """Return the update that applies new_doc's annotations to the stored old_doc
+
+    Only the annotation fields are written, so concurrent changes to the rest
+    of the variant doc are left untouched.
+    """
+    old_clinvar = old_doc.get('clinvar')
+    new_clinvar = new_doc['clinvar']
+    update = {
+        '$set': {
+            'variant': new_doc['variant'],
+        },
+    }
+    if old_clinvar:
         # Variant had existing clinvar, so we might notify
-        old_data = old_doc['clinvar']['current']
-        new_data = new_doc['clinvar']['current']
-        # Append to history
-        history = old_doc['clinvar']['history']
-        history.append(old_data)
-        # Set new annotation data
-        merged_clinvar['current'] = new_data
-        merged_clinvar['history'] = history
-        merged_clinvar['variation_id'] = new_doc['clinvar']['variation_id']
+        if 'variation_id' in new_clinvar:
+            update['$set']['clinvar.variation_id'] = new_clinvar['variation_id']
+        if 'current' in new_clinvar:
+            update['$set']['clinvar.current'] = new_clinvar['current']
+        else:
+            update['$unset'] = { 'clinvar.current': '' }
+        # Keep the replaced annotations for notifications (full history is in clinvar_history)
+        if 'current' in old_clinvar:
+            update['$set']['clinvar.previous'] = old_clinvar['current']
     else:
         # Add clinvar data to existing subscribed variant
-        merged_clinvar = new_doc['clinvar']
+        update['$set']['clinvar'] = new_clinvar
 
-    merged_doc = deepcopy(old_doc)
-    merged_doc.update({
-        'variant': new_doc['variant'],
-        'clinvar': merged_clinvar,
-    })
-    return merged_doc
+    return update
+
+
+def make_history_entry(old_doc, run_id=None):
+    """Return an upsert archiving old_doc's current annotations in clinvar_history
+
+    Keyed by variant and import run, so replaying a batch does not duplicate entries.
+    """
+    variant_id = old_doc['_id']
+    return UpdateOne({ 'variant_id': variant_id, 'run_id': run_id }, {
+        '$setOnInsert': {
+            'variant_id': variant_id,
+            'run_id': run_id,
+            'archived_at': datetime.utcnow(),
+            'clinvar': old_doc['clinvar']['current'],
+        }
+    }, upsert=True)
 
 
 def create_variant_task(db, doc):
@@ -346,43 +587,130 @@ def create_variant_task(db, doc):
     }
 
 
-def update_variant_task(db, existing_doc, updated_doc):
-    doc_id = existing_doc['_id']
-    merged_doc = merge_docs(existing_doc, updated_doc)
-    logger.debug('Updating variant: {}, {} -> {}'.format(doc_id, get_variant_category(existing_doc), get_variant_category(merged_doc)))
+def upsert_variant_task(db, doc):
+    """Return a task writing doc's annotations without reading the stored variant
 
-    if existing_doc['subscribers']:
-        logger.info('Will notify subscribers: {}'.format(updated_doc['subscribers']))
+    Used for variants without subscribers: nothing is notified, and the replaced
+    annotations are not archived in clinvar_history.
+    """
+    clinvar = doc['clinvar']
+    update = {
+        '$set': {
+            'variant': doc['variant'],
+        },
+    }
+    if 'variation_id' in clinvar:
+        update['$set']['clinvar.variation_id'] = clinvar['variation_id']
+    if 'current' in clinvar:
+        update['$set']['clinvar.current'] = clinvar['current']
+    else:
+        update['$unset'] = { 'clinvar.current': '' }
 
     return {
-        'old': existing_doc,
-        'new': merged_doc,
-        'task': ReplaceOne({ '_id': doc_id }, merged_doc)
+        'old': None,
+        'new': None,
+        'task': UpdateOne({ '_id': doc['_id'] }, update, upsert=True),
     }
 
 
-def run_variant_tasks(db, tasks, notifier=None):
-    db_update_queue = [task['task'] for task in tasks]
-    counts = {
-        'inserted': 0,
-        'modified': 0,
-        'notified': 0,
+def slim_variant_doc(doc):
+    """Return only the parts of a variant doc needed to notify subscribers of a change"""
+    return {
+        '_id': doc['_id'],
+        'variant': deep_get(doc, 'variant'),
+        'clinvar': {
+            'variation_id': deep_get(doc, 'clinvar.variation_id'),
+            'current': deep_get(doc, 'clinvar.current'),
+        },
     }
 
-    if db_update_queue:
-        logger.info('Updating {} variants'.format(len(db_update_queue)))
-        result = db.variants.bulk_write(db_update_queue, ordered=False)
-        logger.info('Inserted {} variants and updated status of {}'.format(result.inserted_count, result.modified_count))
-        counts['inserted'] = result.inserted_count
-        counts['modified'] = result.modified_count
 
-    if notifier:
-        notification_queue = [(task['old'], task['new']) for task in tasks if task['old']]
-        for old_doc, new_doc in notification_queue:
-            notifier.notify_of_change(old_doc, new_doc)
+def update_variant_task(db, existing_doc, updated_doc, run_id=None):
+    doc_id = existing_doc['_id']
+    logger.debug('Updating variant: {}, {} -> {}'.format(doc_id, get_variant_category(existing_doc), get_variant_category(updated_doc)))
+
+    return {
+        # Keep only what is needed for notifications, so history isn't held until the write
+        'old': slim_variant_doc(existing_doc),
+        'new': {
+            '_id': doc_id,
+            'variant': updated_doc['variant'],
+            'clinvar': {
+                'variation_id': deep_get(updated_doc, 'clinvar.variation_id', deep_get(existing_doc, 'clinvar.variation_id')),
+                'current': deep_get(updated_doc, 'clinvar.current'),
+            },
+        },
+        'task': UpdateOne({ '_id': doc_id }, make_variant_update(existing_doc, updated_doc)),
+        'history': make_history_entry(existing_doc, run_id) if deep_get(existing_doc, 'clinvar.current') else None,
+    }
 
-        logger.info('Notifying of changes to {} variants'.format(len(notification_queue)))
-        notifier.send_notifications()
-        counts['notified'] = len(notification_queue)
 
-    return counts
+class VariantTaskWriter:
+    """Writes variant tasks to the database in unordered bulk writes of up to batch_size tasks
+
+    With batch_size=None, all tasks are written in a single bulk write when flushed.
+    With outbox, changes to variants with subscribers are queued in the outbox collection
+    as a notification event per subscriber, keyed on run_id, for a dispatch worker to send.
+    """
+    def __init__(self, db, batch_size=None, run_id=None, outbox=False):
+        self.db = db
+        self.batch_size = batch_size
+        self.run_id = run_id
+        self.outbox = outbox
+        self.pending = []
+        self.counts = {
+            'inserted': 0,
+            'modified': 0,
+            'notified': 0,
+        }
+
+    def add(self, task):
+        self.pending.append(task)
+        if self.batch_size and len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def queue_notifications(self, tasks):
+        # Users have no preference for (so aren't notified of) changes to an unknown classification
+        notification_queue = [(task['old'], task['new']) for task in tasks
+                              if task['old'] and get_variant_category(task['new']) != UNKNOWN]
+        if not notification_queue:
+            return
+
+        # One query for the subscribers of all the changed variants in the batch
+        subscriptions = get_variant_subscriptions(self.db, [old_doc['_id'] for old_doc, new_doc in notification_queue])
+        created_at = datetime.utcnow()
+        events = []
+        for old_doc, new_doc in notification_queue:
+            variant_subscriptions = subscriptions.get(old_doc['_id'])
+            if variant_subscriptions:
+                logger.info('Will notify subscribers of {}: {}'.format(old_doc['_id'], len(variant_subscriptions)))
+                for subscription in variant_subscriptions:
+                    events.append(make_outbox_event(self.run_id, old_doc, new_doc, subscription, created_at))
+
+        if events:
+            self.db.outbox.bulk_write(events, ordered=False)
+        self.counts['notified'] += len(notification_queue)
+
+    def flush(self):
+        tasks = self.pending
+        self.pending = []
+        if not tasks:
+            return
+
+        # Queue notifications before the variant write: once written, a change can't be
+        # detected again, whereas a re-imported batch finds the events already queued
+        if self.outbox:
+            self.queue_notifications(tasks)
+
+        # Archive replaced annotations first, so they survive if the variant write fails
+        history_queue = [task['history'] for task in tasks if task.get('history')]
+        if history_queue:
+            self.db.clinvar_history.bulk_write(history_queue, ordered=False)
+
+        db_update_queue = [task['task'] for task in tasks]
+        logger.info('Updating {} variants'.format(len(db_update_queue)))
+        result = self.db.variants.bulk_write(db_update_queue, ordered=False)
+        logger.info('Inserted {} variants and updated status of {}'.format(result.inserted_count + result.upserted_count, result.modified_count))
+        self.counts['inserted'] += result.inserted_count + result.upserted_count
+        self.counts['modified'] += result.modified_count
+
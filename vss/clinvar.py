@@ -1,5 +1,10 @@
+import gzip
 import logging
 
+from collections import namedtuple
+from functools import lru_cache
+from operator import itemgetter
+
 from .constants import BENIGN, UNCERTAIN, UNKNOWN, PATHOGENIC
 
 logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
@@ -18,6 +23,43 @@ CLINVAR_CATEGORY_MAPPING = {
     'benign': BENIGN,
 }
 
+# Columns of clinvar_alleles TSV used by the importer, in the order build_variant_doc takes them
+CLINVAR_ALLELE_COLUMNS = [
+    'chrom',
+    'pos',
+    'ref',
+    'alt',
+    'variation_id',
+    'clinical_significance',
+    'gold_stars',
+    'review_status',
+    'last_evaluated',
+]
+
+ClinvarAllele = namedtuple('ClinvarAllele', CLINVAR_ALLELE_COLUMNS)
+
+
+def iter_clinvar_alleles(filename):
+    """Yield a ClinvarAllele for each row of a clinvar_alleles TSV.gz file
+
+    The header is resolved once and only the columns in CLINVAR_ALLELE_COLUMNS are extracted.
+    Rows are split on tabs without quote handling, which is safe for the pipeline output since
+    none of these columns are quoted.
+    """
+    with gzip.open(filename, 'rt') as ifp:
+        header = next(ifp).rstrip('\n').split('\t')
+        missing = [column for column in CLINVAR_ALLELE_COLUMNS if column not in header]
+        if missing:
+            raise ValueError('Missing columns in {}: {}'.format(filename, ', '.join(missing)))
+
+        get_columns = itemgetter(*[header.index(column) for column in CLINVAR_ALLELE_COLUMNS])
+        make_allele = ClinvarAllele._make
+        for line in ifp:
+            yield make_allele(get_columns(line.rstrip('\n').split('\t')))
+
+
+# Memoized, since there are only a handful of distinct significance strings
+@lru_cache(maxsize=1024)
 def parse_clinvar_category(significance):
     # Normalize significance (removing additional parts, like ", association")
     significance = significance.split(',')[0].strip().lower()
@@ -4,6 +4,14 @@ UNKNOWN = 'unknown'
 PATHOGENIC = 'pathogenic'
 
 DEFAULT_GENOME_BUILD = 'b37'
+# Chromosomes as named in ClinVar
+CHROMOSOMES = [str(x) for x in range(1, 23)] + ['X', 'Y', 'MT']
+
+# Status of an import run document in the updates collection
+RUN_RUNNING = 'running'
+RUN_FINISHED = 'finished'
+# Interrupted, then given up on by a later import run with --restart
+RUN_ABANDONED = 'abandoned'
 
 DEFAULT_NOTIFICATION_PREFERENCES = {
     'unknown_to_benign': True,
@@ -1,14 +1,16 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms.fields import *
 from wtforms.validators import *
 from wtforms.validators import ValidationError
 
-CHROMOSOMES = [str(x) for x in range(1, 23)]
-CHROMOSOMES.extend(['X', 'Y', 'MT', 'M'])
-CHROMOSOMES.extend(['chr{}'.format(x) for x in CHROMOSOMES])
+from .constants import BENIGN, UNCERTAIN, UNKNOWN, PATHOGENIC, CHROMOSOMES as CLINVAR_CHROMOSOMES
 
+CHROMOSOMES = CLINVAR_CHROMOSOMES + ['M']
+CHROMOSOMES.extend(['chr{}'.format(x) for x in CHROMOSOMES])
 from .extensions import mongo
-from .backend import VARIANT_PART_DELIMITER, get_variant_by_clinvar_id
+from .backend import VARIANT_PART_DELIMITER
+from .resolver import resolve_clinvar_id
 
 def ValidClinvarVariant():
     message = 'Unknown Clinvar identifier.'
@@ -20,8 +22,8 @@ def ValidClinvarVariant():
         else:
             # Keep as string to match what's in db
             clinvar_id = variant_string
-            variant = get_variant_by_clinvar_id(mongo.db, clinvar_id)
-            if not variant:
+            # Memoized for the request, so subscribing doesn't look it up again
+            if not resolve_clinvar_id(mongo.db, clinvar_id):
                 raise ValidationError(message)
 
     return _validate
@@ -62,9 +64,26 @@ class SilenceForm(FlaskForm):
 
 
 class VariantForm(FlaskForm):
+    # The selected variants are the variant_id checkboxes of the page
     remove = SubmitField(u'Remove selected variants')
 
 
+class VariantFilterForm(FlaskForm):
+    class Meta:
+        # Submitted with GET, as the query string of the account page
+        csrf = False
+
+    tag = StringField(u'Tag', validators=[Optional()])
+    category = SelectField(u'Category', default='', validators=[Optional()], choices=[
+        ('', 'Any category'),
+        (PATHOGENIC, 'Pathogenic'),
+        (UNCERTAIN, 'Uncertain'),
+        (BENIGN, 'Benign'),
+        (UNKNOWN, 'Unknown/Not in ClinVar'),
+    ])
+    filter = SubmitField(u'Filter')
+
+
 class SignupForm(FlaskForm):
     # TODO: normalize as part of validation process
     variant = StringField(u'Variant (chrom-pos-ref-alt on b37 reference or ClinVar Variation identifier)\ne.g., "1-55518071-G-A", "230224"', validators=[DataRequired(), Regexp('(1[0-9]|2[0-2]|\d|[MXY])-\d+-[ATCG]+-[ATCG]+|\d+'), ValidClinvarVariant()])
@@ -81,6 +100,14 @@ class SignupForm(FlaskForm):
     submit = SubmitField(u'Subscribe')
 
 
+class UploadForm(FlaskForm):
+    variants = FileField(u'Variant list (one chrom-pos-ref-alt or ClinVar Variation identifier per line) or VCF, optionally gzipped',
+                         validators=[FileRequired()])
+    tag = StringField(u'Give these variants a name (optional; please do not use patient information)')
+    email = StringField(u'Email address', validators=[Email(), DataRequired()])
+    submit = SubmitField(u'Subscribe')
+
+
 class LoginForm(FlaskForm):
     email = StringField(u'Email address to send login token', validators=[Email(), DataRequired()])
 
@@ -14,7 +14,6 @@ import logging
 from functools import wraps
 from flask import Blueprint, render_template, flash, redirect, url_for, request, session, g, current_app
 from flask_nav.elements import Navbar, View
-from slackclient import SlackClient
 
 from wtforms.validators import ValidationError
 
@@ -24,11 +23,11 @@ logger.setLevel(logging.DEBUG)
 
 from .forms import *
 from .extensions import mongo, nav
-from .services.notifier import SubscriptionNotifier, ResendTokenNotifier
-from .backend import authenticate, delete_user, get_stats, get_user_subscribed_variants, \
-    remove_user_slack_data, subscribe, set_user_slack_data, set_preferences, \
-    suspend_notifications, unsubscribe
+from .jobs import JobQueue, QueuedSubscriptionNotifier
+from .backend import authenticate, delete_user, get_stats, get_user_by_email, get_user_subscribed_variants, \
+    remove_user_slack_data, subscribe, set_preferences, suspend_notifications, unsubscribe
 from .utils import deep_get
+from .variant_lists import iter_variant_strings, open_variant_list
 
 frontend = Blueprint('frontend', __name__)
 
@@ -54,6 +53,11 @@ def top_nav():
 nav.register_element('frontend_top', top_nav)
 
 
+def get_job_queue():
+    # Third-party calls are queued as jobs, so they don't hold up the response
+    return JobQueue(mongo.db, current_app._get_current_object())
+
+
 def do_login(token):
     if token:
         user = authenticate(token)
@@ -166,36 +170,24 @@ def update_preferences():
     return redirect(url_for('.account'))
 
 
-def create_variants_form(user):
-    variants = get_user_subscribed_variants(user)
-    logger.debug('Variants: %s', variants)
-    if variants:
-        class CustomVariantForm(VariantForm):
-            pass
-
-        for variant in variants['data']:
-            v = variant['variant']
-            v_id = '-'.join([v['chrom'], v['pos'], v['ref'], v['alt']])
-
-            user_id = str(user['_id'])
-            tag = deep_get(variant, 'tags.{}'.format(user_id))
-            category = deep_get(variant, 'clinvar.current.category')
-            gold_stars = deep_get(variant, 'clinvar.current.gold_stars')
-
-            if tag:
-                v_id += ' ({})'.format(tag)
-            if category:
-                try:
-                    stars = int(gold_stars)
-                except:
-                    stars = 0
-                v_id += ': {} {}'.format(category, ' '.join(['⭐'] * stars))
-
-            setattr(CustomVariantForm, variant['_id'], BooleanField(v_id))
-
-        return CustomVariantForm()
-    else:
-        return None
+def describe_variant(variant):
+    v = variant['variant']
+    description = '-'.join([v['chrom'], v['pos'], v['ref'], v['alt']])
+
+    tag = variant.get('tag')
+    category = deep_get(variant, 'clinvar.current.category')
+    gold_stars = deep_get(variant, 'clinvar.current.gold_stars')
+
+    if tag:
+        description += ' ({})'.format(tag)
+    if category:
+        try:
+            stars = int(gold_stars)
+        except:
+            stars = 0
+        description += ': {} {}'.format(category, ' '.join(['⭐'] * stars))
+
+    return description
 
 
 @frontend.route('/account/', methods=('GET', 'POST'))
@@ -206,10 +198,12 @@ def account():
     remove_slack_form = RemoveSlackForm()
     delete_form = DeleteForm()
     silence_form = SilenceForm()
-    variants_form = create_variants_form(user)
+    variants_form = VariantForm()
+    filter_form = VariantFilterForm(request.args)
+    if not filter_form.validate():
+        filter_form = VariantFilterForm(formdata=None)
 
     slack_client_id = current_app.config.get('SLACK_CLIENT_ID', '')
-    slack_client_secret = current_app.config.get('SLACK_CLIENT_SECRET', '')
     logger.debug('Slack client ID: {}'.format(slack_client_id))
     logger.debug('Data: %s', user)
     logger.debug('Payload: %s', request.args)
@@ -219,34 +213,29 @@ def account():
 
     slack_code = request.args.get('code', '')
     if slack_code:
-        sc = SlackClient('')
-
-        # Request the auth tokens from Slack
-        auth_response = sc.api_call(
-            "oauth.access",
-            client_id=slack_client_id,
-            client_secret=slack_client_secret,
-            code=slack_code
-        )
-        logger.debug('Slack auth response: {}'.format(auth_response))
-        success = set_user_slack_data(user, auth_response)
-        if success:
-            flash('Slack successfully connected!', category='success')
-            # Update current user data to ensure render is up-to-date
-            user['slack'] = auth_response
-        else:
-            flash('Error connecting slack', category='danger')
+        get_job_queue().enqueue('connect_slack', user_id=user['_id'], code=slack_code)
+        flash('Connecting Slack... It will show up here in a moment.', category='info')
 
     if variants_form.validate_on_submit():
-        logger.debug('Deleting variants: {}'.format(variants_form.data))
-        num_unsubscribed = unsubscribe(user, variants_form)
+        variant_ids = request.form.getlist('variant_id')
+        logger.debug('Deleting variants: {}'.format(variant_ids))
+        num_unsubscribed = unsubscribe(user, variant_ids)
         if num_unsubscribed > 0:
             flash('Unsubscribed from {} variants'.format(num_unsubscribed), category='success')
-            # Regenerate variants form
-            variants_form = create_variants_form(user)
+
+    tag = filter_form.tag.data or None
+    category = filter_form.category.data or None
+    variants = get_user_subscribed_variants(user, after=request.args.get('after'), tag=tag, category=category)
+    logger.debug('Variants: %s', variants)
+    subscribed_variants = [(variant['_id'], describe_variant(variant)) for variant in variants['data']]
+    # Links to the first and next pages, keeping the filters
+    first_url = url_for('.account', tag=tag, category=category) if request.args.get('after') else None
+    next_url = url_for('.account', after=variants['next'], tag=tag, category=category) if variants['next'] else None
 
     return render_template('account.html', form=form, user=user, variants_form=variants_form,
-                           remove_slack_form=remove_slack_form, delete_form=delete_form, silence_form=silence_form)
+                           filter_form=filter_form, subscribed_variants=subscribed_variants,
+                           first_url=first_url, next_url=next_url, remove_slack_form=remove_slack_form, delete_form=delete_form,
+                           silence_form=silence_form)
 
 
 @frontend.route('/subscribe/', methods=('GET', 'POST'))
@@ -265,7 +254,7 @@ def subscribe_form():
         logger.debug('Email: {}'.format(form.email.data))
         logger.debug('Variant: {}'.format(form.variant.data))
         logger.debug('Tag: {}'.format(form.tag.data))
-        notifier = SubscriptionNotifier(mongo.db, current_app.config)
+        notifier = QueuedSubscriptionNotifier(get_job_queue())
         num_subscribed = subscribe(mongo.db, form.email.data, [form.variant.data], tag=form.tag.data, notifier=notifier)
         if num_subscribed > 0:
             flash('Subscribed to {} new variants'.format(num_subscribed), category='success')
@@ -276,15 +265,51 @@ def subscribe_form():
     return render_template('subscribe.html', form=form)
 
 
+# Number of unresolved variants listed in the message after an upload
+MAX_UNRESOLVED_SHOWN = 10
+
+
+@frontend.route('/subscribe/upload/', methods=('GET', 'POST'))
+def upload_form():
+    email = ''
+    user = g.get('user')
+    if user:
+        email = user.get('email')
+
+    form = UploadForm(data={'email': email})
+
+    if form.validate_on_submit():
+        logger.debug('Email: {}'.format(form.email.data))
+        logger.debug('Variant list: {}'.format(form.variants.data.filename))
+        notifier = QueuedSubscriptionNotifier(get_job_queue())
+        # The upload is parsed as it is subscribed to, rather than read into memory
+        variant_strings = iter_variant_strings(open_variant_list(form.variants.data.stream))
+        unresolved = []
+        num_subscribed = subscribe(mongo.db, form.email.data, variant_strings, tag=form.tag.data,
+                                   notifier=notifier, unresolved=unresolved)
+        if num_subscribed > 0:
+            flash('Subscribed to {} new variants'.format(num_subscribed), category='success')
+        else:
+            flash('Already subscribed to those variants', category='warning')
+        if unresolved:
+            shown = ', '.join(unresolved[:MAX_UNRESOLVED_SHOWN])
+            if len(unresolved) > MAX_UNRESOLVED_SHOWN:
+                shown += ', ...'
+            flash('Could not find {} variants: {}'.format(len(unresolved), shown), category='warning')
+        return redirect(url_for('.index'))
+
+    return render_template('upload.html', form=form)
+
+
 @frontend.route('/login', methods=('GET', 'POST'))
 def login():
     form = LoginForm()
     if request.method == 'POST':
         if form.validate_on_submit():
             email = form.email.data
-            notifier = ResendTokenNotifier(mongo.db, current_app.config)
-            success = notifier.resend_token(email)
+            success = get_user_by_email(mongo.db, email)
             if success:
+                get_job_queue().enqueue('resend_token', email=email)
                 flash('Sent! Please check your email for a login link', category='success')
             else:
                 flash('Error sending email', category='danger')
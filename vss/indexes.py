@@ -0,0 +1,104 @@
+import logging
+
+from bson import ObjectId
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from .backend import CLINVAR_HISTORY_INDEX
+from .outbox import OUTBOX_RETENTION_DAYS, get_claimable_query
+from .jobs import JOB_RETENTION_DAYS, get_claimable_query as get_claimable_jobs_query
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# dict: collection -> indexes the backend queries rely on
+INDEXES = {
+    'users': [
+        IndexModel([('token', ASCENDING)], name='token'),
+        IndexModel([('email', ASCENDING)], name='email'),
+    ],
+    'variants': [
+        IndexModel([('clinvar.variation_id', ASCENDING)], name='clinvar_variation_id'),
+    ],
+    'subscriptions': [
+        IndexModel([('user_id', ASCENDING), ('variant_id', ASCENDING)], name='user_variant', unique=True),
+        IndexModel([('variant_id', ASCENDING), ('user_id', ASCENDING)], name='variant_user'),
+        IndexModel([('user_id', ASCENDING), ('tag', ASCENDING), ('variant_id', ASCENDING)], name='user_tag_variant'),
+    ],
+    'updates': [
+        IndexModel([('finished_at', DESCENDING)], name='finished_at'),
+        IndexModel([('file_hash', ASCENDING), ('status', ASCENDING), ('started_at', DESCENDING)], name='resume'),
+        IndexModel([('status', ASCENDING)], name='status'),
+    ],
+    'clinvar_history': [
+        IndexModel(CLINVAR_HISTORY_INDEX, name='variant_history'),
+    ],
+    'jobs': [
+        IndexModel([('status', ASCENDING), ('lease_expires_at', ASCENDING)], name='claimable'),
+        # Finished jobs are kept for troubleshooting, then removed
+        IndexModel([('finished_at', ASCENDING)], name='finished_at', expireAfterSeconds=JOB_RETENTION_DAYS * 24 * 60 * 60),
+    ],
+    'outbox': [
+        IndexModel([('status', ASCENDING), ('lease_expires_at', ASCENDING)], name='claimable'),
+        IndexModel([('user_id', ASCENDING), ('status', ASCENDING)], name='user_status'),
+        IndexModel([('claim_id', ASCENDING)], name='claim'),
+        # Completed events are kept for troubleshooting, then removed
+        IndexModel([('completed_at', ASCENDING)], name='completed_at', expireAfterSeconds=OUTBOX_RETENTION_DAYS * 24 * 60 * 60),
+    ],
+}
+
+# Representative form of each backend query, as (description, collection, filter, sort),
+# checked against the registered indexes by check_query_plans
+QUERIES = [
+    ('authenticate', 'users', { 'token': 'token' }, None),
+    ('find user by email', 'users', { 'email': 'user@example.com' }, None),
+    ('resolve_clinvar_ids', 'variants', { 'clinvar.variation_id': { '$in': ['230224'] } }, None),
+    ('get_user_subscribed_variants', 'subscriptions', { 'user_id': ObjectId(), 'variant_id': { '$gt': 'b37-1-55518071-G-A' } },
+     [('variant_id', ASCENDING)]),
+    ('get_user_subscribed_variants by tag', 'subscriptions', { 'user_id': ObjectId(), 'tag': 'panel',
+     'variant_id': { '$gt': 'b37-1-55518071-G-A' } }, [('variant_id', ASCENDING)]),
+    ('delete_user, notify_of_subscription', 'subscriptions', { 'user_id': ObjectId() }, None),
+    ('get_variant_subscriptions', 'subscriptions', { 'variant_id': { '$in': ['b37-1-55518071-G-A'] } }, None),
+    ('unsubscribe_from_variants, tag_variants', 'subscriptions', { 'user_id': ObjectId(), 'variant_id': { '$in': ['b37-1-55518071-G-A'] } }, None),
+    ('last update', 'updates', { 'finished_at': { '$ne': None } }, [('finished_at', DESCENDING)]),
+    ('resumable import', 'updates', { 'file_hash': '0' * 64, 'status': 'running', 'num_partitions': 1, 'partition_by': 'hash' },
+     [('started_at', DESCENDING)]),
+    ('get_variant_history', 'clinvar_history', { 'variant_id': 'b37-1-55518071-G-A' }, CLINVAR_HISTORY_INDEX),
+    ('import lookup', 'variants', { '_id': { '$in': ['b37-1-55518071-G-A'] } }, None),
+    ('claim_job', 'jobs', get_claimable_jobs_query(datetime.utcnow()), [('created_at', ASCENDING)]),
+    ('unfinished imports', 'updates', { 'status': 'running' }, None),
+    ('claim_events', 'outbox', get_claimable_query(datetime.utcnow(), [ObjectId()]), None),
+    ('claim_events by user', 'outbox', { 'user_id': { '$in': [ObjectId()] }, 'status': 'pending' }, None),
+    ('claimed events', 'outbox', { 'claim_id': ObjectId(), 'status': 'claimed' }, None),
+]
+
+
+def ensure_indexes(db):
+    """Create any missing registered indexes (existing indexes are left as they are)"""
+    for collection, indexes in INDEXES.items():
+        names = db[collection].create_indexes(indexes)
+        logger.debug('Ensured indexes on {}: {}'.format(collection, names))
+
+
+def iter_plan_stages(plan):
+    yield plan.get('stage')
+    for key in ['inputStage', 'queryPlan']:
+        if key in plan:
+            yield from iter_plan_stages(plan[key])
+    for input_stage in plan.get('inputStages', []):
+        yield from iter_plan_stages(input_stage)
+
+
+def check_query_plans(db):
+    """Explain each registered query, returning the descriptions of those that scan a whole collection"""
+    collection_scans = []
+    for description, collection, query, sort in QUERIES:
+        explanation = db[collection].find(query, sort=sort).explain()
+        winning_plan = explanation['queryPlanner']['winningPlan']
+        stages = list(iter_plan_stages(winning_plan))
+        logger.debug('Query plan for {}: {}'.format(description, ' <- '.join(filter(None, stages))))
+        if 'COLLSCAN' in stages:
+            collection_scans.append(description)
+
+    return collection_scans
@@ -0,0 +1,164 @@
+import logging
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from slackclient import SlackClient
+
+from .backend import set_user_slack_data
+from .services.notifier import SubscriptionNotifier, ResendTokenNotifier
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Status of a job in the jobs collection
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# Where queued jobs are run (JOB_QUEUE config)
+# - mongo: by the worker script (vss.scripts.worker)
+# - inline: by a thread of the web process, for development
+JOB_QUEUE_MONGO = 'mongo'
+JOB_QUEUE_INLINE = 'inline'
+
+# Seconds a worker has to run a job before others may claim it
+DEFAULT_LEASE_SECONDS = 300
+# Attempts at running a job before giving up on it
+DEFAULT_MAX_ATTEMPTS = 3
+# Days to keep finished jobs for troubleshooting
+JOB_RETENTION_DAYS = 30
+
+# dict: job name -> function(db, config, **args)
+JOB_HANDLERS = {}
+
+_inline_executor = ThreadPoolExecutor(max_workers=1)
+
+
+class JobError(Exception):
+    pass
+
+
+def job_handler(name):
+    def register(f):
+        JOB_HANDLERS[name] = f
+        return f
+    return register
+
+
+@job_handler('notify_of_subscription')
+def notify_of_subscription(db, config, user_id, new_subscription_count):
+    SubscriptionNotifier(db, config).notify_of_subscription(user_id, new_subscription_count)
+
+
+@job_handler('resend_token')
+def resend_token(db, config, email):
+    if not ResendTokenNotifier(db, config).resend_token(email):
+        raise JobError('No user with email: {!r}'.format(email))
+
+
+@job_handler('connect_slack')
+def connect_slack(db, config, user_id, code):
+    sc = SlackClient('')
+
+    # Request the auth tokens from Slack
+    auth_response = sc.api_call(
+        "oauth.access",
+        client_id=config.get('SLACK_CLIENT_ID', ''),
+        client_secret=config.get('SLACK_CLIENT_SECRET', ''),
+        code=code
+    )
+    logger.debug('Slack auth response: {}'.format(auth_response))
+    if not set_user_slack_data({ '_id': user_id }, auth_response):
+        raise JobError('Error connecting Slack: {!r}'.format(auth_response.get('error')))
+
+
+def get_claimable_query(now):
+    # Queued jobs, and running jobs whose worker's lease ran out
+    return { '$or': [
+        { 'status': JOB_QUEUED },
+        { 'status': JOB_RUNNING, 'lease_expires_at': { '$lt': now } },
+    ] }
+
+
+def claim_job(db, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """Lease the oldest claimable job to worker_id, returning it (or None if there are none)"""
+    now = datetime.utcnow()
+    return db.jobs.find_one_and_update(get_claimable_query(now), {
+        '$set': {
+            'status': JOB_RUNNING,
+            'worker_id': worker_id,
+            'started_at': now,
+            'lease_expires_at': now + timedelta(seconds=lease_seconds),
+        },
+        '$inc': { 'attempts': 1 },
+    }, sort=[('created_at', 1)], return_document=ReturnDocument.AFTER)
+
+
+def run_job(db, config, job, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Run a claimed job, recording whether it succeeded (or why not) in the jobs collection
+
+    Must be called in an app context. Failed jobs are queued again until they reach max_attempts.
+    """
+    update = { '$unset': { 'lease_expires_at': '' } }
+    try:
+        handler = JOB_HANDLERS[job['name']]
+        handler(db, config, **job['args'])
+    except Exception:
+        logger.exception('Error running job {} ({})'.format(job['_id'], job['name']))
+        status = JOB_QUEUED if job['attempts'] < max_attempts else JOB_FAILED
+        update['$set'] = { 'status': status, 'error': traceback.format_exc() }
+    else:
+        logger.debug('Finished job {} ({})'.format(job['_id'], job['name']))
+        update['$set'] = { 'status': JOB_DONE, 'error': None }
+
+    if update['$set']['status'] != JOB_QUEUED:
+        update['$set']['finished_at'] = datetime.utcnow()
+    db.jobs.update_one({ '_id': job['_id'], 'worker_id': job['worker_id'] }, update)
+    return update['$set']['status']
+
+
+def _run_inline(app, db, job_id):
+    with app.app_context():
+        job = db.jobs.find_one_and_update({ '_id': job_id, 'status': JOB_QUEUED }, {
+            '$set': { 'status': JOB_RUNNING, 'worker_id': 'inline', 'started_at': datetime.utcnow() },
+            '$inc': { 'attempts': 1 },
+        }, return_document=ReturnDocument.AFTER)
+        if job:
+            run_job(db, app.config, job, max_attempts=1)
+
+
+class JobQueue:
+    """Queues jobs in the jobs collection, for the worker (or with JOB_QUEUE = 'inline', a thread) to run"""
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+
+    def enqueue(self, name, **args):
+        assert name in JOB_HANDLERS
+        job = {
+            'name': name,
+            'args': args,
+            'status': JOB_QUEUED,
+            'attempts': 0,
+            'created_at': datetime.utcnow(),
+        }
+        self.db.jobs.insert_one(job)
+        logger.debug('Queued job {} ({})'.format(job['_id'], name))
+
+        if self.app.config.get('JOB_QUEUE', JOB_QUEUE_INLINE) == JOB_QUEUE_INLINE:
+            _inline_executor.submit(_run_inline, self.app, self.db, job['_id'])
+
+        return job['_id']
+
+
+class QueuedSubscriptionNotifier:
+    """Stands in for the SubscriptionNotifier, queueing the email rather than sending it"""
+    def __init__(self, queue):
+        self.queue = queue
+
+    def notify_of_subscription(self, user_id, new_subscription_count):
+        self.queue.enqueue('notify_of_subscription', user_id=user_id, new_subscription_count=new_subscription_count)
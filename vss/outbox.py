@@ -0,0 +1,155 @@
+import logging
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+
+from .constants import RUN_RUNNING
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Status of an event in the outbox collection
+OUTBOX_PENDING = 'pending'
+OUTBOX_CLAIMED = 'claimed'
+OUTBOX_SENT = 'sent'
+# The user no longer exists, or doesn't want to be notified of this change
+OUTBOX_SKIPPED = 'skipped'
+OUTBOX_FAILED = 'failed'
+# Every channel the user is notified on refused the event for good (e.g. a removed Slack webhook)
+OUTBOX_REJECTED = 'rejected'
+
+# Seconds a worker has to dispatch claimed events before others may claim them
+DEFAULT_LEASE_SECONDS = 600
+# Attempts at dispatching an event before giving up on it
+DEFAULT_MAX_ATTEMPTS = 5
+# Seconds before an event that failed to be dispatched may be claimed again
+DEFAULT_RETRY_SECONDS = 300
+# Days to keep completed events for troubleshooting
+OUTBOX_RETENTION_DAYS = 30
+
+
+def get_event_key(run_id, variant_id, user_id):
+    """Idempotency key of the notification of a user of a change to a variant by an import run"""
+    return '{}:{}:{}'.format(run_id, variant_id, user_id)
+
+
+def make_outbox_event(run_id, old_doc, new_doc, subscription, created_at):
+    """Upsert keyed on the event's idempotency key, so a re-imported batch doesn't queue the event twice"""
+    variant_id = new_doc['_id']
+    user_id = subscription['user_id']
+    return UpdateOne({ '_id': get_event_key(run_id, variant_id, user_id) }, {
+        '$setOnInsert': {
+            'run_id': run_id,
+            'variant_id': variant_id,
+            'user_id': user_id,
+            'tag': subscription.get('tag'),
+            'old': old_doc,
+            'new': new_doc,
+            'created_at': created_at,
+            'status': OUTBOX_PENDING,
+            'attempts': 0,
+            # Channels the event was delivered on, so a retry only sends it on the others
+            'delivered': [],
+        },
+    }, upsert=True)
+
+
+def get_claimable_query(now, unfinished_run_ids=None):
+    # Pending events, and claimed events whose worker's lease ran out
+    query = { '$or': [
+        { 'status': OUTBOX_PENDING },
+        { 'status': OUTBOX_CLAIMED, 'lease_expires_at': { '$lt': now } },
+    ] }
+    if unfinished_run_ids:
+        # Events of an import still running may be followed by more for the same users
+        query['run_id'] = { '$nin': unfinished_run_ids }
+    return query
+
+
+def get_unfinished_run_ids(db):
+    """Return the ids of the import runs that are still running, or were interrupted and not yet resumed or abandoned"""
+    return db.updates.distinct('_id', { 'status': RUN_RUNNING })
+
+
+def fail_exhausted_events(db, claimable, now, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Mark failed the claimable events already claimed max_attempts times, returning how many there were
+
+    These are left by workers that died (or were stopped) while dispatching them, since
+    events that fail to be dispatched are marked failed once they reach max_attempts.
+    """
+    result = db.outbox.update_many({ '$and': [claimable, { 'attempts': { '$gte': max_attempts } }] }, {
+        '$set': { 'status': OUTBOX_FAILED, 'completed_at': now },
+        '$unset': { 'lease_expires_at': '' },
+    })
+    if result.modified_count:
+        logger.error('Gave up on {} events after {} attempts'.format(result.modified_count, max_attempts))
+    return result.modified_count
+
+
+def claim_events(db, worker_id, max_users=100, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Lease the claimable events of up to max_users users to worker_id, returning (claim_id, events)
+
+    All of a user's claimable events are claimed together, so they get a single notification.
+    Each event is claimed by a single atomic update, so concurrent workers never share an event.
+    Events already claimed max_attempts times are marked failed rather than claimed again.
+
+    Only events of finished import runs are claimed, so each user gets a single notification
+    of all the changes of a run, however many batches the run queued them in.
+    """
+    now = datetime.utcnow()
+    claimable = get_claimable_query(now, get_unfinished_run_ids(db))
+    fail_exhausted_events(db, claimable, now, max_attempts=max_attempts)
+    user_ids = []
+    for event in db.outbox.find(claimable, ['user_id']).limit(max_users):
+        if event['user_id'] not in user_ids:
+            user_ids.append(event['user_id'])
+
+    if not user_ids:
+        return None, []
+
+    claim_id = ObjectId()
+    db.outbox.update_many({ '$and': [claimable, { 'user_id': { '$in': user_ids } }] }, {
+        '$set': {
+            'status': OUTBOX_CLAIMED,
+            'claim_id': claim_id,
+            'worker_id': worker_id,
+            'lease_expires_at': now + timedelta(seconds=lease_seconds),
+        },
+        '$inc': { 'attempts': 1 },
+    })
+    events = list(db.outbox.find({ 'claim_id': claim_id, 'status': OUTBOX_CLAIMED }))
+    logger.debug('Claimed {} events of {} users as {}'.format(len(events), len(user_ids), claim_id))
+    return claim_id, events
+
+
+def complete_events(db, claim_id, events, statuses, delivered=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                    retry_seconds=DEFAULT_RETRY_SECONDS):
+    """Record the outcome of dispatching claimed events
+
+    statuses: dict of event id -> OUTBOX_SENT, OUTBOX_SKIPPED, OUTBOX_REJECTED or OUTBOX_FAILED.
+    delivered: dict of event id -> channels the event was delivered on by this attempt.
+    Failed events keep their claim for retry_seconds, after which they can be claimed again,
+    until they reach max_attempts. Events whose lease was taken over by another worker in
+    the meantime are left to that worker.
+    """
+    now = datetime.utcnow()
+    delivered = delivered or {}
+    updates = []
+    for event in events:
+        status = statuses[event['_id']]
+        if status == OUTBOX_FAILED and event['attempts'] < max_attempts:
+            update = { '$set': { 'lease_expires_at': now + timedelta(seconds=retry_seconds) } }
+        else:
+            update = {
+                '$set': { 'status': status, 'completed_at': now },
+                '$unset': { 'lease_expires_at': '' },
+            }
+        channels = delivered.get(event['_id'])
+        if channels:
+            update['$addToSet'] = { 'delivered': { '$each': channels } }
+        updates.append(UpdateOne({ '_id': event['_id'], 'claim_id': claim_id }, update))
+
+    if updates:
+        db.outbox.bulk_write(updates, ordered=False)
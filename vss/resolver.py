@@ -0,0 +1,129 @@
+import time
+import bisect
+import logging
+import threading
+
+from array import array
+from flask import g, has_app_context
+from pymongo import DESCENDING
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Seconds between checks for an import run newer than the process-wide index
+INDEX_CHECK_INTERVAL = 60
+
+# Process-wide ClinvarIdIndex, if warmed (CLINVAR_ID_INDEX config)
+clinvar_id_index = None
+
+
+def get_last_update(db):
+    doc = db.updates.find_one({ 'finished_at': { '$ne': None } }, ['finished_at'], sort=[('finished_at', DESCENDING)])
+    return doc['finished_at'] if doc else None
+
+
+class ClinvarIdIndex:
+    """Compact map of ClinVar Variation ids to variant ids, loaded from the variants collection
+
+    Variation ids are kept as a sorted array of ints, with the variant ids in a parallel list,
+    so a few million variants take tens of bytes each rather than a dict entry per variant.
+    The index is reloaded once an import run newer than the one it was loaded after finishes.
+    """
+    def __init__(self, check_interval=INDEX_CHECK_INTERVAL, timer=time.monotonic):
+        self.check_interval = check_interval
+        self.timer = timer
+        self.clinvar_ids = array('q')
+        self.variant_ids = []
+        self.loaded_update = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.clinvar_ids)
+
+    def load(self, db):
+        last_update = get_last_update(db)
+        entries = []
+        for variant in db.variants.find({ 'clinvar.variation_id': { '$exists': True } }, ['clinvar.variation_id']):
+            clinvar_id = variant['clinvar']['variation_id']
+            if clinvar_id.isdigit():
+                entries.append((int(clinvar_id), variant['_id']))
+        entries.sort()
+
+        # Swapped in at once, so concurrent lookups see either the old or the new index
+        self.clinvar_ids, self.variant_ids = array('q', (entry[0] for entry in entries)), [entry[1] for entry in entries]
+        self.loaded_update = last_update
+        self.checked_at = self.timer()
+        logger.info('Loaded ClinVar id index of {} variants'.format(len(entries)))
+
+    def refresh_if_stale(self, db):
+        """Reload the index if an import run has finished since it was loaded (checked at most every check_interval)"""
+        if self.checked_at is not None and self.timer() - self.checked_at < self.check_interval:
+            return
+
+        with self.lock:
+            if self.checked_at is not None and self.timer() - self.checked_at < self.check_interval:
+                return
+            self.checked_at = self.timer()
+            if get_last_update(db) != self.loaded_update:
+                self.load(db)
+
+    def get(self, clinvar_id):
+        if not clinvar_id.isdigit():
+            return None
+
+        clinvar_ids, variant_ids = self.clinvar_ids, self.variant_ids
+        key = int(clinvar_id)
+        i = bisect.bisect_left(clinvar_ids, key)
+        if i < len(clinvar_ids) and clinvar_ids[i] == key:
+            return variant_ids[i]
+
+
+def warm_clinvar_id_index(db):
+    """Load the process-wide index, used by resolve_clinvar_ids from then on"""
+    global clinvar_id_index
+    index = ClinvarIdIndex()
+    index.load(db)
+    clinvar_id_index = index
+    return index
+
+
+def get_request_memo():
+    # Lookups of the current request (or app context), shared by validation and subscription
+    if not has_app_context():
+        return {}
+    return g.setdefault('clinvar_variant_ids', {})
+
+
+def resolve_clinvar_ids(db, clinvar_ids):
+    """Return dict: ClinVar Variation id -> variant id, for those of clinvar_ids in ClinVar
+
+    Ids are looked up in the request memo, then the process-wide index if warmed, and only
+    then in the database, with a single query for all of those left.
+    """
+    memo = get_request_memo()
+    missing = [clinvar_id for clinvar_id in clinvar_ids if clinvar_id not in memo]
+
+    index = clinvar_id_index
+    if missing and index is not None:
+        index.refresh_if_stale(db)
+        for clinvar_id in missing:
+            variant_id = index.get(clinvar_id)
+            if variant_id:
+                memo[clinvar_id] = variant_id
+        # Variants imported since the index was loaded are still found in the database
+        missing = [clinvar_id for clinvar_id in missing if clinvar_id not in memo]
+
+    if missing:
+        for clinvar_id in missing:
+            memo[clinvar_id] = None
+        for variant in db.variants.find({ 'clinvar.variation_id': { '$in': missing } }, ['clinvar.variation_id']):
+            memo[variant['clinvar']['variation_id']] = variant['_id']
+
+    return dict((clinvar_id, memo[clinvar_id]) for clinvar_id in clinvar_ids if memo[clinvar_id])
+
+
+def resolve_clinvar_id(db, clinvar_id):
+    """Return the variant id of a ClinVar Variation id, or None if it isn't in ClinVar"""
+    return resolve_clinvar_ids(db, [clinvar_id]).get(clinvar_id)
@@ -0,0 +1,151 @@
+import os
+import time
+import socket
+import logging
+
+from collections import OrderedDict
+
+from . import app, connect_db
+from ..indexes import ensure_indexes
+from ..outbox import claim_events, complete_events, OUTBOX_SENT, OUTBOX_SKIPPED, OUTBOX_FAILED, OUTBOX_REJECTED, \
+    DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_SECONDS
+from ..services.notifier import UpdateNotifier
+from ..services.dispatcher import NotificationDispatcher, DELIVERED, FAILED
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Number of users whose events are claimed and notified at once
+DEFAULT_BATCH_SIZE = 100
+# Seconds to wait for new events when the outbox is empty
+DEFAULT_POLL_INTERVAL = 10
+
+
+def group_events(events):
+    """Return (old_doc, new_doc, events, change_key) for each variant change of an import run, with its events"""
+    groups = OrderedDict()
+    for event in events:
+        groups.setdefault((event['run_id'], event['variant_id']), []).append(event)
+    return [(group[0]['old'], group[0]['new'], group, change_key) for change_key, group in groups.items()]
+
+
+def get_event_status(event, outcomes):
+    """Return the status of an event, given the outcome of sending it on each channel it wasn't yet delivered on"""
+    delivered = event.get('delivered', [])
+    outcomes = dict((channel, outcome) for channel, outcome in outcomes.items() if channel not in delivered)
+    if FAILED in outcomes.values():
+        # Retried on the failed channels only
+        return OUTBOX_FAILED
+    elif delivered or DELIVERED in outcomes.values():
+        return OUTBOX_SENT
+    elif outcomes:
+        # Refused by all the user's channels, so retrying won't help
+        return OUTBOX_REJECTED
+    else:
+        # No channel to notify the user on
+        return OUTBOX_SKIPPED
+
+
+def dispatch_events(db, config, events, dispatcher=None, changes=None):
+    """Notify users of claimed events, returning the dispatcher's report, the status of each event and
+    the channels each event was delivered on
+
+    changes: cache of the changes notified by earlier batches, so a change is rendered once for all its subscribers.
+    """
+    notifier = UpdateNotifier(db, config, dispatcher=dispatcher, changes=changes)
+    # The subscribers of a change share a single record of it
+    notifier.notify_of_changes(group_events(events))
+
+    report = notifier.send_notifications()
+
+    # Events whose notification couldn't be built, e.g. from malformed variant docs
+    failed_ids = set(event['_id'] for event in notifier.failed)
+    statuses = {}
+    delivered = {}
+    for event in events:
+        outcomes = notifier.deliveries.get(event['user_id'])
+        if event['_id'] in failed_ids:
+            statuses[event['_id']] = OUTBOX_FAILED
+        elif outcomes is None:
+            # Missing user, or not wanted by the user's preferences
+            statuses[event['_id']] = OUTBOX_SKIPPED
+        else:
+            statuses[event['_id']] = get_event_status(event, outcomes)
+            delivered[event['_id']] = [channel for channel, outcome in outcomes.items()
+                                       if outcome == DELIVERED and channel not in event.get('delivered', [])]
+
+    return report, statuses, delivered
+
+
+def main(worker_id=None, batch_size=DEFAULT_BATCH_SIZE, lease_seconds=DEFAULT_LEASE_SECONDS,
+         max_attempts=DEFAULT_MAX_ATTEMPTS, retry_seconds=DEFAULT_RETRY_SECONDS, loop=False,
+         poll_interval=DEFAULT_POLL_INTERVAL):
+    """Send the notifications queued in the outbox, until it is empty or forever if loop
+
+    Any number of workers can drain the outbox in parallel, each leasing the events of a
+    batch of users at a time. Events of a worker that dies are claimed again once its lease
+    runs out, so the lease must be longer than it takes to notify a batch.
+
+    Batches are sent by a single dispatcher, so its rate limits apply to the whole run of
+    this worker. Each worker has its own, so N workers send up to N times the limits.
+    """
+    db = connect_db()
+    ensure_indexes(db)
+    worker_id = worker_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+    dispatcher = NotificationDispatcher(app.config)
+    # Subscribers of a change may be claimed in several batches
+    changes = OrderedDict()
+
+    totals = {}
+    try:
+        while True:
+            claim_id, events = claim_events(db, worker_id, max_users=batch_size, lease_seconds=lease_seconds,
+                                            max_attempts=max_attempts)
+            if not events:
+                if not loop:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            report, statuses, delivered = dispatch_events(db, app.config, events, dispatcher=dispatcher, changes=changes)
+            complete_events(db, claim_id, events, statuses, delivered=delivered, max_attempts=max_attempts,
+                            retry_seconds=retry_seconds)
+            for channel, counts in report.items():
+                channel_totals = totals.setdefault(channel, dict.fromkeys(counts, 0))
+                for key in counts:
+                    channel_totals[key] += counts[key]
+    finally:
+        dispatcher.close()
+
+    logger.info('No more events to claim. Notification report: {}'.format(totals))
+    return totals
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Send the update notifications queued in the outbox')
+    parser.add_argument('--worker-id', type=str,
+                        help='Name of this worker in claimed events (default: HOSTNAME:PID)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of users to claim events of at once (default: %(default)s)')
+    parser.add_argument('--lease', type=int, default=DEFAULT_LEASE_SECONDS,
+                        help='Seconds before events claimed by this worker may be claimed by another (default: %(default)s)')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help='Number of attempts at sending an event before marking it failed (default: %(default)s)')
+    parser.add_argument('--retry-delay', type=int, default=DEFAULT_RETRY_SECONDS,
+                        help='Seconds before an event that failed to send is retried (default: %(default)s)')
+    parser.add_argument('--loop', action='store_true',
+                        help='Keep waiting for new events once the outbox is empty')
+    parser.add_argument('--poll-interval', type=int, default=DEFAULT_POLL_INTERVAL,
+                        help='Seconds between checks for new events with --loop (default: %(default)s)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(worker_id=args.worker_id, batch_size=args.batch_size, lease_seconds=args.lease,
+         max_attempts=args.max_attempts, retry_seconds=args.retry_delay, loop=args.loop,
+         poll_interval=args.poll_interval)
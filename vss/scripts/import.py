@@ -1,25 +1,79 @@
 import sys
-import gzip
+import zlib
+import queue
+import hashlib
 import logging
 
-from csv import DictReader
 from datetime import datetime
+from multiprocessing import Manager, Pool
+from pymongo import DESCENDING
 
-from . import app, connect_db
-from ..constants import DEFAULT_GENOME_BUILD, BENIGN, UNCERTAIN, UNKNOWN, PATHOGENIC
+from . import connect_db
+from ..clinvar import iter_clinvar_alleles
+from ..constants import DEFAULT_GENOME_BUILD, CHROMOSOMES, BENIGN, UNCERTAIN, UNKNOWN, PATHOGENIC, RUN_RUNNING, RUN_FINISHED, \
+    RUN_ABANDONED
 from ..extensions import mongo
-from ..backend import build_variant_doc, get_variant_category, update_variant_task, create_variant_task, run_variant_tasks
-from ..services.notifier import UpdateNotifier
+from ..backend import build_variant_doc, get_variant_category, update_variant_task, create_variant_task, \
+    upsert_variant_task, load_subscribed_variant_ids, refresh_stats, VariantTaskWriter, VARIANT_UPDATE_PROJECTION
+from ..indexes import ensure_indexes
 
 logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Number of TSV rows resolved against the database per query
+DEFAULT_BATCH_SIZE = 1000
+# Number of variant writes sent per bulk_write
+DEFAULT_WRITE_BATCH_SIZE = 1000
+# Chunks of rows read ahead for each worker process, before reading waits for it to catch up
+MAX_QUEUED_CHUNKS = 4
+# Seconds between checks that a worker process is still running, while waiting for it
+WORKER_CHECK_INTERVAL = 1
 
-def iter_variants(filename):
-    with gzip.open(filename, 'rt') as ifp:
-        for row in DictReader(ifp, dialect='excel-tab'):
-            yield row
+# How rows are split between worker processes
+PARTITION_BY_HASH = 'hash'
+PARTITION_BY_CHROM = 'chrom'
+CHROMOSOME_INDEX = dict((chrom, i) for i, chrom in enumerate(CHROMOSOMES))
+
+
+def get_partition(row, num_partitions, partition_by=PARTITION_BY_HASH):
+    """Return the partition of a row, which is stable across processes and runs"""
+    chrom = row.chrom
+    if partition_by == PARTITION_BY_CHROM:
+        if chrom in CHROMOSOME_INDEX:
+            return CHROMOSOME_INDEX[chrom] % num_partitions
+        else:
+            key = chrom
+    else:
+        key = '-'.join([chrom, row.pos, row.ref, row.alt])
+
+    return zlib.crc32(key.encode('utf-8')) % num_partitions
+
+
+def iter_partition_chunks(filename, row_offsets, chunk_size, partition_by=PARTITION_BY_HASH):
+    """Yield (partition, rows) for chunks of up to chunk_size rows of each partition, reading the file once
+
+    row_offsets: number of rows of each partition to skip, as already committed by an interrupted import.
+    Chunks of a partition are yielded in file order.
+    """
+    num_partitions = len(row_offsets)
+    skipped = list(row_offsets)
+    chunks = [[] for partition in range(num_partitions)]
+    for row in iter_clinvar_alleles(filename):
+        partition = get_partition(row, num_partitions, partition_by) if num_partitions > 1 else 0
+        if skipped[partition]:
+            skipped[partition] -= 1
+            continue
+
+        chunk = chunks[partition]
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield partition, chunk
+            chunks[partition] = []
+
+    for partition, chunk in enumerate(chunks):
+        if chunk:
+            yield partition, chunk
 
 
 def did_variant_category_change(old_doc, new_doc):
@@ -28,49 +82,257 @@ def did_variant_category_change(old_doc, new_doc):
     return old_category != new_category
 
 
-def iter_variant_updates(db, variants):
-    for variant in variants:
-        new_doc = build_variant_doc(DEFAULT_GENOME_BUILD, **variant)
+def find_variant_changes(db, new_docs):
+    """Yield (old_doc, new_doc) for each of new_docs whose category differs from the stored variant"""
+    doc_ids = [doc['_id'] for doc in new_docs]
+    old_docs = db.variants.find({ '_id': { '$in': doc_ids } }, VARIANT_UPDATE_PROJECTION)
+    old_docs_by_id = dict((doc['_id'], doc) for doc in old_docs)
 
-        doc_id = new_doc['_id']
-        old_doc = db.variants.find_one({ '_id': doc_id })
+    for new_doc in new_docs:
+        old_doc = old_docs_by_id.get(new_doc['_id'])
         if did_variant_category_change(old_doc, new_doc):
             yield (old_doc, new_doc)
 
 
-def main(clinvar_filename):
-    db = connect_db()
-    notifier = UpdateNotifier(db, app.config)
-    started_at = datetime.utcnow()
-
-    task_list = []
-    variant_iterator = iter_variants(clinvar_filename)
-    for i, (old_doc, new_doc) in enumerate(iter_variant_updates(db, variant_iterator)):
-        if i % 10000 == 0:
-            logger.debug('Processed {} variants'.format(i))
-
+def iter_variant_tasks(db, variant_updates, run_id=None):
+    for old_doc, new_doc in variant_updates:
         if old_doc:
             # Variant is already known, either:
             # - someone subscribed before it was added to clinvar, or
             # - it was already in clinvar, and we might have new annotations
-            task = update_variant_task(db, old_doc, new_doc)
+            yield update_variant_task(db, old_doc, new_doc, run_id=run_id)
 
         else:
             # Add clinvar annotations with empty subscriber data
-            task = create_variant_task(db, new_doc)
+            yield create_variant_task(db, new_doc)
 
-        task_list.append(task)
 
-    results = run_variant_tasks(db, task_list, notifier=notifier)
-    logger.debug('Variants updated. Results: {}'.format(results))
+def hash_file(filename, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as ifp:
+        for block in iter(lambda: ifp.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def new_partition_progress():
+    return {
+        # Progress checkpoint: rows of the partition already committed
+        'row_offset': 0,
+        'committed_batches': 0,
+        'inserted_count': 0,
+        'modified_count': 0,
+        'notified_count': 0,
+    }
+
+
+def start_run(db, clinvar_filename, num_partitions=1, partition_by=PARTITION_BY_HASH, resume=False, restart=False):
+    """Return the updates doc for this import, continuing an unfinished import of the same file if resume
+
+    An unfinished import holds back the notifications it queued, and the changes it wrote won't
+    be found again by a new import, so a new import is refused while one is unfinished, unless
+    restart: the unfinished imports are then abandoned, which releases their notifications.
+    """
+    file_hash = hash_file(clinvar_filename)
+    if resume:
+        run = db.updates.find_one({
+            'file_hash': file_hash,
+            'status': RUN_RUNNING,
+            'num_partitions': num_partitions,
+            'partition_by': partition_by,
+        }, sort=[('started_at', DESCENDING)])
+        if run:
+            logger.info('Resuming import {} from rows {}'.format(run['_id'], [progress['row_offset'] for progress in run['partitions']]))
+            return run
+        else:
+            logger.warning('No unfinished import of {} to resume, starting from the beginning'.format(clinvar_filename))
+
+    unfinished_runs = list(db.updates.find({ 'status': RUN_RUNNING }, ['filename', 'num_partitions', 'partition_by']))
+    if unfinished_runs:
+        descriptions = ', '.join('{} ({}, workers={}, partition_by={})'.format(
+            run['_id'], run.get('filename'), run.get('num_partitions'), run.get('partition_by')) for run in unfinished_runs)
+        if not restart:
+            raise RuntimeError('Unfinished imports: {}. Resume with --resume (with the same file, --workers and '
+                               '--partition-by), or abandon them with --restart'.format(descriptions))
+
+        logger.warning('Abandoning unfinished imports: {}'.format(descriptions))
+        db.updates.update_many({ '_id': { '$in': [run['_id'] for run in unfinished_runs] } }, {
+            '$set': { 'status': RUN_ABANDONED, 'abandoned_at': datetime.utcnow() },
+        })
+
+    run = {
+        'started_at': datetime.utcnow(),
+        'filename': clinvar_filename,
+        'file_hash': file_hash,
+        'status': RUN_RUNNING,
+        'num_partitions': num_partitions,
+        'partition_by': partition_by,
+        'partitions': [new_partition_progress() for partition in range(num_partitions)],
+    }
+    result = db.updates.insert_one(run)
+    run['_id'] = result.inserted_id
+    return run
+
+
+def checkpoint_partition(db, run_id, partition, row_offset, counts):
+    prefix = 'partitions.{}.'.format(partition)
+    db.updates.update_one({ '_id': run_id }, {
+        '$set': {
+            prefix + 'row_offset': row_offset,
+            prefix + 'inserted_count': counts['inserted'],
+            prefix + 'modified_count': counts['modified'],
+            prefix + 'notified_count': counts['notified'],
+        },
+        '$inc': { prefix + 'committed_batches': 1 },
+    })
+
+
+def finish_run(db, run_id, counts, committed_batches):
+    db.updates.update_one({ '_id': run_id }, {
+        '$set': {
+            'status': RUN_FINISHED,
+            'finished_at': datetime.utcnow(),
+            'committed_batches': committed_batches,
+            'inserted_count': counts['inserted'],
+            'modified_count': counts['modified'],
+            'notified_count': counts['notified'],
+        },
+    })
+
 
-    db.updates.insert_one({
-        'started_at': started_at,
-        'finished_at': datetime.utcnow(),
-        'inserted_count': results['inserted'],
-        'modified_count': results['modified'],
-        'notified_count': results['notified'],
+def import_partition(job, chunks):
+    """Import the chunks of rows of one partition of a ClinVar release, checkpointing progress after each
+
+    Runs in a worker process (with its own database connection) when importing in parallel.
+    Changes to variants with subscribers are queued in the outbox along with each chunk.
+    Returns the partition's counts and number of committed batches.
+    """
+    db = connect_db()
+    partition = job['partition']
+    progress = job['progress']
+
+    writer = VariantTaskWriter(db, batch_size=job['write_batch_size'] or None, run_id=job['run_id'], outbox=True)
+    # Carry over counts from batches committed before resuming
+    writer.counts.update({
+        'inserted': progress['inserted_count'],
+        'modified': progress['modified_count'],
+        'notified': progress['notified_count'],
     })
+    committed_batches = progress['committed_batches']
+
+    row_offset = progress['row_offset']
+    # Resolve existing docs a chunk at a time, rather than one query per row
+    for chunk in chunks:
+        new_docs = [build_variant_doc(DEFAULT_GENOME_BUILD, *variant) for variant in chunk]
+        subscribed_variant_ids = job['subscribed_variant_ids']
+        if subscribed_variant_ids is not None:
+            # Fast path: only variants with subscribers are read, merged and notified
+            upsert_docs = [doc for doc in new_docs if doc['_id'] not in subscribed_variant_ids]
+            new_docs = [doc for doc in new_docs if doc['_id'] in subscribed_variant_ids]
+            for doc in upsert_docs:
+                writer.add(upsert_variant_task(db, doc))
+
+        for task in iter_variant_tasks(db, find_variant_changes(db, new_docs), run_id=job['run_id']):
+            writer.add(task)
+
+        # Commit the whole chunk before recording it as done
+        writer.flush()
+        row_offset += len(chunk)
+        committed_batches += 1
+        checkpoint_partition(db, job['run_id'], partition, row_offset, writer.counts)
+        logger.debug('Processed {} variants in partition {}'.format(row_offset, partition))
+
+    return writer.counts, committed_batches
+
+
+def import_queued_partition(job, chunk_queue):
+    """Import the chunks of a partition put on chunk_queue by the parent process, until it puts None"""
+    return import_partition(job, iter(chunk_queue.get, None))
+
+
+def put_chunk(chunk_queue, chunk, result):
+    """Put a chunk on a worker's queue, raising the worker's error if it exited rather than waiting forever"""
+    while True:
+        try:
+            chunk_queue.put(chunk, timeout=WORKER_CHECK_INTERVAL)
+            return
+        except queue.Full:
+            if result.ready():
+                result.get()
+                raise RuntimeError('Import worker exited before the end of its partition')
+
+
+def main(clinvar_filename, batch_size=DEFAULT_BATCH_SIZE, write_batch_size=DEFAULT_WRITE_BATCH_SIZE, resume=False,
+         restart=False, workers=1, partition_by=PARTITION_BY_HASH, fast_path=False):
+    """Import a ClinVar release, split across worker processes if workers > 1
+
+    The release is read and split into partitions once, by this process, which hands
+    chunks of rows of each partition to its worker process.
+
+    If resume, rows committed by an interrupted import of the same file (with the same
+    workers and partition_by) are skipped. Notifications of changes committed before the
+    interruption are already in the outbox. While an import is unfinished, others are
+    refused unless restart, which abandons it (see start_run).
+
+    Notifications are sent by the dispatch worker (vss.scripts.dispatch), not by the import.
+
+    If fast_path, rows for variants that had no subscribers when the import started are
+    written without reading the stored variant, so their changes are not notified or
+    archived in clinvar_history: their history is incomplete if they are later subscribed to.
+    """
+    db = connect_db()
+    ensure_indexes(db)
+    run = start_run(db, clinvar_filename, num_partitions=workers, partition_by=partition_by, resume=resume,
+                    restart=restart)
+
+    subscribed_variant_ids = None
+    if fast_path:
+        subscribed_variant_ids = load_subscribed_variant_ids(db)
+        logger.info('Loaded {} subscribed variants'.format(len(subscribed_variant_ids)))
+
+    jobs = []
+    for partition, progress in enumerate(run['partitions']):
+        jobs.append({
+            'run_id': run['_id'],
+            'partition': partition,
+            'progress': progress,
+            'write_batch_size': write_batch_size,
+            'subscribed_variant_ids': subscribed_variant_ids,
+        })
+
+    chunks = iter_partition_chunks(clinvar_filename, [progress['row_offset'] for progress in run['partitions']],
+                                   batch_size, partition_by)
+    if workers > 1:
+        with Manager() as manager, Pool(workers) as pool:
+            # Bounded, so reading doesn't get ahead of a slow worker by more than a few chunks
+            chunk_queues = [manager.Queue(MAX_QUEUED_CHUNKS) for job in jobs]
+            results = [pool.apply_async(import_queued_partition, (job, chunk_queue))
+                       for job, chunk_queue in zip(jobs, chunk_queues)]
+            for partition, chunk in chunks:
+                put_chunk(chunk_queues[partition], chunk, results[partition])
+            for chunk_queue, result in zip(chunk_queues, results):
+                put_chunk(chunk_queue, None, result)
+            partition_results = [result.get() for result in results]
+    else:
+        partition_results = [import_partition(jobs[0], (chunk for partition, chunk in chunks))]
+
+    results = {
+        'inserted': 0,
+        'modified': 0,
+        'notified': 0,
+    }
+    committed_batches = 0
+    for counts, partition_batches in partition_results:
+        for key in results:
+            results[key] += counts[key]
+        committed_batches += partition_batches
+
+    logger.info('Queued notifications of changes to {} variants'.format(results['notified']))
+    logger.debug('Variants updated. Results: {}'.format(results))
+
+    finish_run(db, run['_id'], results, committed_batches)
+    # Show the new import date on the home page
+    refresh_stats(db)
 
 
 def parse_args():
@@ -79,10 +341,25 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Update ClinVar data')
     parser.add_argument('clinvar_filename', metavar='CLINVAR_ALLELES_TSV_GZ', type=str,
                         help='clinvar_alleles.single.b*.tsv.gz from github.com/macarthur-lab/clinvar pipeline')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of rows to look up in the database at once (default: %(default)s)')
+    parser.add_argument('--write-batch-size', type=int, default=DEFAULT_WRITE_BATCH_SIZE,
+                        help='Maximum number of variant writes per bulk write, or 0 for no limit (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted import of the same file, skipping rows already committed')
+    parser.add_argument('--restart', action='store_true',
+                        help='Abandon unfinished imports (sending the notifications they queued) and start over')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes to split the import across (default: %(default)s)')
+    parser.add_argument('--partition-by', choices=[PARTITION_BY_HASH, PARTITION_BY_CHROM], default=PARTITION_BY_HASH,
+                        help='Split rows between workers by hash of the variant or by chromosome (default: %(default)s)')
+    parser.add_argument('--fast-path', action='store_true',
+                        help='Only read, compare and archive variants with subscribers, so others have no history')
 
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args.clinvar_filename)
+    main(args.clinvar_filename, batch_size=args.batch_size, write_batch_size=args.write_batch_size, resume=args.resume,
+         restart=args.restart, workers=args.workers, partition_by=args.partition_by, fast_path=args.fast_path)
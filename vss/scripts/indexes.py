@@ -0,0 +1,38 @@
+import sys
+import logging
+
+from . import connect_db
+from ..indexes import ensure_indexes, check_query_plans
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def main(check=False):
+    db = connect_db()
+    ensure_indexes(db)
+    logger.info('Database indexes are up to date')
+
+    if check:
+        collection_scans = check_query_plans(db)
+        if collection_scans:
+            logger.error('Queries scanning a whole collection: {}'.format(', '.join(collection_scans)))
+            sys.exit(1)
+        else:
+            logger.info('All queries use an index')
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Create database indexes')
+    parser.add_argument('--check', action='store_true',
+                        help='Also explain each backend query, and fail if any of them scans a whole collection')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(check=args.check)
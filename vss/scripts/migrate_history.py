@@ -0,0 +1,59 @@
+import logging
+
+from . import connect_db
+from ..indexes import ensure_indexes
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def migrate_variant_history(db, doc):
+    """Move a variant's embedded clinvar.history array to the clinvar_history collection
+
+    Safe to re-run: entries migrated by an earlier, interrupted attempt are replaced.
+    """
+    variant_id = doc['_id']
+    history = doc['clinvar']['history']
+    # Migrated entries have no import run; insertion order preserves their order
+    db.clinvar_history.delete_many({ 'variant_id': variant_id, 'run_id': None })
+    if history:
+        db.clinvar_history.insert_many([{
+            'variant_id': variant_id,
+            'run_id': None,
+            'archived_at': None,
+            'clinvar': entry,
+        } for entry in history], ordered=True)
+
+    update = { '$unset': { 'clinvar.history': '' } }
+    if history:
+        # Keep the last replaced annotations on the variant for notifications
+        update['$set'] = { 'clinvar.previous': history[-1] }
+    db.variants.update_one({ '_id': variant_id }, update)
+
+
+def main():
+    db = connect_db()
+    ensure_indexes(db)
+
+    count = 0
+    for doc in db.variants.find({ 'clinvar.history': { '$exists': True } }, ['clinvar.history']):
+        migrate_variant_history(db, doc)
+        count += 1
+        if count % 10000 == 0:
+            logger.debug('Migrated {} variants'.format(count))
+
+    logger.info('Migrated history of {} variants'.format(count))
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Move embedded ClinVar history arrays to the clinvar_history collection')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main()
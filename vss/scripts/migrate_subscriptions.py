@@ -0,0 +1,59 @@
+import logging
+
+from datetime import datetime
+
+from . import connect_db
+from ..backend import make_subscription, refresh_stats
+from ..indexes import ensure_indexes
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def migrate_variant_subscriptions(db, doc, migrated_at):
+    """Move a variant's embedded subscribers array and tags map to the subscriptions collection
+
+    Safe to re-run: subscriptions migrated by an earlier, interrupted attempt are left as they are.
+    """
+    variant_id = doc['_id']
+    subscribers = doc.get('subscribers') or []
+    tags = doc.get('tags') or {}
+    if subscribers:
+        db.subscriptions.bulk_write([
+            make_subscription(user_id, variant_id, tag=tags.get(str(user_id)), created_at=migrated_at)
+            for user_id in subscribers
+        ], ordered=False)
+
+    db.variants.update_one({ '_id': variant_id }, { '$unset': { 'subscribers': '', 'tags': '' } })
+    return len(subscribers)
+
+
+def main():
+    db = connect_db()
+    ensure_indexes(db)
+
+    migrated_at = datetime.utcnow()
+    count = 0
+    num_subscriptions = 0
+    for doc in db.variants.find({ 'subscribers': { '$exists': True } }, ['subscribers', 'tags']):
+        num_subscriptions += migrate_variant_subscriptions(db, doc, migrated_at)
+        count += 1
+        if count % 10000 == 0:
+            logger.debug('Migrated {} variants'.format(count))
+
+    logger.info('Migrated {} subscriptions from {} variants'.format(num_subscriptions, count))
+    refresh_stats(db)
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Move embedded variant subscribers and tags to the subscriptions collection')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main()
@@ -0,0 +1,33 @@
+import logging
+
+from . import connect_db
+from ..backend import refresh_stats, STATS_ID
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def main():
+    db = connect_db()
+    old_stats = db.stats.find_one({ '_id': STATS_ID }) or {}
+    stats = refresh_stats(db)
+    drift = stats['subscribed_variants'] - old_stats.get('subscribed_variants', 0)
+    if old_stats and drift:
+        logger.warning('Corrected subscribed variants by {} (from {} to {})'.format(
+            drift, old_stats['subscribed_variants'], stats['subscribed_variants']))
+
+    logger.info('Stats: {}'.format(stats))
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Recompute the stats shown on the home page, correcting any drift')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main()
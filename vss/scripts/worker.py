@@ -0,0 +1,67 @@
+import os
+import time
+import socket
+import logging
+
+from . import app
+from ..extensions import mongo
+from ..indexes import ensure_indexes
+from ..jobs import claim_job, run_job, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Seconds to wait for new jobs when the queue is empty
+DEFAULT_POLL_INTERVAL = 2
+
+
+def main(worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS, loop=False,
+         poll_interval=DEFAULT_POLL_INTERVAL):
+    """Run the jobs queued by the web app, until there are none left or forever if loop
+
+    Several workers can run in parallel, each leasing one job at a time.
+    """
+    worker_id = worker_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+    counts = {}
+    # Jobs use the app's database connection and config
+    with app.app_context():
+        db = mongo.db
+        ensure_indexes(db)
+        while True:
+            job = claim_job(db, worker_id, lease_seconds=lease_seconds)
+            if not job:
+                if not loop:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            status = run_job(db, app.config, job, max_attempts=max_attempts)
+            counts[status] = counts.get(status, 0) + 1
+
+    logger.info('No more jobs to run. Job statuses: {}'.format(counts))
+    return counts
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run jobs queued by the web app (with JOB_QUEUE = "mongo")')
+    parser.add_argument('--worker-id', type=str,
+                        help='Name of this worker in claimed jobs (default: HOSTNAME:PID)')
+    parser.add_argument('--lease', type=int, default=DEFAULT_LEASE_SECONDS,
+                        help='Seconds before a job claimed by this worker may be claimed by another (default: %(default)s)')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help='Number of attempts at running a job before marking it failed (default: %(default)s)')
+    parser.add_argument('--loop', action='store_true',
+                        help='Keep waiting for new jobs once the queue is empty')
+    parser.add_argument('--poll-interval', type=int, default=DEFAULT_POLL_INTERVAL,
+                        help='Seconds between checks for new jobs with --loop (default: %(default)s)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(worker_id=args.worker_id, lease_seconds=args.lease, max_attempts=args.max_attempts, loop=args.loop,
+         poll_interval=args.poll_interval)
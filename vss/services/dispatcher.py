@@ -0,0 +1,197 @@
+import time
+import logging
+import threading
+import requests
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+
+from .mailer import Mailer
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+EMAIL = 'email'
+SLACK = 'slack'
+CHANNELS = [EMAIL, SLACK]
+
+# Response status codes of a delivered notification, per channel
+SUCCESS_STATUS_CODES = {
+    EMAIL: {200, 202},
+    SLACK: {200},
+}
+
+# Outcome of delivering a notification on a channel
+DELIVERED = 'delivered'
+# Not delivered, but may be on a later attempt (e.g. connection or server errors)
+FAILED = 'failed'
+# Refused for good (e.g. a removed Slack webhook), so not worth trying again
+REJECTED = 'rejected'
+
+DEFAULT_NOTIFICATION_WORKERS = 8
+# Sustained notifications per second, per channel
+DEFAULT_EMAIL_RATE_LIMIT = 10
+DEFAULT_SLACK_RATE_LIMIT = 10
+DEFAULT_NOTIFICATION_MAX_RETRIES = 3
+# Seconds before the first retry, doubled for each further retry
+DEFAULT_NOTIFICATION_RETRY_BACKOFF = 1.0
+MAX_RETRY_DELAY = 60
+
+
+class TokenBucket:
+    """Thread-safe token bucket, allowing bursts of up to capacity and rate acquisitions per second on average"""
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, self.rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, blocking until one is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_retry_after(response):
+    """Return the delay in seconds requested by a response's Retry-After header, if any"""
+    if response is None:
+        return None
+
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(response):
+    # Connection errors (no response), rate limits and server errors may succeed on retry
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+
+class NotificationDispatcher:
+    """Sends emails and Slack messages concurrently from a bounded pool of worker threads
+
+    Each channel has its own rate limit. Rate limited (429) and failed (5xx) requests are
+    retried after the delay given by Retry-After, or with exponential backoff otherwise.
+
+    A dispatcher is meant to be kept for the life of the process and reused for each batch of
+    notifications (see join), so its rate limits and connections carry over between batches.
+    Rate limits are per dispatcher, so processes sending at once add up to a multiple of them.
+    """
+    def __init__(self, config, max_workers=None):
+        self.config = config
+        self.max_workers = max_workers or config.get('NOTIFICATION_WORKERS', DEFAULT_NOTIFICATION_WORKERS)
+        self.max_retries = config.get('NOTIFICATION_MAX_RETRIES', DEFAULT_NOTIFICATION_MAX_RETRIES)
+        self.retry_backoff = config.get('NOTIFICATION_RETRY_BACKOFF', DEFAULT_NOTIFICATION_RETRY_BACKOFF)
+        self.rate_limits = {
+            EMAIL: TokenBucket(config.get('EMAIL_RATE_LIMIT', DEFAULT_EMAIL_RATE_LIMIT)),
+            SLACK: TokenBucket(config.get('SLACK_RATE_LIMIT', DEFAULT_SLACK_RATE_LIMIT)),
+        }
+
+        # Connections are kept alive and shared between workers, with a connection per worker
+        self.mail_session = make_session(self.max_workers)
+        self.mailer = Mailer(config, session=self.mail_session)
+        self.slack_session = make_session(self.max_workers)
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.futures = []
+        self.report_lock = threading.Lock()
+        self.report = self._new_report()
+
+    @staticmethod
+    def _new_report():
+        return dict((channel, { 'sent': 0, 'failed': 0, 'retried': 0 }) for channel in CHANNELS)
+
+    def _count(self, channel, outcome, count=1):
+        with self.report_lock:
+            self.report[channel][outcome] += count
+
+    def _get_retry_delay(self, response, attempt):
+        delay = get_retry_after(response)
+        if delay is None:
+            delay = self.retry_backoff * (2 ** attempt)
+        return min(delay, MAX_RETRY_DELAY)
+
+    def _deliver(self, channel, send, description, count=1):
+        # count: number of notifications delivered by the request
+        for attempt in range(self.max_retries + 1):
+            self.rate_limits[channel].acquire()
+            response = None
+            try:
+                response = send()
+            except requests.RequestException as e:
+                logger.warning('Error sending {} to {!r}: {}'.format(channel, description, e))
+
+            if response is not None and response.status_code in SUCCESS_STATUS_CODES[channel]:
+                logger.debug('Sent {} to {!r}'.format(channel, description))
+                self._count(channel, 'sent', count)
+                return DELIVERED
+
+            if not is_retryable(response) or attempt == self.max_retries:
+                break
+
+            delay = self._get_retry_delay(response, attempt)
+            logger.info('Retrying {} to {!r} in {}s ({!r})'.format(
+                channel, description, delay, response.status_code if response is not None else None))
+            self._count(channel, 'retried', count)
+            time.sleep(delay)
+
+        if response is not None:
+            logger.error('Error sending {} to {!r} ({!r}): {!r}'.format(channel, description, response.status_code, response.text))
+        self._count(channel, 'failed', count)
+        return FAILED if is_retryable(response) else REJECTED
+
+    def _send_mail(self, to_emails, mail):
+        description = to_emails[0] if len(to_emails) == 1 else '{} recipients'.format(len(to_emails))
+        future = self.executor.submit(self._deliver, EMAIL, lambda: self.mailer.send(mail), description, len(to_emails))
+        self.futures.append(future)
+        return future
+
+    def send_emails(self, messages):
+        """Send (to_email, subject, body) messages, with identical messages batched into a single request
+
+        Returns (to_emails, future) for each request, where the future's result is the outcome
+        of the request: DELIVERED, FAILED or REJECTED.
+        """
+        return [(to_emails, self._send_mail(to_emails, mail)) for to_emails, mail in self.mailer.iter_batches(messages)]
+
+    def post_slack(self, url, json, description=None):
+        """Post a Slack message, returning a future whose result is the outcome of the request"""
+        future = self.executor.submit(self._deliver, SLACK, lambda: self.slack_session.post(url, json=json), description)
+        self.futures.append(future)
+        return future
+
+    def join(self):
+        """Wait for the notifications submitted since the last join, returning the report of each channel for them"""
+        futures, self.futures = self.futures, []
+        wait(futures)
+        with self.report_lock:
+            report, self.report = self.report, self._new_report()
+        logger.info('Notification report: {}'.format(report))
+        return report
+
+    def close(self):
+        """Wait for any submitted notifications, then shut down the pool and close its connections"""
+        self.executor.shutdown()
+        self.mail_session.close()
+        self.slack_session.close()
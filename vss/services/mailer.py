@@ -1,25 +1,71 @@
-from sendgrid import SendGridAPIClient
+import threading
+import requests
+
 from sendgrid.helpers.mail import Mail, Email, Personalization, Content
 
+from ..utils import iter_chunks
+
+DEFAULT_SENDGRID_API_URL = 'https://api.sendgrid.com'
+# SendGrid accepts at most this many personalizations per request
+MAX_PERSONALIZATIONS = 1000
+
+_mailers = {}
+_mailers_lock = threading.Lock()
+
+
+def get_mailer(config):
+    """Return a Mailer shared by all callers with the same SendGrid account, keeping its connections alive"""
+    key = (config.get('SENDGRID_API_URL', DEFAULT_SENDGRID_API_URL), config['SENDGRID_API_KEY'])
+    with _mailers_lock:
+        mailer = _mailers.get(key)
+        if not mailer:
+            mailer = _mailers[key] = Mailer(config)
+    return mailer
+
+
 class Mailer:
-    def __init__(self, config):
+    def __init__(self, config, session=None):
         self.config = config
-        self.client = SendGridAPIClient(apikey=self.config['SENDGRID_API_KEY'])
+        # Mail is posted with requests, so callers can share a pooled session
+        self.session = session or requests.Session()
+        self.url = '{}/v3/mail/send'.format(self.config.get('SENDGRID_API_URL', DEFAULT_SENDGRID_API_URL))
+        self.headers = {
+            'Authorization': 'Bearer {}'.format(self.config['SENDGRID_API_KEY']),
+        }
 
     def build(self, to_email, subject, body):
+        return self.build_batch([to_email], subject, body)
+
+    def build_batch(self, to_emails, subject, body):
         mail = Mail()
         from_email = self.config['MAILER_FROM_EMAIL']
         from_name = self.config['MAILER_FROM_NAME']
         mail.from_email = Email(from_email, from_name)
         mail.subject = subject
 
-        personalization = Personalization()
-        personalization.add_to(Email(to_email))
-        mail.add_personalization(personalization)
+        # One personalization per recipient, so recipients don't see each other
+        for to_email in to_emails:
+            personalization = Personalization()
+            personalization.add_to(Email(to_email))
+            mail.add_personalization(personalization)
 
         mail.add_content(Content("text/plain", body))
 
         return mail.get()
 
+    def iter_batches(self, messages, batch_size=MAX_PERSONALIZATIONS):
+        """Group (to_email, subject, body) messages with identical content into as few mails as possible
+
+        Yields (to_emails, mail) for each mail to send.
+        """
+        # dict: (subject, body) -> list of recipients
+        recipients = {}
+        for to_email, subject, body in messages:
+            recipients.setdefault((subject, body), []).append(to_email)
+
+        for (subject, body), to_emails in recipients.items():
+            for chunk in iter_chunks(to_emails, batch_size):
+                yield chunk, self.build_batch(chunk, subject, body)
+
     def send(self, mail):
-        return self.client.client.mail.send.post(request_body=mail)
+        return self.session.post(self.url, json=mail, headers=self.headers)
@@ -2,17 +2,27 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import requests
 
+from collections import OrderedDict
 from ..constants import BENIGN, UNCERTAIN, UNKNOWN, PATHOGENIC, DEFAULT_NOTIFICATION_PREFERENCES
 from ..backend import get_variant_category
-from ..utils import deep_get
-from .mailer import Mailer
+from ..utils import deep_get, iter_chunks
+from .mailer import get_mailer
+from .dispatcher import NotificationDispatcher, EMAIL, SLACK, FAILED
 
 logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# User fields needed to notify a user of updates
+USER_NOTIFICATION_PROJECTION = ['email', 'token', 'notification_preferences', 'slack.incoming_webhook.url']
+# Number of users loaded per query
+USER_BATCH_SIZE = 1000
+# Number of users kept in the UpdateNotifier's cache (those with queued notifications are also kept)
+MAX_CACHED_USERS = 10000
+# Number of keyed changes (with their rendered text) kept for later batches of their subscribers
+MAX_CACHED_CHANGES = 10000
+
 # dict: FROM -> TO -> FIELD_NAME
 NOTIFICATION_PREFERENCE_MAP = {
     UNKNOWN: {
@@ -56,42 +66,145 @@ def render_rating_slack(gold_stars):
         stars = 0
 
 
-def variant_to_string(user, doc):
-    tag = doc['tags'].get(str(user['_id']), '')
+def variant_to_string(doc, tag=None):
     variant = doc['variant']
+    return format_variant(variant['chrom'], variant['pos'], variant['ref'], variant['alt'], tag)
+
+
+def format_variant(chrom, pos, ref, alt, tag=None):
+    return add_tag('{}:{} {}>{}'.format(chrom, pos, ref, alt), tag)
+
+
+def add_tag(variant_string, tag=None):
     if tag:
-        return '{}:{} {}>{} ({})'.format(variant['chrom'], variant['pos'], variant['ref'], variant['alt'], tag)
+        return '{} ({})'.format(variant_string, tag)
     else:
-        return '{}:{} {}>{}'.format(variant['chrom'], variant['pos'], variant['ref'], variant['alt'])
+        return variant_string
+
+
+# Templates of the parts of a notification that are the same for all subscribers of a variant
+CLINVAR_LINK_TEMPLATE = 'See ClinVar for more information: https://www.ncbi.nlm.nih.gov/clinvar/variation/{}/'
+EMAIL_RECLASSIFICATION_TEMPLATE = """  - new classification: {new} ({new_rating})
+  - previous classification: {old} ({old_rating})
+  - {link}
+"""
+EMAIL_CLASSIFICATION_TEMPLATE = """  - {new} ({new_rating})
+  - {link}
+"""
+SLACK_RECLASSIFICATION_TEMPLATE = '{old} {old_rating} → {new} {new_rating}\n{link}'
+SLACK_CLASSIFICATION_TEMPLATE = '{new} {new_rating}\n{link}'
+
+
+class RenderedChange:
+    """Email and Slack text of a change, up to the tag each subscriber gave the variant"""
+    __slots__ = ['variant_string', 'email_title', 'email_body', 'slack_title', 'slack_body']
+
+    def __init__(self, change):
+        self.variant_string = change.to_string()
+        link = CLINVAR_LINK_TEMPLATE.format(change.variation_id)
+        if change.is_reclassification():
+            self.email_title = 'classification updated'
+            self.slack_title = 'Classification updated'
+            email_template = EMAIL_RECLASSIFICATION_TEMPLATE
+            slack_template = SLACK_RECLASSIFICATION_TEMPLATE
+        else:
+            self.email_title = 'new classification'
+            self.slack_title = 'New classification'
+            email_template = EMAIL_CLASSIFICATION_TEMPLATE
+            slack_template = SLACK_CLASSIFICATION_TEMPLATE
+
+        self.email_body = email_template.format(
+            new=change.new_significance, new_rating=render_rating(change.new_stars),
+            old=change.old_significance, old_rating=render_rating(change.old_stars), link=link)
+        self.slack_body = slack_template.format(
+            new=change.new_significance, new_rating=render_rating(change.new_stars, True),
+            old=change.old_significance, old_rating=render_rating(change.old_stars, True), link=link)
+
+    def make_email_text(self, tag=None):
+        return '{}: {}\n{}'.format(self.email_title, add_tag(self.variant_string, tag), self.email_body)
+
+    def make_slack_field(self, tag=None):
+        return {
+            'title': self.slack_title,
+            'value': '{}\n{}'.format(add_tag(self.variant_string, tag), self.slack_body),
+            'short': False
+        }
+
+
+class VariantChange:
+    """What notifications of a change to a variant need to know, shared by all its subscribers"""
+    __slots__ = ['variant_id', 'chrom', 'pos', 'ref', 'alt', 'variation_id',
+                 'old_significance', 'old_stars', 'new_significance', 'new_stars', 'rendered']
+
+    def __init__(self, old_doc, new_doc):
+        variant = new_doc['variant']
+        self.variant_id = new_doc['_id']
+        self.chrom = variant['chrom']
+        self.pos = variant['pos']
+        self.ref = variant['ref']
+        self.alt = variant['alt']
+        self.variation_id = deep_get(new_doc, 'clinvar.variation_id')
+        # Significance of the previous classification is None for a new classification
+        old_clinvar = deep_get(old_doc, 'clinvar.current')
+        self.old_significance = old_clinvar['clinical_significance'] if old_clinvar else None
+        self.old_stars = old_clinvar['gold_stars'] if old_clinvar else None
+        clinvar = new_doc['clinvar']['current']
+        self.new_significance = clinvar['clinical_significance']
+        self.new_stars = clinvar['gold_stars']
+        self.rendered = None
+
+    def is_reclassification(self):
+        return self.old_significance is not None
+
+    def to_string(self, tag=None):
+        return format_variant(self.chrom, self.pos, self.ref, self.alt, tag)
+
+    def render(self):
+        # Rendered once, on first use, for all subscribers
+        if self.rendered is None:
+            self.rendered = RenderedChange(self)
+        return self.rendered
+
+
+class Notification:
+    """A user's notification of a change, with the tag the user gave the variant
+
+    delivered: channels the notification was already delivered on, by an earlier attempt.
+    """
+    __slots__ = ['change', 'tag', 'delivered']
+
+    def __init__(self, change, tag=None, delivered=()):
+        self.change = change
+        self.tag = tag
+        self.delivered = delivered
 
 
 class Notifier:
     def __init__(self, config):
         self.config = config
 
-    def notify(self, user, subject, body, force_email=True):
+    def can_email(self, user, force_email=True):
         # force_email is used for overriding the user preferences to receive email
         email = user.get('email')
 
         # Take into account user notification preferences
         can_email_user = email and (force_email or deep_get(user, 'notification_preferences.notify_emails', DEFAULT_NOTIFICATION_PREFERENCES['notify_emails']))
         logger.debug('Notifications for user {!r}: email={!r}'.format(email, can_email_user))
+        return can_email_user
 
-        if can_email_user:
-            logger.debug('Sending notification to email: {!r}'.format(email))
-            mailer = Mailer(self.config)
-            mail = mailer.build(email, subject, body)
-            response = mailer.send(mail)
-            if response.status_code != 202:
-                logger.error('Error sending email ({!r}): {!r}'.format(response.status_code, response.body))
-            else:
-                logger.debug('Sent email:\n  to: {!r}\n  subject: {!r}\n  body: {!r}\n  response: {!r}'.format(email, subject, body, response.body))
-
-    def slack_notify(self, user, data):
+    def get_slack_url(self, user):
+        # Returns the user's Slack webhook, if they can be notified on Slack
         email = user.get('email')
         slack_url = deep_get(user, 'slack.incoming_webhook.url')
 
-        json = {
+        # Take into account user notification preferences
+        can_slack_user = slack_url and deep_get(user, 'notification_preferences.notify_slack', DEFAULT_NOTIFICATION_PREFERENCES['notify_slack'])
+        logger.debug('Notifications for user {!r}: slack={!r}'.format(email, can_slack_user))
+        if can_slack_user:
+            return slack_url
+
+    def build_slack_message(self, data):
+        return {
             "attachments": [
                 {
                     "fallback": "Summary of your variants",
@@ -109,17 +222,18 @@ class Notifier:
                 }
             ]
         }
-        # Take into account user notification preferences
-        can_slack_user = slack_url and deep_get(user, 'notification_preferences.notify_slack', DEFAULT_NOTIFICATION_PREFERENCES['notify_slack'])
-        logger.debug('Notifications for user {!r}: slack={!r}'.format(email, can_slack_user))
 
-        if can_slack_user:
-            logger.debug('Posting notification to slack')
-            response = requests.post(slack_url, json=json)
-            if response.status_code != 200:
-                logger.error('Error posting to Slack ({!r}): {!r}'.format(response.status_code, response.text))
+    def notify(self, user, subject, body, force_email=True):
+        email = user.get('email')
+        if self.can_email(user, force_email=force_email):
+            logger.debug('Sending notification to email: {!r}'.format(email))
+            mailer = get_mailer(self.config)
+            mail = mailer.build(email, subject, body)
+            response = mailer.send(mail)
+            if response.status_code != 202:
+                logger.error('Error sending email ({!r}): {!r}'.format(response.status_code, response.text))
             else:
-                logger.debug('Posted to Slack: {!r}'.format(response.text))
+                logger.debug('Sent email:\n  to: {!r}\n  subject: {!r}\n  body: {!r}\n  response: {!r}'.format(email, subject, body, response.text))
 
 
 class ResendTokenNotifier(Notifier):
@@ -162,7 +276,7 @@ class SubscriptionNotifier(Notifier):
         token = user['token']
         email = user.get('email')
 
-        total_subscription_count = self.db.variants.count({ 'subscribers': user_id })
+        total_subscription_count = self.db.subscriptions.count({ 'user_id': user_id })
 
         account_url = '{}/account/?t={}'.format(self.config['BASE_URL'], token)
 
@@ -184,26 +298,64 @@ This link gives full access to your account, so keep it private.
 
 
 class UpdateNotifier(Notifier):
-    def __init__(self, db, config):
+    def __init__(self, db, config, dispatcher=None, changes=None):
         super().__init__(config)
+        # Long-lived dispatcher to send with, or None for one of its own, closed once sent
+        self.dispatcher = dispatcher
+        # dict: change key -> VariantChange (LRU cache), which may be shared by successive notifiers
+        self.changes = changes if changes is not None else OrderedDict()
         self.notifications = {}  # dict: user_id -> list of notifications
-        self.users = {}  # dict: user_id -> user data (memoization)
+        self.deliveries = {}  # dict: user_id -> channel -> outcome of sending their notifications, once sent
+        self.failed = []  # subscriptions whose notification couldn't be built
+        self.users = OrderedDict()  # dict: user_id -> user data or None if missing (LRU cache)
+        self.notified_users = {}  # dict: user_id -> user data, for users with notifications
         self.db = db
         self.config = config
 
+    def _cache_user(self, user_id, user):
+        self.users[user_id] = user
+        self.users.move_to_end(user_id)
+        while len(self.users) > MAX_CACHED_USERS:
+            self.users.popitem(last=False)
+
+    def prefetch_users(self, user_ids):
+        """Load the users not already cached, with a query per USER_BATCH_SIZE users"""
+        missing_ids = [user_id for user_id in set(user_ids) if user_id not in self.users]
+        for chunk in iter_chunks(missing_ids, USER_BATCH_SIZE):
+            users = self.db.users.find({ '_id': { '$in': chunk } }, USER_NOTIFICATION_PROJECTION)
+            users_by_id = dict((user['_id'], user) for user in users)
+            for user_id in chunk:
+                self._cache_user(user_id, users_by_id.get(user_id))
+
     def _get_user(self, user_id):
-        # Get user data, memoized with self.users
-        user = self.users.get(user_id)
-        if not user:
-            user = self.db.users.find_one(user_id)
-            self.users[user_id] = user
-        return user
+        if user_id not in self.users:
+            self.prefetch_users([user_id])
+        else:
+            self.users.move_to_end(user_id)
+        return self.users[user_id]
+
+    def _get_change(self, old_doc, new_doc, change_key=None):
+        # Changes with a key are shared with notifiers using the same cache, e.g. of later batches
+        if change_key is None:
+            return VariantChange(old_doc, new_doc)
+
+        change = self.changes.get(change_key)
+        if change is None:
+            change = self.changes[change_key] = VariantChange(old_doc, new_doc)
+        self.changes.move_to_end(change_key)
+        while len(self.changes) > MAX_CACHED_CHANGES:
+            self.changes.popitem(last=False)
+        return change
 
     def _get_preference_name(self, old_category, new_category):
-        return NOTIFICATION_PREFERENCE_MAP[old_category][new_category]
+        return NOTIFICATION_PREFERENCE_MAP.get(old_category, {}).get(new_category)
 
     def should_notify_user(self, user, old_category, new_category):
         preference_field = self._get_preference_name(old_category, new_category)
+        if preference_field is None:
+            # Users can't choose to be notified of these changes (e.g. to an unknown classification)
+            return False
+
         should_notify = deep_get(user, 'notification_preferences.{}'.format(preference_field, DEFAULT_NOTIFICATION_PREFERENCES[preference_field]))
 
         if should_notify is None:
@@ -211,100 +363,123 @@ class UpdateNotifier(Notifier):
         else:
             return bool(should_notify)
 
-    def notify_of_change(self, old_doc, new_doc):
+    def notify_of_change(self, old_doc, new_doc, subscriptions, change_key=None):
+        # subscriptions: list of the variant's subscriptions, each with user_id, tag and optionally
+        # the channels the change was already delivered on
+        # change_key: identifies the change (e.g. import run and variant), to reuse its record across batches
         old_category = get_variant_category(old_doc)
         new_category = get_variant_category(new_doc)
-        logger.debug('Will notify of change: {!r}'.format(old_doc['subscribers']))
-        for user_id in old_doc['subscribers']:
-            user = self._get_user(user_id)
-            if self.should_notify_user(user, old_category, new_category):
-                logger.info('Will notify user ({!r}) of change to variant: {!r}'.format(user['email'], variant_to_string(user, new_doc)))
-                # Add to user's notification queue
-                user_notifications = self.notifications.setdefault(user_id, [])
-                user_notifications.append({
-                    'old_category': old_category,
-                    'new_category': new_category,
-                    'old_doc': old_doc,
-                    'new_doc': new_doc,
-                })
-            else:
-                logger.info('Skipping notification of user ({!r}) of change to variant ({!r}) due to user preferences'.format(user['email'], new_doc['_id']))
+        logger.debug('Will notify of change: {!r}'.format([subscription['user_id'] for subscription in subscriptions]))
+        change = None
+        for subscription in subscriptions:
+            user_id = subscription['user_id']
+            tag = subscription.get('tag')
+            try:
+                user = self._get_user(user_id)
+                if not user:
+                    logger.error('Skipping notification of missing user: {!r}'.format(user_id))
+                elif self.should_notify_user(user, old_category, new_category):
+                    logger.info('Will notify user ({!r}) of change to variant: {!r}'.format(user['email'], variant_to_string(new_doc, tag)))
+                    if change is None:
+                        change = self._get_change(old_doc, new_doc, change_key)
+                    # Add to user's notification queue
+                    self.notified_users[user_id] = user
+                    self.notifications.setdefault(user_id, []).append(Notification(change, tag, subscription.get('delivered', ())))
+                else:
+                    logger.info('Skipping notification of user ({!r}) of change to variant ({!r}) due to user preferences'.format(user['email'], new_doc['_id']))
+            except Exception:
+                # Don't let one bad change or user stop the others from being notified
+                logger.exception('Error queueing notification of user {!r} of change to variant {!r}'.format(user_id, deep_get(new_doc, '_id')))
+                self.failed.append(subscription)
+
+    def notify_of_changes(self, changes):
+        """Queue notifications of (old_doc, new_doc, subscriptions[, change_key]) changes, loading their subscribers up front"""
+        self.prefetch_users([subscription['user_id'] for change in changes for subscription in change[2]])
+        for change in changes:
+            self.notify_of_change(*change)
 
     def make_notification(self, user, notification):
-        variant = deep_get(notification, 'new_doc.variant')
-        clinvar = deep_get(notification, 'new_doc.clinvar.current')
-        old_clinvar = deep_get(notification, 'old_doc.clinvar.current')
-        variation_id = deep_get(notification, 'new_doc.clinvar.variation_id')
-        variant_string = variant_to_string(user, notification['new_doc'])
-        if old_clinvar:
-            # Re-classification
-            return """classification updated: {}
-  - new classification: {} ({})
-  - previous classification: {} ({})
-  - See ClinVar for more information: https://www.ncbi.nlm.nih.gov/clinvar/variation/{}/
-""".format(variant_string,
-           clinvar['clinical_significance'], render_rating(clinvar['gold_stars']),
-           old_clinvar['clinical_significance'], render_rating(old_clinvar['gold_stars']),
-           variation_id)
-        else:
-            # New classification
-            return """new classification: {}
-  - {} ({})
-  - See ClinVar for more information: https://www.ncbi.nlm.nih.gov/clinvar/variation/{}/
-""".format(variant_string,
-           clinvar['clinical_significance'], render_rating(clinvar['gold_stars']),
-           variation_id)
+        return notification.change.render().make_email_text(notification.tag)
 
     def make_slack_notification(self, user, notification):
-        variant = deep_get(notification, 'new_doc.variant')
-        clinvar = deep_get(notification, 'new_doc.clinvar.current')
-        old_clinvar = deep_get(notification, 'old_doc.clinvar.current')
-        variation_id = deep_get(notification, 'new_doc.clinvar.variation_id')
-        variant_string = variant_to_string(user, notification['new_doc'])
-        data = []
-        if old_clinvar:
-            # Re-classification
-            data.append({
-                'title': 'Classification updated',
-                'value': '{}\n{} {} → {} {}\n'
-                         'See ClinVar for more information: https://www.ncbi.nlm.nih.gov/clinvar/variation/{}/'.format(
-                    variant_string,
-                    old_clinvar['clinical_significance'], render_rating(old_clinvar['gold_stars'], True),
-                    clinvar['clinical_significance'], render_rating(clinvar['gold_stars'], True), variation_id),
-                'short': False
-            })
+        return [notification.change.render().make_slack_field(notification.tag)]
+
+    def build_user_notification(self, user, user_notifications):
+        """Return the email subject, email text and Slack fields notifying a user of their queued notifications"""
+        notification_count = len(user_notifications)
+        if notification_count == 1:
+            # Custom subject for this case
+            variant_string = add_tag(user_notifications[0].change.render().variant_string, user_notifications[0].tag)
+            subject = "🎉  News for your variant: {}".format(variant_string)
         else:
-            data.append({
-                'title': 'New classification',
-                'value': '{}\n{} {}\n'
-                         'See ClinVar for more information: https://www.ncbi.nlm.nih.gov/clinvar/variation/{}/'.format(
-                    variant_string,
-                    clinvar['clinical_significance'], render_rating(clinvar['gold_stars'], True), variation_id),
-                'short': False
-            })
-        return data
+            subject = "🎉  News for {} variants".format(notification_count)
+
+        text_parts = []
+        slack_text_parts = []
+        for i, notification in enumerate(user_notifications):
+            part = '{}. {}'.format(i + 1, self.make_notification(user, notification))
+            text_parts.append(part)
+            slack_text_parts.extend(self.make_slack_notification(user, notification))
+
+        return subject, '\n'.join(text_parts), slack_text_parts
+
+    def get_channels(self, user):
+        """Return the channels to notify a user on, with the user's Slack webhook or None"""
+        channels = []
+        if self.can_email(user):
+            channels.append(EMAIL)
+        slack_url = self.get_slack_url(user)
+        if slack_url:
+            channels.append(SLACK)
+        return channels, slack_url
 
     def send_notifications(self):
+        """Send each user's queued notifications, returning the dispatcher's report of sent, failed and retried counts
+
+        Notifications are only sent on the channels they weren't already delivered on, and the
+        outcome on each channel is kept in deliveries, so a failed channel can be retried alone.
+        """
         logger.debug('Sending notifications to {!r} users'.format(len(self.notifications)))
+        dispatcher = self.dispatcher or NotificationDispatcher(self.config)
+        emails = []
+        user_futures = {}  # dict: user_id -> channel -> future of the request notifying them
+        email_user_ids = {}  # dict: email -> user_ids
         for user_id, user_notifications in self.notifications.items():
-            user = self.users[user_id]
-            logger.debug('Sending {!r} notifications to {!r}'.format(len(user_notifications), user))
-            notification_count = len(user_notifications)
-            if notification_count == 1:
-                # Custom subject for this case
-                variant_string = variant_to_string(user, user_notifications[0]['new_doc'])
-                subject = "🎉  News for your variant: {}".format(variant_string)
-            else:
-                subject = "🎉  News for {} variants".format(notification_count)
-
-            text_parts = []
-            slack_text_parts = []
-            for i, notification in enumerate(user_notifications):
-                part = '{}. {}'.format(i + 1, self.make_notification(user, notification))
-                text_parts.append(part)
-                slack_text_parts.extend(self.make_slack_notification(user, notification))
-
-            text = '\n'.join(text_parts)
-            logger.debug('Email text below:\n{!r}'.format(text))
-            self.notify(user, subject, text)
-            self.slack_notify(user, slack_text_parts)
+            user = self.notified_users[user_id]
+            outcomes = self.deliveries[user_id] = {}
+            futures = user_futures[user_id] = {}
+            channels, slack_url = self.get_channels(user)
+            for channel in channels:
+                notifications = [notification for notification in user_notifications if channel not in notification.delivered]
+                if not notifications:
+                    continue
+
+                logger.debug('Sending {!r} notifications to {!r} by {}'.format(len(notifications), user, channel))
+                try:
+                    subject, text, slack_text_parts = self.build_user_notification(user, notifications)
+                except Exception:
+                    # Nothing is sent to the user, but the others are still notified
+                    logger.exception('Error building notification of user {!r}'.format(user_id))
+                    outcomes[channel] = FAILED
+                    continue
+
+                if channel == EMAIL:
+                    logger.debug('Email text below:\n{!r}'.format(text))
+                    emails.append((user['email'], subject, text))
+                    email_user_ids.setdefault(user['email'], []).append(user_id)
+                else:
+                    futures[SLACK] = dispatcher.post_slack(slack_url, self.build_slack_message(slack_text_parts), description=user.get('email'))
+
+        # Users with the same notifications share a request
+        for to_emails, future in dispatcher.send_emails(emails):
+            for email in to_emails:
+                for user_id in email_user_ids[email]:
+                    user_futures[user_id][EMAIL] = future
+
+        report = dispatcher.join()
+        if dispatcher is not self.dispatcher:
+            dispatcher.close()
+        for user_id, futures in user_futures.items():
+            for channel, future in futures.items():
+                self.deliveries[user_id][channel] = future.result()
+        return report
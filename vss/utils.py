@@ -1,3 +1,12 @@
+import time
+import threading
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from hashlib import blake2b
+
+
 def deep_get(obj, path, default=None):
     """
     Get a deeply nested path, with fallback if it can't be found
@@ -25,6 +34,108 @@ def deep_get(obj, path, default=None):
         return default
 
 
+def iter_chunks(iterable, size):
+    """
+    Yield successive lists of up to size items from iterable
+
+    >>> list(iter_chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+class HashedIdSet:
+    """
+    Compact read-only set of string ids, stored as a sorted array of 64-bit hashes
+
+    Membership tests may (very rarely) give a false positive, but never a false negative.
+
+    >>> ids = HashedIdSet(['a', 'b'])
+    >>> 'a' in ids, 'c' in ids, len(ids)
+    (True, False, 2)
+    """
+    def __init__(self, ids):
+        self.hashes = array('Q', sorted(set(self._hash(value) for value in ids)))
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def __contains__(self, value):
+        value_hash = self._hash(value)
+        i = bisect_left(self.hashes, value_hash)
+        return i < len(self.hashes) and self.hashes[i] == value_hash
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache of up to maxsize items, each expiring ttl seconds after it was set
+
+    >>> cache = TTLCache(maxsize=2, ttl=60)
+    >>> cache.set('a', 1)
+    >>> cache.get('a'), cache.get('b')
+    (1, None)
+    >>> cache.hits, cache.misses
+    (1, 1)
+    """
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.items = OrderedDict()  # dict: key -> (expires_at, value), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item and item[0] > self.timer():
+                self.items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+
+            if item:
+                del self.items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (self.timer() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def pop_matching(self, predicate):
+        """Remove the items whose value matches predicate"""
+        with self.lock:
+            for key in [key for key, (expires_at, value) in self.items.items() if predicate(value)]:
+                del self.items[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
 if __name__ == '__main__':
     assert deep_get({'a': {'b': 5}}, 'a.b') == 5
     assert deep_get({'a': {'b': 5}}, 'foo') is None
@@ -32,3 +143,20 @@ if __name__ == '__main__':
     assert deep_get({'a': {'b': 5}}, 'foo', 0) == 0
     assert deep_get(None, 'foo', 0) == 0
     assert deep_get({'a': None}, 'a.b', 0) == 0
+    assert list(iter_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(iter_chunks([], 2)) == []
+    ids = HashedIdSet(['a', 'b', 'a'])
+    assert 'a' in ids and 'b' in ids and 'c' not in ids
+    assert len(ids) == 2
+    now = [0]
+    cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    now[0] = 10
+    assert cache.get('a') is None and len(cache) == 1
+    cache.pop_matching(lambda value: value == 3)
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (3, 2)
@@ -0,0 +1,72 @@
+import codecs
+import gzip
+import logging
+
+from .backend import VARIANT_PART_DELIMITER, format_variant_string
+
+logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Columns of a VCF data line, up to ALT
+VCF_CHROM, VCF_POS, VCF_ID, VCF_REF, VCF_ALT = range(5)
+# Separators of variant parts accepted in variant lists (e.g. 1:55518071:G:A)
+LIST_PART_SEPARATORS = [':', '_', '/']
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_variant_list(fileobj):
+    """Return a stream of the text lines of an uploaded binary file, decompressing it if gzipped"""
+    magic = fileobj.read(len(GZIP_MAGIC))
+    fileobj.seek(0)
+    if magic == GZIP_MAGIC:
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    return codecs.getreader('utf-8')(fileobj, errors='replace')
+
+
+def iter_entry_variant_strings(entry):
+    """Yield the variant strings of a comma-separated entry of a variant list
+
+    An entry of 4 whitespace-separated fields is a chrom pos ref alt variant, and one of a
+    single field is a variant string or ClinVar Variation id. Otherwise, the fields are
+    variant strings, unless any is a bare integer: since it can't be told apart from part
+    of a variant, the whole entry is yielded as is, for the caller to report as unresolved.
+    """
+    fields = entry.split()
+    if len(fields) == 4 and fields[1].isdigit() and not any(VARIANT_PART_DELIMITER in field for field in fields):
+        yield format_variant_string(*fields)
+    elif len(fields) > 1 and any(field.isdigit() for field in fields):
+        yield ' '.join(fields)
+    else:
+        for field in fields:
+            for separator in LIST_PART_SEPARATORS:
+                field = field.replace(separator, VARIANT_PART_DELIMITER)
+            if field.count(VARIANT_PART_DELIMITER) == 3:
+                field = format_variant_string(*field.split(VARIANT_PART_DELIMITER))
+            yield field
+
+
+def iter_variant_strings(lines):
+    """Yield the variant strings (chrom-pos-ref-alt or ClinVar Variation id) of a variant list or VCF
+
+    Lines are consumed as a stream. A VCF yields each ALT allele of each data line. A list has one
+    variant per line (or several, separated by commas or whitespace), with '#' starting comments.
+    A variant may also be given as chrom pos ref alt, separated by spaces or tabs.
+    Entries are only normalized here: whether they are valid variants is up to the caller.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        columns = line.split('\t')
+        if len(columns) > VCF_ALT:
+            # VCF data line
+            for alt in columns[VCF_ALT].split(','):
+                if alt != '.':
+                    yield format_variant_string(columns[VCF_CHROM], columns[VCF_POS], columns[VCF_REF], alt)
+            continue
+
+        for entry in line.split(','):
+            yield from iter_entry_variant_strings(entry)
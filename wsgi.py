@@ -1,4 +1,6 @@
-from vss import app
+from vss import app, prepare_database
+
+prepare_database(app)
 
 if __name__ == "__main__":
     app.run()